@@ -0,0 +1,105 @@
+# coding: utf-8
+"""
+Micro-benchmark of frame subsampling and frame masking in signjoey.batch.Batch
+against the former per-sequence Python loops.
+
+    python benchmarks/batch_augmentation_benchmark.py --batch_size 64 --max_frames 300
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from signjoey.batch import Batch  # noqa: E402
+
+
+def loop_subsample(sgn, sgn_lengths, ratio, random_init):
+    tmp_sgn = torch.zeros_like(sgn)
+    tmp_sgn_lengths = torch.zeros_like(sgn_lengths)
+    for idx, (features, length) in enumerate(zip(sgn, sgn_lengths)):
+        features = features.clone()
+        if random_init:
+            init_frame = random.randint(0, (ratio - 1))
+        else:
+            init_frame = math.floor((ratio - 1) / 2)
+        tmp_data = features[: length.long(), :]
+        tmp_data = tmp_data[init_frame::ratio]
+        tmp_sgn[idx, 0 : tmp_data.shape[0]] = tmp_data
+        tmp_sgn_lengths[idx] = tmp_data.shape[0]
+    return tmp_sgn[:, : tmp_sgn_lengths.max().long(), :], tmp_sgn_lengths
+
+
+def loop_mask(sgn, sgn_lengths, ratio):
+    tmp_sgn = torch.zeros_like(sgn)
+    num_mask_frames = (sgn_lengths * ratio).floor().long()
+    for idx, features in enumerate(sgn):
+        features = features.clone()
+        mask_frame_idx = np.random.permutation(int(sgn_lengths[idx].long().numpy()))[
+            : num_mask_frames[idx]
+        ]
+        features[mask_frame_idx, :] = 1e-8
+        tmp_sgn[idx] = features
+    return tmp_sgn
+
+
+def make_batch(batch_size, max_frames, feature_size):
+    lengths = torch.randint(max_frames // 4, max_frames + 1, (batch_size,))
+    sgn = torch.zeros(batch_size, int(lengths.max()), feature_size)
+    for i, length in enumerate(lengths):
+        sgn[i, :length] = torch.rand(length, feature_size) + 1e-8
+    return SimpleNamespace(sequence=[""] * batch_size, signer=[""] * batch_size,
+                           sgn=(sgn, lengths))
+
+
+def timeit(fn, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def main():
+    ap = argparse.ArgumentParser("Batch augmentation benchmark")
+    ap.add_argument("--batch_size", type=int, default=32)
+    ap.add_argument("--max_frames", type=int, default=300)
+    ap.add_argument("--feature_size", type=int, default=1024)
+    ap.add_argument("--ratio", type=int, default=2)
+    ap.add_argument("--masking_ratio", type=float, default=0.1)
+    ap.add_argument("--repeats", type=int, default=20)
+    args = ap.parse_args()
+    torch.manual_seed(0)
+
+    tb = make_batch(args.batch_size, args.max_frames, args.feature_size)
+    sgn, lengths = tb.sgn
+
+    # deterministic (eval) subsampling must match exactly
+    ref_sgn, ref_len = loop_subsample(sgn, lengths, args.ratio, random_init=False)
+    batch = Batch(tb, 1, args.feature_size, frame_subsampling_ratio=args.ratio)
+    assert torch.equal(batch.sgn, ref_sgn) and torch.equal(batch.sgn_lengths, ref_len)
+    # masking hits exactly floor(length * ratio) real frames per sequence
+    batch = Batch(tb, 1, args.feature_size, is_train=True,
+                  random_frame_masking_ratio=args.masking_ratio)
+    masked = (batch.sgn[..., 0] == 1e-8).sum(1)
+    assert torch.equal(masked, (lengths * args.masking_ratio).floor().long())
+
+    # time the augmentation itself, without the rest of the batch construction
+    batch = Batch(tb, 1, args.feature_size)
+    results = {
+        "subsampling (loop)": lambda: loop_subsample(sgn, lengths, args.ratio, True),
+        "subsampling (batched)": lambda: batch._subsample_frames(args.ratio, True),
+        "masking (loop)": lambda: loop_mask(sgn, lengths, args.masking_ratio),
+        "masking (batched)": lambda: batch._mask_frames(args.masking_ratio),
+    }
+    for name, fn in results.items():
+        print("{:<24} {:8.2f} ms/batch".format(name, timeit(fn, args.repeats)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# coding: utf-8
+"""
+Parity check and speed of the BLEU and chrF statistics that validate_on_data
+accumulates batch by batch against cached reference statistics, compared to
+signjoey.metrics.bleu and chrf, which score the whole corpus with sacrebleu.
+
+    python benchmarks/bleu_benchmark.py --sentences 5000 --validations 5
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from signjoey.metrics import (  # noqa: E402
+    CorpusStatistics,
+    ReferenceStatistics,
+    bleu,
+    chrf,
+)
+
+
+class Dataset:
+    """Stands in for the dataset the references are cached for."""
+
+
+def make_sentences(num, max_length, vocab_size, seed):
+    rng = random.Random(seed)
+    words = ["w{}".format(i) for i in range(vocab_size)] + [".", ",", "über", "ß"]
+    references, hypotheses = [], []
+    for _ in range(num):
+        ref = [rng.choice(words) for _ in range(rng.randint(0, max_length))]
+        hyp = [w if rng.random() > 0.3 else rng.choice(words) for w in ref]
+        hyp = hyp[: rng.randint(0, len(hyp) + 2)]
+        references.append(" ".join(ref) + rng.choice(["", " ", "\t"]))
+        hypotheses.append(" ".join(hyp) + rng.choice(["", " "]))
+    return references, hypotheses
+
+
+def accumulate(dataset, references, hypotheses, batch_size, rng=None):
+    statistics = CorpusStatistics(ReferenceStatistics.for_dataset(dataset, references))
+    order = list(range(len(references)))
+    if rng is not None:
+        rng.shuffle(order)
+    for start in range(0, len(order), batch_size):
+        indices = order[start : start + batch_size]
+        statistics.add(indices=indices, hypotheses=[hypotheses[i] for i in indices])
+    return statistics.bleu(), statistics.chrf()
+
+
+def main():
+    ap = argparse.ArgumentParser("BLEU and chrF benchmark")
+    ap.add_argument("--sentences", type=int, default=5000)
+    ap.add_argument("--max_length", type=int, default=25)
+    ap.add_argument("--vocab_size", type=int, default=2000)
+    ap.add_argument("--batch_size", type=int, default=32)
+    ap.add_argument("--validations", type=int, default=5)
+    args = ap.parse_args()
+
+    mismatches = 0
+    rng = random.Random(0)
+    for seed, vocab_size in enumerate((3, 10, args.vocab_size)):
+        references, hypotheses = make_sentences(500, 30, vocab_size, seed)
+        ours = accumulate(Dataset(), references, hypotheses, 7, rng)
+        ref = (
+            bleu(references=references, hypotheses=hypotheses),
+            chrf(references=references, hypotheses=hypotheses),
+        )
+        # scores have to be bit-identical
+        mismatches += ours != ref
+    print("parity: {:d} mismatches".format(mismatches))
+
+    references, hypotheses = make_sentences(
+        args.sentences, args.max_length, args.vocab_size, 100
+    )
+    start = time.perf_counter()
+    for _ in range(args.validations):
+        bleu(references=references, hypotheses=hypotheses)
+        chrf(references=references, hypotheses=hypotheses)
+    full_time = time.perf_counter() - start
+
+    dataset = Dataset()
+    start = time.perf_counter()
+    for _ in range(args.validations):
+        accumulate(dataset, references, hypotheses, args.batch_size)
+    cached_time = time.perf_counter() - start
+    print("{:d} validations of {:d} sentences: sacrebleu {:.3f} s  "
+          "cached references {:.3f} s".format(
+              args.validations, args.sentences, full_time, cached_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# coding: utf-8
+"""
+Parity check, speed and activation memory of SignModel.get_loss_for_batch with the
+translation loss computed over the full target length and in slices of
+translation_loss_chunk_size time steps, on a randomly initialized transformer
+with a large text vocabulary.
+
+    python benchmarks/chunked_loss_benchmark.py --vocab_size 30000 --chunk_sizes 4 16
+
+The memory column is the size of the tensors that the forward pass keeps
+for the backward pass. Inside the checkpointed slices nothing is kept, their
+logits are recomputed one slice at a time during the backward pass.
+"""
+import argparse
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from signjoey.batch import Batch  # noqa: E402
+from signjoey.loss import XentLoss  # noqa: E402
+from signjoey.model import build_model  # noqa: E402
+from signjoey.vocabulary import (  # noqa: E402
+    PAD_TOKEN,
+    SIL_TOKEN,
+    GlossVocabulary,
+    TextVocabulary,
+)
+
+
+def make_model(args):
+    layers = {
+        "type": "transformer",
+        "num_layers": 2,
+        "num_heads": 4,
+        "embeddings": {"embedding_dim": args.hidden_size, "dropout": 0.0},
+        "hidden_size": args.hidden_size,
+        "ff_size": 4 * args.hidden_size,
+        "dropout": 0.0,
+    }
+    torch.manual_seed(0)
+    return build_model(
+        cfg={"encoder": dict(layers), "decoder": dict(layers)},
+        sgn_dim=args.sgn_dim,
+        gls_vocab=GlossVocabulary(tokens=["g{}".format(i) for i in range(100)]),
+        txt_vocab=TextVocabulary(
+            tokens=["w{}".format(i) for i in range(args.vocab_size)]
+        ),
+    )
+
+
+def make_batch(args, txt_pad_index):
+    generator = torch.Generator().manual_seed(1)
+    batch_size, sgn_length = args.batch_size, args.sgn_length
+    txt_length = args.txt_length
+    sgn_lengths = torch.randint(
+        sgn_length // 2, sgn_length + 1, (batch_size,), generator=generator
+    )
+    sgn = torch.randn(batch_size, sgn_length, args.sgn_dim, generator=generator)
+    sgn[torch.arange(sgn_length)[None, :] >= sgn_lengths[:, None]] = 0
+    # BOS + words + EOS, padded
+    txt_lengths = torch.randint(2, txt_length + 1, (batch_size,), generator=generator)
+    txt = torch.randint(
+        4, args.vocab_size, (batch_size, txt_length), generator=generator
+    )
+    txt[torch.arange(txt_length)[None, :] >= txt_lengths[:, None]] = txt_pad_index
+    gls_lengths = torch.randint(1, 10, (batch_size,), generator=generator)
+    gls = torch.randint(1, 100, (batch_size, 9), generator=generator)
+    return Batch(
+        torch_batch=SimpleNamespace(
+            sequence=["sequence{}".format(i) for i in range(batch_size)],
+            signer=["signer"] * batch_size,
+            sgn=(sgn, sgn_lengths),
+            txt=(txt, txt_lengths),
+            gls=(gls, gls_lengths),
+        ),
+        txt_pad_index=txt_pad_index,
+        sgn_dim=args.sgn_dim,
+        is_train=True,
+    )
+
+
+def loss_and_grads(model, batch, chunk_size, saved_storages=None):
+    model.zero_grad(set_to_none=True)
+
+    def pack(tensor):
+        if saved_storages is not None:
+            storage = tensor.untyped_storage()
+            saved_storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        recognition_loss, translation_loss = model.get_loss_for_batch(
+            batch=batch,
+            recognition_loss_function=torch.nn.CTCLoss(
+                blank=model.gls_vocab.stoi[SIL_TOKEN], zero_infinity=True
+            ),
+            translation_loss_function=XentLoss(
+                pad_index=model.txt_vocab.stoi[PAD_TOKEN], smoothing=0.1
+            ),
+            recognition_loss_weight=1.0,
+            translation_loss_weight=1.0,
+            translation_loss_chunk_size=chunk_size,
+        )
+    (recognition_loss + translation_loss).backward()
+    return translation_loss.detach(), [p.grad for p in model.parameters()]
+
+
+def flatten(grads):
+    return torch.cat([g.flatten() for g in grads if g is not None])
+
+
+def main():
+    ap = argparse.ArgumentParser("Chunked translation loss benchmark")
+    ap.add_argument("--vocab_size", type=int, default=30000)
+    ap.add_argument("--batch_size", type=int, default=32)
+    ap.add_argument("--txt_length", type=int, default=40)
+    ap.add_argument("--sgn_length", type=int, default=100)
+    ap.add_argument("--sgn_dim", type=int, default=64)
+    ap.add_argument("--hidden_size", type=int, default=256)
+    ap.add_argument("--chunk_sizes", type=int, nargs="+", default=[4, 16])
+    ap.add_argument("--repeats", type=int, default=3)
+    args = ap.parse_args()
+
+    model = make_model(args)
+    model.train()
+    batch = make_batch(args, model.txt_pad_index)
+    full_loss, full_grads = loss_and_grads(model, batch, None)
+    full_grads = flatten(full_grads)
+    for chunk_size in [None] + args.chunk_sizes:
+        saved_storages = {}
+        loss, grads = loss_and_grads(model, batch, chunk_size, saved_storages)
+        times = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            loss_and_grads(model, batch, chunk_size)
+            times.append(time.perf_counter() - start)
+        # relative to the whole gradient, some entries are analytically zero
+        print(
+            "chunk {:>4}  {:9.1f} ms  saved for backward {:7.1f} MB  "
+            "loss difference {:.1e}  gradient difference {:.1e}".format(
+                "full" if chunk_size is None else chunk_size,
+                min(times) * 1000,
+                sum(saved_storages.values()) / 2 ** 20,
+                float((loss - full_loss).abs() / full_loss),
+                float((flatten(grads) - full_grads).norm() / full_grads.norm()),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
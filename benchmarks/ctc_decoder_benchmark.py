@@ -0,0 +1,191 @@
+# coding: utf-8
+"""
+Parity check and latency of signjoey.ctc_decoder against a plain float64
+prefix beam search and the TensorFlow CTC beam search decoder that
+SignModel.run_batch used before.
+
+    python benchmarks/ctc_decoder_benchmark.py --beam_sizes 1 2 5 10 20 50
+
+The TensorFlow comparison is skipped if tensorflow is not installed.
+
+Against the float64 reference, a differing sequence is counted as a tie if
+the reference scores it within --tie_tolerance of its own best sequence, so
+that float32 rounding may pick either. Outputs are not identical to
+TensorFlow: on flat distributions over few classes a few percent of the
+sequences differ for beams >= 2. Besides ties and precision, TensorFlow
+drops the probabilities of the previous frame from a beam entry that it
+evicted from a full beam and proposes again as an extension that does not
+make it into the beam, the entry is then not extended any more.
+signjoey.ctc_decoder keeps extending it, as in the usual prefix beam search.
+"""
+import argparse
+import math
+import os
+import sys
+import time
+from collections import defaultdict
+from itertools import groupby
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from signjoey.ctc_decoder import ctc_decode  # noqa: E402
+from signjoey.language_model import NGramLanguageModel  # noqa: E402
+
+
+def tf_decode(tf, log_probs, lengths, beam_size):
+    # TensorFlow expects time major inputs with the blank as the last class
+    log_probs = log_probs.permute(1, 0, 2).numpy()
+    log_probs = np.concatenate((log_probs[:, :, 1:], log_probs[:, :, 0, None]), axis=-1)
+    decoded, _ = tf.nn.ctc_beam_search_decoder(
+        inputs=log_probs,
+        sequence_length=lengths.numpy().astype(np.int32),
+        beam_width=beam_size,
+        top_paths=1,
+    )
+    sequences = [[] for _ in range(len(lengths))]
+    for (value_idx, dense_idx) in enumerate(decoded[0].indices.numpy()):
+        sequences[dense_idx[0]].append(int(decoded[0].values[value_idx]) + 1)
+    return sequences
+
+
+def logaddexp(a, b):
+    if a == -math.inf:
+        return b
+    if b == -math.inf:
+        return a
+    return max(a, b) + math.log1p(math.exp(-abs(a - b)))
+
+
+def reference_decode(log_probs, lengths, beam_size, blank=0):
+    """Prefix beam search in float64, returns the final beam of every sequence
+    as a dict from prefix to score."""
+    beams_per_sequence = []
+    for sequence, length in zip(log_probs.double().tolist(), lengths.tolist()):
+        beams = {(): (0.0, -math.inf)}  # prefix -> (ends in blank, ends in label)
+        for frame in sequence[:length]:
+            new_beams = defaultdict(lambda: [-math.inf, -math.inf])
+            for prefix, (p_blank, p_label) in beams.items():
+                total = logaddexp(p_blank, p_label)
+                stay = new_beams[prefix]
+                stay[0] = logaddexp(stay[0], total + frame[blank])
+                if prefix:
+                    stay[1] = logaddexp(stay[1], p_label + frame[prefix[-1]])
+                for label, log_prob in enumerate(frame):
+                    if label == blank:
+                        continue
+                    extension = new_beams[prefix + (label,)]
+                    # repeating the last label needs a blank in between
+                    source = p_blank if prefix and prefix[-1] == label else total
+                    extension[1] = logaddexp(extension[1], source + log_prob)
+            best = sorted(new_beams.items(), key=lambda item: -logaddexp(*item[1]))
+            beams = dict(best[:beam_size])
+        beams_per_sequence.append(
+            {prefix: logaddexp(*scores) for prefix, scores in beams.items()}
+        )
+    return beams_per_sequence
+
+
+def compare_to_reference(sequences, reference_beams, tie_tolerance):
+    differ, ties = 0, 0
+    for sequence, beams in zip(sequences, reference_beams):
+        best = max(beams, key=beams.get)
+        if tuple(sequence) != best:
+            differ += 1
+            score = beams.get(tuple(sequence), -math.inf)
+            ties += beams[best] - score <= tie_tolerance
+    return differ, ties
+
+
+def merge_repeated(sequences):
+    return [[x[0] for x in groupby(sequence)] for sequence in sequences]
+
+
+def make_batch(batch_size, max_frames, num_classes, sharpness, seed):
+    generator = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(max_frames // 2, max_frames + 1, (batch_size,),
+                            generator=generator)
+    scores = torch.randn(batch_size, max_frames, num_classes, generator=generator)
+    # make the blank likely, as in trained models
+    scores[:, :, 0] += 2.0
+    return (scores * sharpness).log_softmax(-1), lengths
+
+
+def timeit(fn, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def main():
+    ap = argparse.ArgumentParser("CTC decoder benchmark")
+    ap.add_argument("--batch_size", type=int, default=32)
+    ap.add_argument("--max_frames", type=int, default=100)
+    ap.add_argument("--num_classes", type=int, default=1100)
+    ap.add_argument("--beam_sizes", type=int, nargs="+", default=[1, 2, 5, 10])
+    ap.add_argument("--parity_batches", type=int, default=20)
+    ap.add_argument("--tie_tolerance", type=float, default=1e-4,
+                    help="log-probability difference treated as a tie")
+    ap.add_argument("--repeats", type=int, default=3)
+    ap.add_argument("--lm_order", type=int, default=3,
+                    help="order of a gloss language model on random sentences")
+    args = ap.parse_args()
+
+    try:
+        import tensorflow as tf
+    except ImportError:
+        tf = None
+        print("tensorflow is not installed, skipping the parity check")
+
+    log_probs, lengths = make_batch(args.batch_size, args.max_frames,
+                                    args.num_classes, 1.0, 0)
+    for beam_size in args.beam_sizes:
+        # small vocabularies and flat distributions make prefixes collide often
+        for num_frames, num_classes in ((30, 6), (40, 50)):
+            differ, ties, tf_differ, total = 0, 0, 0, 0
+            for seed in range(args.parity_batches):
+                flat_log_probs, flat_lengths = make_batch(
+                    8, num_frames, num_classes, 0.5 + seed % 4, seed)
+                ours = ctc_decode(flat_log_probs, flat_lengths, beam_size)
+                batch_differ, batch_ties = compare_to_reference(
+                    ours, reference_decode(flat_log_probs, flat_lengths, beam_size),
+                    args.tie_tolerance)
+                differ += batch_differ
+                ties += batch_ties
+                total += len(ours)
+                if tf is not None:
+                    ref = merge_repeated(
+                        tf_decode(tf, flat_log_probs, flat_lengths, beam_size))
+                    tf_differ += sum(
+                        a != b for a, b in zip(merge_repeated(ours), ref))
+            print("parity beam {:<3d} {:2d} classes  float64 reference: {:d}/{:d} "
+                  "differ ({:d} ties)  tensorflow: {}".format(
+                      beam_size, num_classes, differ, total, ties,
+                      "{:d}/{:d} differ".format(tf_differ, total)
+                      if tf is not None else "-"))
+
+    generator = torch.Generator().manual_seed(0)
+    sentences = torch.randint(3, args.num_classes, (7000, 12), generator=generator)
+    lm = NGramLanguageModel(sentences.tolist(), args.num_classes, args.lm_order)
+
+    print("{:<8} {:>14} {:>14} {:>14}".format(
+        "beam", "native [ms]", "native+lm [ms]", "tf [ms]"))
+    for beam_size in [0] + args.beam_sizes:
+        native = timeit(lambda: ctc_decode(log_probs, lengths, beam_size), args.repeats)
+        fused = timeit(lambda: ctc_decode(log_probs, lengths, beam_size, lm=lm,
+                                          lm_weight=0.5, insertion_bonus=1.0),
+                       args.repeats)
+        # TensorFlow is too slow for wide beams
+        if tf is not None and 0 < beam_size <= 10:
+            ref = timeit(lambda: tf_decode(tf, log_probs, lengths, beam_size),
+                         args.repeats)
+        else:
+            ref = float("nan")
+        print("{:<8} {:>14.2f} {:>14.2f} {:>14.2f}".format(
+            "greedy" if beam_size == 0 else beam_size, native, fused, ref))
+
+
+if __name__ == "__main__":
+    main()
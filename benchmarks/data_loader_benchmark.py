@@ -0,0 +1,57 @@
+# coding: utf-8
+"""
+Time one training epoch of batch construction with the torchtext iterator
+and with the torch DataLoader path of signjoey.data.make_data_iter.
+
+    python benchmarks/data_loader_benchmark.py configs/sign.yaml --num_workers 0 2 4
+
+Only batching is timed, no model is involved.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from signjoey.data import load_data, make_data_iter  # noqa: E402
+from signjoey.helpers import load_config  # noqa: E402
+
+
+def run_epoch(data_iter) -> (float, int):
+    start = time.perf_counter()
+    frames = 0
+    for batch in data_iter:
+        frames += int(batch.sgn[1].sum())
+    return time.perf_counter() - start, frames
+
+
+def main():
+    ap = argparse.ArgumentParser("Data loader benchmark")
+    ap.add_argument("config", help="training configuration file")
+    ap.add_argument("--num_workers", type=int, nargs="+", default=[0, 2])
+    ap.add_argument("--epochs", type=int, default=2)
+    args = ap.parse_args()
+
+    cfg = load_config(args.config)
+    train_cfg = cfg["training"]
+    train_data = load_data(data_cfg=cfg["data"])[0]
+
+    runs = [("torchtext", 0)] + [("dataloader", n) for n in args.num_workers]
+    for data_loader, num_workers in runs:
+        data_iter = make_data_iter(
+            train_data,
+            batch_size=train_cfg["batch_size"],
+            batch_type=train_cfg.get("batch_type", "sentence"),
+            train=True,
+            shuffle=True,
+            data_loader=data_loader,
+            num_workers=num_workers,
+        )
+        # first epoch includes worker start-up
+        times = [run_epoch(data_iter)[0] for _ in range(args.epochs)]
+        print("{:<12} workers={:<3d} first {:8.3f} s  last {:8.3f} s/epoch".format(
+            data_loader, num_workers, times[0], times[-1]))
+
+
+if __name__ == "__main__":
+    main()
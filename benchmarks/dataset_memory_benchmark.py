@@ -0,0 +1,95 @@
+# coding: utf-8
+"""
+Memory report of a loaded dataset with contiguous per-example features and
+with the former per-frame tokenization of the sgn field.
+
+    python benchmarks/dataset_memory_benchmark.py data/phoenix.train data/phoenix.dev
+    python benchmarks/dataset_memory_benchmark.py --merge data/hands.train data/body.train
+
+Every dataset and mode is loaded in a fresh interpreter so that peak RSS is
+comparable.
+"""
+import argparse
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def _load(path, mode: str) -> dict:
+    import torch
+    from torchtext import data
+    from signjoey.dataset import SignTranslationDataset, FeatureField
+
+    def split_frames(x):
+        # feature streams used to be concatenated when the dataset was loaded
+        if isinstance(x, tuple):
+            x = torch.cat(x, dim=1)
+        return [ft.squeeze() for ft in torch.split(x, 1, dim=0)]
+
+    if mode == "per-frame":
+        # sgn field as it was before examples kept contiguous features
+        sgn_field = data.RawField(preprocessing=split_frames)
+    else:
+        sgn_field = FeatureField(feature_size=0)
+    fields = (data.RawField(), data.RawField(), sgn_field, data.RawField(),
+              data.RawField())
+
+    gc.collect()
+    rss_before, objects_before = _rss_mb(), len(gc.get_objects())
+    start = time.time()
+    dataset = SignTranslationDataset(path=path, fields=fields)
+    load_time = time.time() - start
+    gc.collect()
+
+    return {
+        "sequences": len(dataset),
+        "load_s": load_time,
+        "objects": len(gc.get_objects()) - objects_before,
+        "rss_mb": _rss_mb() - rss_before,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser("Dataset memory benchmark")
+    ap.add_argument("paths", nargs="+", help="pickle files and/or feature stores")
+    ap.add_argument("--merge", action="store_true",
+                    help="load all paths as feature streams of one dataset")
+    ap.add_argument("--mode", default=None, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.mode is not None:
+        print(json.dumps(_load(args.paths if args.merge else args.paths[0], args.mode)))
+        return
+
+    print("{:<40} {:<11} {:>7} {:>9} {:>11} {:>9} {:>11}".format(
+        "dataset", "mode", "seqs", "load[s]", "objects", "RSS[MB]", "maxRSS[MB]"))
+    groups = [args.paths] if args.merge else [[path] for path in args.paths]
+    for paths in groups:
+        path = "+".join(paths)
+        for mode in ("per-frame", "contiguous"):
+            merge = ["--merge"] if args.merge else []
+            out = subprocess.run(
+                [sys.executable, __file__, *paths, *merge, "--mode", mode],
+                check=True,
+                stdout=subprocess.PIPE,
+            )
+            res = json.loads(out.stdout.decode().strip().splitlines()[-1])
+            print("{:<40} {:<11} {:>7d} {:>9.3f} {:>11d} {:>9.1f} {:>11.1f}".format(
+                path, mode, res["sequences"], res["load_s"], res["objects"],
+                res["rss_mb"], res["max_rss_mb"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# coding: utf-8
+"""
+Hypothesis parity and decoding speed of transformer greedy and beam search
+with the incremental decoder cache, against decoding the whole prefix in
+every step as signjoey.search did before.
+
+    python benchmarks/decoder_cache_benchmark.py --beam_sizes 1 5 --max_output_length 30
+
+The decoder is randomly initialized, so hypotheses rarely end early and
+every step decodes the full batch.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from signjoey.decoders import TransformerDecoder  # noqa: E402
+from signjoey.embeddings import Embeddings  # noqa: E402
+from signjoey.search import beam_search, transformer_greedy  # noqa: E402
+
+
+class FullPrefixDecoder(TransformerDecoder):
+    """
+    Feeds all previous targets through the decoder in every step, as
+    decoding worked without the cache.
+    """
+
+    def init_cache(self, encoder_output=None):
+        return [{"prefix": {}, "memory": {"encoder_output": encoder_output}}]
+
+    def forward(self, trg_embed=None, cache=None, **kwargs):
+        prefix = cache[0]["prefix"]
+        if "embed" in prefix:
+            trg_embed = torch.cat([prefix["embed"], trg_embed], dim=1)
+        prefix["embed"] = trg_embed
+        kwargs["encoder_output"] = cache[0]["memory"]["encoder_output"]
+        return super().forward(trg_embed=trg_embed, cache=None, **kwargs)
+
+
+def decode(decoder, embed, encoder_output, src_mask, beam_size, max_output_length):
+    with torch.no_grad():
+        if beam_size == 0:
+            return transformer_greedy(
+                src_mask=src_mask,
+                embed=embed,
+                bos_index=2,
+                eos_index=3,
+                max_output_length=max_output_length,
+                decoder=decoder,
+                encoder_output=encoder_output,
+                encoder_hidden=None,
+            )[0]
+        return beam_search(
+            decoder=decoder,
+            size=beam_size,
+            bos_index=2,
+            eos_index=3,
+            pad_index=1,
+            encoder_output=encoder_output,
+            encoder_hidden=None,
+            src_mask=src_mask,
+            max_output_length=max_output_length,
+            alpha=1.0,
+            embed=embed,
+        )[0]
+
+
+def main():
+    ap = argparse.ArgumentParser("Decoder cache benchmark")
+    ap.add_argument("--batch_size", type=int, default=32)
+    ap.add_argument("--src_length", type=int, default=100)
+    ap.add_argument("--vocab_size", type=int, default=3000)
+    ap.add_argument("--hidden_size", type=int, default=512)
+    ap.add_argument("--num_layers", type=int, default=3)
+    ap.add_argument("--max_output_length", type=int, default=30)
+    ap.add_argument("--beam_sizes", type=int, nargs="+", default=[1, 5])
+    args = ap.parse_args()
+
+    torch.manual_seed(0)
+    kwargs = dict(
+        num_layers=args.num_layers,
+        num_heads=8,
+        hidden_size=args.hidden_size,
+        ff_size=4 * args.hidden_size,
+        vocab_size=args.vocab_size,
+    )
+    decoder = TransformerDecoder(**kwargs).eval()
+    full_prefix = FullPrefixDecoder(**kwargs).eval()
+    full_prefix.load_state_dict(decoder.state_dict())
+    embed = Embeddings(
+        embedding_dim=args.hidden_size, vocab_size=args.vocab_size, padding_idx=1
+    ).eval()
+
+    encoder_output = torch.randn(args.batch_size, args.src_length, args.hidden_size)
+    lengths = torch.randint(args.src_length // 2, args.src_length + 1, (args.batch_size,))
+    src_mask = (torch.arange(args.src_length)[None, :] < lengths[:, None])[:, None, :]
+
+    print("{:<8} {:>9} {:>16} {:>16} {:>9}".format(
+        "beam", "tokens", "full [tok/s]", "cached [tok/s]", "same"))
+    for beam_size in [0] + args.beam_sizes:
+        results = []
+        for dec in (full_prefix, decoder):
+            start = time.perf_counter()
+            output = decode(dec, embed, encoder_output, src_mask, beam_size,
+                            args.max_output_length)
+            results.append((output, time.perf_counter() - start))
+        (ref, ref_time), (out, out_time) = results
+        # hypotheses, including all beams, times the steps decoded
+        tokens = ref.size * max(beam_size, 1)
+        print("{:<8} {:>9d} {:>16.1f} {:>16.1f} {:>9}".format(
+            "greedy" if beam_size == 0 else beam_size, tokens, tokens / ref_time,
+            tokens / out_time, str(np.array_equal(ref, out))))
+
+
+if __name__ == "__main__":
+    main()
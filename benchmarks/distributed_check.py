@@ -0,0 +1,188 @@
+# coding: utf-8
+"""
+Parity check and speed of distributed training: the configuration is trained
+once in a single process, accumulating the gradients of N batches per update,
+and once with torchrun in N processes with one batch each. Both see the same
+batches in every update, so their losses should agree up to the summation order.
+
+    python benchmarks/distributed_check.py configs/sign.yaml --nproc 2 --epochs 1
+
+Dropout and the random frame subsampling and masking are switched off, the
+per-step losses are compared and, if both runs stored the same best checkpoint,
+its parameters. Within an epoch the processes drop the batches that do not
+fill a last update, so only the common steps are compared.
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from signjoey.helpers import load_config  # noqa: E402
+
+STEP_PATTERN = re.compile(
+    r"\[Epoch: (\d+) Step: (\d+)\] (?:Batch Recognition Loss: +([-\d.]+))?.*?"
+    r"(?:Batch Translation Loss: +([-\d.]+))?"
+)
+
+
+def disable_dropout(cfg):
+    for key, value in cfg.items():
+        if isinstance(value, dict):
+            disable_dropout(value)
+        elif "dropout" in key:
+            cfg[key] = 0.0
+
+
+def write_config(cfg, model_dir, accumulation_size, work_dir, name):
+    cfg = dict(cfg, training=dict(cfg["training"]))
+    cfg["training"].update(
+        model_dir=model_dir,
+        overwrite=True,
+        accumulation_type="batch",
+        accumulation_size=accumulation_size,
+        logging_freq=1,
+    )
+    path = os.path.join(work_dir, name + ".yaml")
+    with open(path, "w") as config_file:
+        yaml.safe_dump(cfg, config_file)
+    return path
+
+
+def step_losses(model_dir):
+    losses = {}
+    with open(os.path.join(model_dir, "train.log")) as log_file:
+        for line in log_file:
+            match = STEP_PATTERN.search(line)
+            if match:
+                losses[int(match.group(2))] = [
+                    float(loss) for loss in match.group(3, 4) if loss is not None
+                ]
+    return losses
+
+
+def run(command, log_path, env):
+    start = time.perf_counter()
+    with open(log_path, "w") as log_file:
+        subprocess.run(
+            command, stdout=log_file, stderr=subprocess.STDOUT, check=True, env=env
+        )
+    return time.perf_counter() - start
+
+
+def main():
+    ap = argparse.ArgumentParser("Distributed training parity check")
+    ap.add_argument("config", help="training configuration file")
+    ap.add_argument("--nproc", type=int, default=2)
+    ap.add_argument("--epochs", type=int, default=1)
+    args = ap.parse_args()
+
+    cfg = load_config(args.config)
+    disable_dropout(cfg["model"])
+    cfg["data"].pop("frame_subsampling_ratio", None)
+    cfg["data"]["random_frame_subsampling"] = False
+    cfg["data"]["random_frame_masking_ratio"] = 0.0
+    cfg["training"]["epochs"] = args.epochs
+    # the test after training is not part of the comparison
+    cfg["testing"] = dict(
+        cfg.get("testing", {}),
+        recognition_beam_sizes=[1],
+        translation_beam_sizes=[1],
+        translation_beam_alphas=[-1],
+    )
+
+    work_dir = tempfile.mkdtemp(prefix="distributed_check_")
+    env = dict(os.environ, WANDB_MODE="disabled")
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(
+            None,
+            [
+                os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                env.get("PYTHONPATH"),
+            ],
+        )
+    )
+    model_dirs = {}
+    for name, accumulation_size in (("single", args.nproc), ("distributed", 1)):
+        model_dirs[name] = os.path.join(work_dir, name)
+        config = write_config(cfg, model_dirs[name], accumulation_size, work_dir, name)
+        if name == "single":
+            command = [sys.executable, "-m", "signjoey", "train", config]
+        else:
+            command = [
+                sys.executable,
+                "-m",
+                "torch.distributed.run",
+                "--standalone",
+                "--nproc_per_node",
+                str(args.nproc),
+                "-m",
+                "signjoey",
+                "train",
+                config,
+            ]
+        # the processes share the cores
+        num_threads = torch.get_num_threads() // (1 if name == "single" else args.nproc)
+        duration = run(
+            command,
+            os.path.join(work_dir, name + ".log"),
+            dict(env, OMP_NUM_THREADS=str(max(num_threads, 1))),
+        )
+        print("{:<12} {:8.1f} s".format(name, duration))
+
+    single, distributed = (step_losses(model_dirs[name]) for name in model_dirs)
+    steps = sorted(set(single) & set(distributed))
+    worst = max(
+        abs(a - b) / max(abs(a), 1e-8)
+        for step in steps
+        for a, b in zip(single[step], distributed[step])
+    )
+    print(
+        "{} common steps ({} single, {} distributed), "
+        "max relative loss difference {:.2e}".format(
+            len(steps), len(single), len(distributed), worst
+        )
+    )
+
+    checkpoints = {
+        name: torch.load(os.path.join(model_dir, "best.ckpt"), map_location="cpu")
+        for name, model_dir in model_dirs.items()
+        if os.path.exists(os.path.join(model_dir, "best.ckpt"))
+    }
+    if len(checkpoints) == 2:
+        single, distributed = checkpoints["single"], checkpoints["distributed"]
+        if single["steps"] != distributed["steps"]:
+            print(
+                "best checkpoints at different steps: {} and {}".format(
+                    single["steps"], distributed["steps"]
+                )
+            )
+            return
+        # buffers like the BatchNorm running statistics are the first process'
+        parameter_names = {
+            name
+            for name, _ in single["model_state"].items()
+            if "running_" not in name and "num_batches_tracked" not in name
+        }
+        worst = max(
+            float(
+                (single["model_state"][name] - distributed["model_state"][name])
+                .abs()
+                .max()
+            )
+            for name in parameter_names
+        )
+        print(
+            "best checkpoint at step {}: max absolute parameter difference "
+            "{:.2e}".format(single["steps"], worst)
+        )
+
+
+if __name__ == "__main__":
+    main()
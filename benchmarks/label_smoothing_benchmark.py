@@ -0,0 +1,149 @@
+# coding: utf-8
+"""
+Parity check, speed and peak memory of the label-smoothed XentLoss against the
+implementation it replaced, which is copied below and builds the dense
+batch*seq_len x vocab_size target distributions for KLDivLoss.
+
+    python benchmarks/label_smoothing_benchmark.py --vocab_sizes 1000 10000 30000
+
+The memory column is the growth of the peak resident set size during one
+forward and backward pass, measured in a separate process per run.
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from signjoey.loss import XentLoss  # noqa: E402
+
+
+class ReferenceXentLoss(nn.Module):
+    def __init__(self, pad_index, smoothing):
+        super().__init__()
+        self.smoothing = smoothing
+        self.pad_index = pad_index
+        self.criterion = nn.KLDivLoss(reduction="sum")
+
+    def _smooth_targets(self, targets, vocab_size):
+        smooth_dist = targets.new_zeros((targets.size(0), vocab_size)).float()
+        smooth_dist.fill_(self.smoothing / (vocab_size - 2))
+        smooth_dist.scatter_(1, targets.unsqueeze(1).data, 1.0 - self.smoothing)
+        smooth_dist[:, self.pad_index] = 0
+        padding_positions = torch.nonzero(targets.data == self.pad_index)
+        if len(padding_positions) > 0:
+            smooth_dist.index_fill_(0, padding_positions.squeeze(), 0.0)
+        return smooth_dist
+
+    def forward(self, log_probs, targets):
+        targets = self._smooth_targets(
+            targets=targets.contiguous().view(-1), vocab_size=log_probs.size(-1)
+        )
+        return self.criterion(
+            log_probs.contiguous().view(-1, log_probs.size(-1)), targets
+        )
+
+
+def make_inputs(batch_size, seq_len, vocab_size, pad_index, seed):
+    generator = torch.Generator().manual_seed(seed)
+    logits = torch.randn(batch_size, seq_len, vocab_size, generator=generator) * 3
+    log_probs = F.log_softmax(logits, dim=-1).requires_grad_()
+    targets = torch.randint(0, vocab_size, (batch_size, seq_len), generator=generator)
+    # padded ends of the sentences, targets may also hit padding by chance
+    lengths = torch.randint(1, seq_len + 1, (batch_size,), generator=generator)
+    targets[torch.arange(seq_len)[None, :] >= lengths[:, None]] = pad_index
+    return log_probs, targets
+
+
+def loss_and_grad(loss_function, log_probs, targets):
+    log_probs.grad = None
+    loss = loss_function(log_probs, targets)
+    loss.backward()
+    return loss.detach(), log_probs.grad
+
+
+def parity():
+    worst_loss, worst_grad = 0.0, 0.0
+    for seed, (vocab_size, smoothing) in enumerate(
+        [(4, 0.1), (50, 0.1), (1000, 0.1), (1000, 0.4), (1000, 1.0), (9000, 0.1)]
+    ):
+        for pad_index in (1, vocab_size - 1):
+            log_probs, targets = make_inputs(16, 20, vocab_size, pad_index, seed)
+            ours = loss_and_grad(
+                XentLoss(pad_index=pad_index, smoothing=smoothing), log_probs, targets
+            )
+            ref = loss_and_grad(
+                ReferenceXentLoss(pad_index=pad_index, smoothing=smoothing),
+                log_probs,
+                targets,
+            )
+            worst_loss = max(worst_loss, float((ours[0] - ref[0]).abs() / ref[0].abs()))
+            worst_grad = max(worst_grad, float((ours[1] - ref[1]).abs().max()))
+    print(
+        "parity: max relative loss difference {:.2e}, "
+        "max absolute gradient difference {:.2e}".format(worst_loss, worst_grad)
+    )
+
+
+def run(args, implementation, vocab_size):
+    loss_class = XentLoss if implementation == "closed_form" else ReferenceXentLoss
+    loss_function = loss_class(pad_index=1, smoothing=0.1)
+    log_probs, targets = make_inputs(
+        args.batch_size, args.seq_len, vocab_size, pad_index=1, seed=0
+    )
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    loss_and_grad(loss_function, log_probs, targets)
+    peak_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss) / 1024
+    times = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        loss_and_grad(loss_function, log_probs, targets)
+        times.append(time.perf_counter() - start)
+    print(
+        "vocab {:6d}  {:<11}  {:8.2f} ms  peak +{:7.1f} MB".format(
+            vocab_size, implementation, min(times) * 1000, peak_mb
+        )
+    )
+
+
+def main():
+    ap = argparse.ArgumentParser("Label smoothing benchmark")
+    ap.add_argument("--vocab_sizes", type=int, nargs="+", default=[1000, 10000, 30000])
+    ap.add_argument("--batch_size", type=int, default=32)
+    ap.add_argument("--seq_len", type=int, default=30)
+    ap.add_argument("--repeats", type=int, default=5)
+    ap.add_argument("--child", nargs=2, default=None, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.child is not None:
+        run(args, args.child[0], int(args.child[1]))
+        return
+    parity()
+    for vocab_size in args.vocab_sizes:
+        for implementation in ("dense", "closed_form"):
+            subprocess.run(
+                [
+                    sys.executable,
+                    os.path.abspath(__file__),
+                    "--batch_size",
+                    str(args.batch_size),
+                    "--seq_len",
+                    str(args.seq_len),
+                    "--repeats",
+                    str(args.repeats),
+                    "--child",
+                    implementation,
+                    str(vocab_size),
+                ],
+                check=True,
+            )
+
+
+if __name__ == "__main__":
+    main()
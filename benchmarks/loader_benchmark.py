@@ -0,0 +1,71 @@
+# coding: utf-8
+"""
+Compare dataset start-up time and resident memory of gzip-pickled dataset
+files and memory-mapped feature stores.
+
+    python benchmarks/loader_benchmark.py data/phoenix.train data/phoenix.train.store
+
+Every dataset is loaded in a fresh interpreter so that peak RSS is comparable.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _load(path: str, touch: int) -> dict:
+    from torchtext import data
+    from signjoey.dataset import SignTranslationDataset
+
+    fields = tuple(data.RawField() for _ in range(5))
+    start = time.time()
+    dataset = SignTranslationDataset(path=path, fields=fields)
+    load_time = time.time() - start
+
+    # read a random subset of sequences, e.g. the first batches of an epoch
+    start = time.time()
+    checksum = 0.0
+    for i in random.Random(0).sample(range(len(dataset)), min(touch, len(dataset))):
+        checksum += float(dataset.examples[i].sgn.sum())
+    touch_time = time.time() - start
+
+    return {
+        "sequences": len(dataset),
+        "load_s": load_time,
+        "touch_s": touch_time,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser("Dataset loader benchmark")
+    ap.add_argument("paths", nargs="+", help="pickle files and/or feature stores")
+    ap.add_argument("--touch", type=int, default=256, help="sequences to read")
+    ap.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.worker:
+        print(json.dumps(_load(args.paths[0], args.touch)))
+        return
+
+    print("{:<50} {:>9} {:>9} {:>9} {:>12}".format(
+        "dataset", "seqs", "load[s]", "touch[s]", "maxRSS[MB]"))
+    for path in args.paths:
+        out = subprocess.run(
+            [sys.executable, __file__, path, "--touch", str(args.touch), "--worker"],
+            check=True,
+            stdout=subprocess.PIPE,
+        )
+        res = json.loads(out.stdout.decode().strip().splitlines()[-1])
+        print("{:<50} {:>9d} {:>9.3f} {:>9.3f} {:>12.1f}".format(
+            path, res["sequences"], res["load_s"], res["touch_s"], res["max_rss_mb"]))
+
+
+if __name__ == "__main__":
+    main()
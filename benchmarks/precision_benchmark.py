@@ -0,0 +1,128 @@
+# coding: utf-8
+"""
+Training steps per second and peak memory of TrainManager._train_update with
+the training precisions fp32 and bf16 (fp16 needs CUDA).
+
+    python benchmarks/precision_benchmark.py configs/sign.yaml --steps 50
+
+Every precision runs in its own process, so that the peak resident set sizes
+can be compared. The peak before training covers the data and the model.
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from signjoey.batch import Batch  # noqa: E402
+from signjoey.data import load_data, make_data_iter  # noqa: E402
+from signjoey.helpers import load_config  # noqa: E402
+from signjoey.model import build_model  # noqa: E402
+from signjoey.training import TrainManager  # noqa: E402
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(config, precision, steps, warmup):
+    cfg = load_config(config)
+    cfg["training"]["precision"] = precision
+    cfg["training"]["overwrite"] = True
+    cfg["training"]["batch_multiplier"] = 1
+    cfg["training"]["model_dir"] = tempfile.mkdtemp(prefix="precision_benchmark_")
+    train_data, _, _, gls_vocab, txt_vocab = load_data(data_cfg=cfg["data"])
+    feature_size = cfg["data"]["feature_size"]
+    sgn_dim = sum(feature_size) if isinstance(feature_size, list) else feature_size
+    torch.manual_seed(cfg["training"].get("random_seed", 42))
+    trainer = TrainManager(
+        model=build_model(
+            cfg=cfg["model"],
+            gls_vocab=gls_vocab,
+            txt_vocab=txt_vocab,
+            sgn_dim=sgn_dim,
+            do_recognition=cfg["training"].get("recognition_loss_weight", 1.0) > 0.0,
+            do_translation=cfg["training"].get("translation_loss_weight", 1.0) > 0.0,
+        ),
+        config=cfg,
+    )
+    trainer.model.train()
+    train_iter = make_data_iter(
+        train_data,
+        batch_size=trainer.batch_size,
+        batch_type=trainer.batch_type,
+        train=True,
+        shuffle=False,
+    )
+    start_rss = peak_rss_mb()
+
+    def batches():
+        while True:
+            for torch_batch in iter(train_iter):
+                yield Batch(
+                    is_train=True,
+                    torch_batch=torch_batch,
+                    txt_pad_index=trainer.txt_pad_index,
+                    sgn_dim=trainer.feature_size,
+                    use_cuda=trainer.use_cuda,
+                )
+
+    batch_iter = batches()
+    for _ in range(warmup):
+        trainer._train_update([next(batch_iter)])
+    elapsed = 0.0
+    losses = []
+    for _ in range(steps):
+        batch = next(batch_iter)
+        start = time.perf_counter()
+        recognition_loss, translation_loss = trainer._train_update([batch])
+        elapsed += time.perf_counter() - start
+        losses.append(float(recognition_loss) + float(translation_loss))
+    print(
+        "{:<5} {:8.2f} steps/s  peak RSS {:8.1f} MB  (before training {:8.1f} MB)"
+        "  mean loss {:.4f}".format(
+            precision,
+            steps / elapsed,
+            peak_rss_mb(),
+            start_rss,
+            sum(losses) / len(losses),
+        )
+    )
+
+
+def main():
+    ap = argparse.ArgumentParser("Training precision benchmark")
+    ap.add_argument("config", help="training configuration file")
+    ap.add_argument("--precisions", nargs="+", default=["fp32", "bf16"])
+    ap.add_argument("--steps", type=int, default=50)
+    ap.add_argument("--warmup", type=int, default=5)
+    ap.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.child is not None:
+        run(args.config, args.child, args.steps, args.warmup)
+        return
+    for precision in args.precisions:
+        subprocess.run(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                args.config,
+                "--steps",
+                str(args.steps),
+                "--warmup",
+                str(args.warmup),
+                "--child",
+                precision,
+            ],
+            check=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# coding: utf-8
+"""
+Parity check and speed of signjoey.metrics.rouge against scoring every
+sentence pair with mscoco_rouge, as rouge did before.
+
+    python benchmarks/rouge_benchmark.py --sentences 5000 --max_length 40
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from signjoey.external_metrics import mscoco_rouge  # noqa: E402
+from signjoey.metrics import rouge  # noqa: E402
+
+
+def reference_rouge(references, hypotheses):
+    rouge_score = 0
+    n_seq = len(hypotheses)
+    for h, r in zip(hypotheses, references):
+        rouge_score += mscoco_rouge.calc_score(hypotheses=[h], references=[r]) / n_seq
+    return rouge_score * 100
+
+
+def make_sentences(num, max_length, vocab_size, seed):
+    rng = random.Random(seed)
+    words = ["w{}".format(i) for i in range(vocab_size)]
+    references, hypotheses = [], []
+    for _ in range(num):
+        ref = [rng.choice(words) for _ in range(rng.randint(0, max_length))]
+        hyp = [w if rng.random() > 0.3 else rng.choice(words) for w in ref]
+        hyp = hyp[: rng.randint(0, len(hyp) + 2)]
+        references.append(" ".join(ref))
+        # double spaces give empty tokens, which count as words
+        hypotheses.append(rng.choice([" ", "  "]).join(hyp))
+    return references, hypotheses
+
+
+def main():
+    ap = argparse.ArgumentParser("ROUGE benchmark")
+    ap.add_argument("--sentences", type=int, default=5000)
+    ap.add_argument("--max_length", type=int, default=40)
+    ap.add_argument("--vocab_size", type=int, default=2000)
+    args = ap.parse_args()
+
+    mismatches = 0
+    for seed, vocab_size in enumerate((2, 5, 50, args.vocab_size)):
+        references, hypotheses = make_sentences(500, 50, vocab_size, seed)
+        # scores have to be bit-identical
+        mismatches += rouge(references, hypotheses) != reference_rouge(
+            references, hypotheses
+        )
+    print("parity: {:d} mismatches".format(mismatches))
+
+    references, hypotheses = make_sentences(
+        args.sentences, args.max_length, args.vocab_size, 100
+    )
+    start = time.perf_counter()
+    reference_rouge(references, hypotheses)
+    reference_time = time.perf_counter() - start
+    start = time.perf_counter()
+    rouge(references, hypotheses)
+    batched_time = time.perf_counter() - start
+    print("{:d} sentences: per sentence {:.3f} s  batched {:.3f} s".format(
+        args.sentences, reference_time, batched_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# coding: utf-8
+"""
+Time validate_on_data on the dev set of a configuration, with batches in
+dataset order and with batches grouped by sign length.
+
+    python benchmarks/validation_benchmark.py configs/sign.yaml --ckpt best.ckpt
+
+Without a checkpoint the model is randomly initialized, its hypotheses then
+usually run to translation_max_output_length.
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from signjoey.data import load_data  # noqa: E402
+from signjoey.helpers import load_checkpoint, load_config  # noqa: E402
+from signjoey.loss import XentLoss  # noqa: E402
+from signjoey.model import build_model  # noqa: E402
+from signjoey.prediction import validate_on_data  # noqa: E402
+from signjoey.vocabulary import PAD_TOKEN, SIL_TOKEN  # noqa: E402
+
+
+def main():
+    ap = argparse.ArgumentParser("Validation benchmark")
+    ap.add_argument("config", help="training configuration file")
+    ap.add_argument("--ckpt", default=None, help="checkpoint to load")
+    ap.add_argument("--translation_beam_size", type=int, default=1)
+    ap.add_argument("--repeats", type=int, default=2)
+    ap.add_argument("--skip_translation_loss", action="store_true",
+                    help="do not run the decoder on the references")
+    args = ap.parse_args()
+
+    cfg = load_config(args.config)
+    train_cfg = cfg["training"]
+    _, dev_data, _, gls_vocab, txt_vocab = load_data(data_cfg=cfg["data"])
+    feature_size = cfg["data"]["feature_size"]
+    sgn_dim = sum(feature_size) if isinstance(feature_size, list) else feature_size
+    do_recognition = train_cfg.get("recognition_loss_weight", 1.0) > 0.0
+    do_translation = train_cfg.get("translation_loss_weight", 1.0) > 0.0
+
+    torch.manual_seed(train_cfg.get("random_seed", 42))
+    model = build_model(
+        cfg=cfg["model"],
+        gls_vocab=gls_vocab,
+        txt_vocab=txt_vocab,
+        sgn_dim=sgn_dim,
+        do_recognition=do_recognition,
+        do_translation=do_translation,
+    )
+    if args.ckpt is not None:
+        model.load_state_dict(load_checkpoint(args.ckpt, use_cuda=False)["model_state"])
+
+    def validate(sort_by_length):
+        return validate_on_data(
+            model=model,
+            data=dev_data,
+            batch_size=train_cfg.get("eval_batch_size", train_cfg["batch_size"]),
+            batch_type=train_cfg.get("eval_batch_type", "sentence"),
+            use_cuda=False,
+            sgn_dim=sgn_dim,
+            txt_pad_index=txt_vocab.stoi[PAD_TOKEN],
+            level=cfg["data"]["level"],
+            do_recognition=do_recognition,
+            recognition_loss_function=torch.nn.CTCLoss(
+                blank=gls_vocab.stoi[SIL_TOKEN], zero_infinity=True
+            ),
+            recognition_loss_weight=1,
+            recognition_beam_size=1,
+            do_translation=do_translation,
+            translation_loss_function=XentLoss(
+                pad_index=txt_vocab.stoi[PAD_TOKEN], smoothing=0.0
+            ),
+            translation_loss_weight=1,
+            translation_max_output_length=train_cfg.get(
+                "translation_max_output_length", None
+            ),
+            translation_beam_size=args.translation_beam_size,
+            translation_beam_alpha=-1,
+            dataset_version=cfg["data"].get("version", "phoenix_2014_trans"),
+            frame_subsampling_ratio=cfg["data"].get("frame_subsampling_ratio", None),
+            sort_by_length=sort_by_length,
+            compute_translation_loss=not args.skip_translation_loss,
+        )
+
+    results = {}
+    for sort_by_length in (False, True):
+        times = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            results[sort_by_length] = validate(sort_by_length)
+            times.append(time.perf_counter() - start)
+        print("sort_by_length={!s:<5}  {:8.3f} s".format(sort_by_length, min(times)))
+
+    for key in ("gls_hyp", "txt_hyp"):
+        if key in results[False]:
+            same = results[False][key] == results[True][key]
+            print("{} identical: {}".format(key, same))
+    same = results[False]["valid_scores"] == results[True]["valid_scores"]
+    print("valid_scores identical: {}".format(same))
+
+
+if __name__ == "__main__":
+    main()
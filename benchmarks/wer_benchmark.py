@@ -0,0 +1,155 @@
+# coding: utf-8
+"""
+Parity check and speed of signjoey.metrics.wer_list against the sentence by
+sentence implementation it replaced, which is copied below.
+
+    python benchmarks/wer_benchmark.py --sentences 5000 --max_length 30
+
+The previous implementation kept the edit distance in uint8, which wraps
+around for long sentences (costs above 255), so the parity check uses
+sentences of at most 40 words.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from signjoey import metrics  # noqa: E402
+from signjoey.metrics import (  # noqa: E402
+    WER_COST_DEL,
+    WER_COST_INS,
+    WER_COST_SUB,
+    get_alignment,
+    wer_list,
+    wer_single,
+)
+
+
+def reference_edit_distance(r, h):
+    d = np.zeros((len(r) + 1) * (len(h) + 1), dtype=np.uint8).reshape(
+        (len(r) + 1, len(h) + 1)
+    )
+    for i in range(len(r) + 1):
+        for j in range(len(h) + 1):
+            if i == 0:
+                d[0][j] = j * WER_COST_INS
+            elif j == 0:
+                d[i][0] = i * WER_COST_DEL
+    for i in range(1, len(r) + 1):
+        for j in range(1, len(h) + 1):
+            if r[i - 1] == h[j - 1]:
+                d[i][j] = d[i - 1][j - 1]
+            else:
+                substitute = d[i - 1][j - 1] + WER_COST_SUB
+                insert = d[i][j - 1] + WER_COST_INS
+                delete = d[i - 1][j] + WER_COST_DEL
+                d[i][j] = min(substitute, insert, delete)
+    return d
+
+
+def reference_wer_single(r, h):
+    r = r.strip().split()
+    h = h.strip().split()
+    alignment, alignment_out = get_alignment(r=r, h=h, d=reference_edit_distance(r, h))
+    return {
+        "alignment": alignment,
+        "alignment_out": alignment_out,
+        "num_cor": alignment.count("C"),
+        "num_del": alignment.count("D"),
+        "num_ins": alignment.count("I"),
+        "num_sub": alignment.count("S"),
+        "num_ref": len(r),
+    }
+
+
+def reference_wer_list(references, hypotheses):
+    total = {"num_del": 0, "num_ins": 0, "num_sub": 0, "num_ref": 0}
+    for r, h in zip(references, hypotheses):
+        res = reference_wer_single(r, h)
+        for key in total:
+            total[key] += res[key]
+    errors = total["num_del"] + total["num_ins"] + total["num_sub"]
+    return {
+        "wer": errors / total["num_ref"] * 100,
+        "del_rate": total["num_del"] / total["num_ref"] * 100,
+        "ins_rate": total["num_ins"] / total["num_ref"] * 100,
+        "sub_rate": total["num_sub"] / total["num_ref"] * 100,
+    }
+
+
+def make_sentences(num, max_length, vocab_size, seed):
+    """References and hypotheses that share many words, as in real outputs."""
+    rng = random.Random(seed)
+    words = ["W{}".format(i) for i in range(vocab_size)]
+    references, hypotheses = [], []
+    for _ in range(num):
+        ref = [rng.choice(words) for _ in range(rng.randint(0, max_length))]
+        hyp = [w for w in ref if rng.random() > 0.2]
+        for _ in range(rng.randint(0, max(1, len(ref) // 4))):
+            hyp.insert(rng.randint(0, len(hyp)), rng.choice(words))
+        hypotheses.append(" ".join(hyp[:max_length]))
+        references.append(" ".join(ref))
+    return references, hypotheses
+
+
+def timeit(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        metrics._wer_cache.clear()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    ap = argparse.ArgumentParser("WER benchmark")
+    ap.add_argument("--sentences", type=int, default=5000)
+    ap.add_argument("--max_length", type=int, default=30)
+    ap.add_argument("--vocab_size", type=int, default=1000)
+    ap.add_argument("--parity_sentences", type=int, default=3000)
+    ap.add_argument("--num_workers", type=int, default=None)
+    ap.add_argument("--repeats", type=int, default=3)
+    args = ap.parse_args()
+
+    # small vocabularies make ties between alignments frequent
+    mismatches = 0
+    for seed, vocab_size in enumerate((3, 5, 20, args.vocab_size)):
+        if args.parity_sentences < 4:
+            break
+        references, hypotheses = make_sentences(
+            args.parity_sentences // 4, 40, vocab_size, seed
+        )
+        for r, h in zip(references, hypotheses):
+            ours = wer_single(r, h, alignment=True)
+            ref = reference_wer_single(r, h)
+            mismatches += any(ours[key] != ref[key] for key in ref)
+        mismatches += wer_list(references, hypotheses) != reference_wer_list(
+            references, hypotheses
+        )
+    print("parity: {:d} mismatches".format(mismatches))
+
+    references, hypotheses = make_sentences(
+        args.sentences, args.max_length, args.vocab_size, 100
+    )
+    reference_time = timeit(
+        lambda: reference_wer_list(references, hypotheses), args.repeats
+    )
+    batched_time = timeit(
+        lambda: wer_list(references, hypotheses, num_workers=args.num_workers),
+        args.repeats,
+    )
+    wer_list(references, hypotheses)
+    start = time.perf_counter()
+    wer_list(references, hypotheses)
+    cached_time = time.perf_counter() - start
+    print("{:d} sentences: previous {:.3f} s  batched {:.3f} s  cached {:.3f} s".format(
+        args.sentences, reference_time, batched_time, cached_time))
+
+
+if __name__ == "__main__":
+    main()
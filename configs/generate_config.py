@@ -47,12 +47,22 @@ def create_config(dataset_name, train_file, dev_file, test_file,
             'eval_recognition_beam_size': 1,
             'eval_translation_beam_size': 1,
             'eval_translation_beam_alpha': -1,
+            'eval_sort_by_length': False,
+            'eval_rouge': True,
+            'eval_translation_loss': True,
             'overwrite': True,
             'shuffle': True,
+            'data_loader': 'torchtext',
+            'num_workers': 0,
+            'pin_memory': False,
             'use_cuda': True,
             'translation_max_output_length': 30,
             'keep_last_ckpts': 1,
             'batch_multiplier': 1,
+            'accumulation_type': 'batch',
+            'precision': 'fp32',
+            'distributed_backend': 'gloo',
+            'distributed_timeout': 7200,
             'logging_freq': 5,
             'validation_freq': 5,
             'betas': [0.9, 0.998],
@@ -61,7 +71,8 @@ def create_config(dataset_name, train_file, dev_file, test_file,
             'weight_decay': 0.001,
             'patience': 8,
             'decrease_factor': 0.7,
-            'label_smoothing': 0.0
+            'label_smoothing': 0.0,
+            'translation_loss_chunk_size': None
         },
         'model': {
             'initializer': 'xavier',
@@ -1,6 +1,9 @@
 import os
+import sys
 import gzip
+import json
 import pickle
+import shutil
 import torch
 import torchvision
 from collections import defaultdict
@@ -15,6 +18,15 @@ from nltk.tokenize import word_tokenize
 from nltk.translate.bleu_score import SmoothingFunction
 from openai import OpenAI
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from signjoey.feature_store import (
+    build_store_from_records,
+    export_records,
+    is_exported,
+    is_feature_store,
+    load_records,
+)
+
 def create_pil_images(data_path):
     """Create a dictionary of PIL images for each video in the given data path.
 
@@ -40,6 +52,59 @@ def create_pil_images(data_path):
     return pil_image_dict
 
 
+def records_dir(filename):
+    """Directory holding the exported records of a dataset.
+
+    Args:
+        filename (str): Pickle filename of the dataset.
+
+    Returns:
+        str: Path of the record directory.
+    """
+    return filename[:-7] + ".records"
+
+
+def store_file(filename, split):
+    """Feature store of a data split.
+
+    Args:
+        filename (str): Pickle filename of the dataset.
+        split (str): One of train, dev and test.
+
+    Returns:
+        str: Path of the feature store directory.
+    """
+    return f"{filename[:-7]}_{split}.store"
+
+
+def splits_file(record_dir):
+    """File listing the video names of the train, dev and test splits of a record directory.
+
+    Args:
+        record_dir (str): Directory of the records.
+
+    Returns:
+        str: Path of the split file.
+    """
+    return os.path.join(record_dir, "splits.json")
+
+
+def export_finished(filename, split=True, record_dir=None):
+    """Check whether a previous run already exported a dataset completely, so it does not have to be created again.
+
+    Args:
+        filename (str): Pickle filename of the dataset.
+        split (bool, optional): Whether the export also builds the train, dev and test feature stores.
+        record_dir (str, optional): Custom directory of the records.
+
+    Returns:
+        bool: True if the export is complete.
+    """
+    if split:
+        return all(is_feature_store(store_file(filename, split_name)) for split_name in ("train", "dev", "test"))
+    return is_exported(record_dir or records_dir(filename))
+
+
 class DataProcessor:
     """ Super class for the data processing methods used by all data objects.
     """
@@ -63,6 +128,7 @@ class DataProcessor:
 
     def load_data(self, filename):
         """Load data_dicts from a pickle file.
+        If the export format is set to store, the data is read from the record directory belonging to the pickle filename instead.
 
         Args:
             filename (str): Name of the file to load the data from.
@@ -70,9 +136,66 @@ class DataProcessor:
         Returns:
             list: data_dicts from the pickle file.
         """             
+        if self.config.get('export_format', 'pickle') == 'store':
+            return load_records(records_dir(filename))
         with gzip.open(filename, "rb") as f:
             return pickle.load(f)
 
+    def export_data(self, filename, split=True, rate=(0.7, 0.1), record_dir=None):
+        """Export the processed data_dicts as one record per video and build train, dev and test feature stores from the records.
+        Replaces dump_data and split_data if the export format is set to store. The records are written by a process pool and
+        an interrupted export continues with the videos that have not been written yet, after checking the hashes of the
+        records it keeps. The split is saved next to the records on the first run, so that a resumed export (e.g. of
+        shuffled augmented data) builds its stores from the same split. Unless all three stores exist, all of them are
+        built again.
+
+        Args:
+            filename (str): Base filename for the exported data. Records go to <filename without .pickle>.records
+            split (bool, optional): Whether to build the train, dev and test feature stores.
+            rate (tuple, optional): Tuple containing the split ratios for train and dev sets. Remaining ratio is assigned to test.
+            record_dir (str, optional): Custom directory for the records.
+        """
+        record_dir = record_dir or records_dir(filename)
+        export_records(self.data_dicts, record_dir, num_workers=self.config.get('num_workers', 1), verify=True)
+        if not split:
+            return
+
+        names = [video["name"] for video in self.data_dicts]
+        if os.path.isfile(splits_file(record_dir)):
+            with open(splits_file(record_dir), "r") as f:
+                splits = json.load(f)
+            if sorted(sum(splits.values(), [])) != sorted(names):
+                raise ValueError(f"The split in {splits_file(record_dir)} does not match the videos of the data.")
+        else:
+            train_index, dev_index = self.split_indices(len(names), rate)
+            splits = {"train": names[:train_index], "dev": names[train_index:dev_index], "test": names[dev_index:]}
+            with open(splits_file(record_dir), "w") as f:
+                json.dump(splits, f)
+
+        stores = {split_name: store_file(filename, split_name) for split_name in splits}
+        rebuild = not all(is_feature_store(store) for store in stores.values())
+        for split_name, split_names in splits.items():
+            if rebuild:
+                if os.path.isdir(stores[split_name]):
+                    shutil.rmtree(stores[split_name])
+                build_store_from_records(record_dir, stores[split_name], names=split_names)
+            # Sanity check
+            print(f"{split_name.capitalize()} data: {len(split_names)}")
+
+    def split_indices(self, num_videos, rate):
+        """Compute where the train and dev portions of the data end.
+
+        Args:
+            num_videos (int): Number of videos in the data.
+            rate (tuple): Tuple containing the split ratios for train and dev sets.
+
+        Returns:
+            tuple: End index of the train data and end index of the dev data.
+        """
+        train_index = int(num_videos * rate[0])
+        dev_index = train_index + int((num_videos - train_index) * rate[1])
+        return train_index, dev_index
+
     def split_data(self, filename, rate=(0.7, 0.1)):
         """Split the data into train, dev, and test sets and save them to separate files.
 
@@ -84,8 +207,7 @@ class DataProcessor:
         dev_file = filename[:-7] + "_dev.pickle"
         test_file = filename[:-7] + "_test.pickle"
 
-        train_index = int(len(self.data_dicts) * rate[0])
-        dev_index = train_index + int(len(self.data_dicts[train_index:]) * rate[1])
+        train_index, dev_index = self.split_indices(len(self.data_dicts), rate)
 
         with gzip.open(train_file, "wb") as train:
             pickle.dump(self.data_dicts[:train_index], train)
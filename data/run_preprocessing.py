@@ -1,6 +1,6 @@
 import yaml
 import os
-from data_processor import create_pil_images, BaselineDataProcessor, BodypartDataProcessor, AugmentedDataProcessor
+from data_processor import create_pil_images, export_finished, BaselineDataProcessor, BodypartDataProcessor, AugmentedDataProcessor
 
 CONFIG_LOCATION = './preprocess_config.yaml'
 
@@ -23,6 +23,15 @@ def generate_file_affix(config):
 
     return affix
 
+def export_to_store(config):
+    """ Check whether the datasets are exported as feature stores instead of pickle files.
+
+    Args: Configuration
+
+    Returns: True if the export format is store.
+    """
+    return config.get('export_format', 'pickle') == 'store'
+
 def process_baseline_data(config):   
     """Create baseline data
 
@@ -30,12 +39,22 @@ def process_baseline_data(config):
 
     Returns: Filename of the created dataset.
     """
+    filename = f"baseline{generate_file_affix(config)}.pickle"
+    path = f"{config['preprocessed_data_location']}/{filename}"
+    # the augmentation step splits the data if augmented data is created
+    split = not config['augmented']
+    if export_to_store(config) and export_finished(path, split):
+        print(f"{filename} has already been exported")
+        return filename
+
     pil_image_dict = create_pil_images(f"{config['raw_data_location']}/tracking-groundtruth-sequences")
     processor = BaselineDataProcessor(config, pil_image_dict)
     processor.create_data()
-    filename = f"baseline{generate_file_affix(config)}.pickle"
-    processor.dump_data(f"{config['preprocessed_data_location']}/{filename}")
-    processor.split_data(f"{config['preprocessed_data_location']}/{filename}")
+    if export_to_store(config):
+        processor.export_data(path, split=split)
+    else:
+        processor.dump_data(path)
+        processor.split_data(path)
     return filename
 
 def process_bodypart_data(config, bodypart, combination_data, whole_data, customFilename = None):   
@@ -50,16 +69,24 @@ def process_bodypart_data(config, bodypart, combination_data, whole_data, custom
 
     Returns: Filenames of the created datasets
     """
+    filename = f"{customFilename}{generate_file_affix(config)}.pickle" if customFilename else f"{bodypart}{generate_file_affix(config)}.pickle"
+    path = f"{config['preprocessed_data_location']}/{filename}"
+    if export_to_store(config) and export_finished(path, not config['augmented']):
+        print(f"{filename} has already been exported")
+        return filename
+
     bodypart_pil_images = create_pil_images(f"{config['raw_data_location']}/tracking-groundtruth-sequences-bodyparts/{bodypart}")
     processor = BodypartDataProcessor(config, bodypart_pil_images, 
                                     f"{config['preprocessed_data_location']}/{whole_data}", 
                                     f"{config['preprocessed_data_location']}/{combination_data}")
     processor.create_data()
 
-    filename = f"{customFilename}{generate_file_affix(config)}.pickle" if customFilename else f"{bodypart}{generate_file_affix(config)}.pickle"
-    processor.dump_data(f"{config['preprocessed_data_location']}/{filename}")
+    if export_to_store(config):
+        processor.export_data(path, split=not config['augmented'])
+        return filename
+    processor.dump_data(path)
     if not config['augmented']:
-        processor.split_data(f"{config['preprocessed_data_location']}/{filename}")
+        processor.split_data(path)
     return filename
 
 def process_augmented_data(config, filename):
@@ -67,10 +94,19 @@ def process_augmented_data(config, filename):
 
     Args: Filename of the file that should be augmented
     """
-    processor = AugmentedDataProcessor(config,f"{config['preprocessed_data_location']}/{filename}")
+    path = f"{config['preprocessed_data_location']}/{filename}"
+    if export_to_store(config) and export_finished(path):
+        print(f"{filename} has already been augmented and exported")
+        return
+
+    processor = AugmentedDataProcessor(config, path)
     processor.augment_data()
-    processor.dump_data(f"{config['preprocessed_data_location']}/{filename}")
-    processor.split_data(f"{config['preprocessed_data_location']}/{filename}")
+    if export_to_store(config):
+        # keep the records of the original data, they are the input of this step
+        processor.export_data(path, record_dir=f"{path[:-7]}_augmented.records")
+    else:
+        processor.dump_data(path)
+        processor.split_data(path)
 
 
 if __name__ == "__main__":
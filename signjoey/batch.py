@@ -1,8 +1,6 @@
 # coding: utf-8
 import math
-import random
 import torch
-import numpy as np
 
 
 class Batch:
@@ -41,38 +39,14 @@ class Batch:
         # Sign
         self.sgn, self.sgn_lengths = torch_batch.sgn
 
-        # Here be dragons
         if frame_subsampling_ratio:
-            tmp_sgn = torch.zeros_like(self.sgn)
-            tmp_sgn_lengths = torch.zeros_like(self.sgn_lengths)
-            for idx, (features, length) in enumerate(zip(self.sgn, self.sgn_lengths)):
-                features = features.clone()
-                if random_frame_subsampling and is_train:
-                    init_frame = random.randint(0, (frame_subsampling_ratio - 1))
-                else:
-                    init_frame = math.floor((frame_subsampling_ratio - 1) / 2)
-
-                tmp_data = features[: length.long(), :]
-                tmp_data = tmp_data[init_frame::frame_subsampling_ratio]
-                tmp_sgn[idx, 0 : tmp_data.shape[0]] = tmp_data
-                tmp_sgn_lengths[idx] = tmp_data.shape[0]
-
-            self.sgn = tmp_sgn[:, : tmp_sgn_lengths.max().long(), :]
-            self.sgn_lengths = tmp_sgn_lengths
+            self.sgn, self.sgn_lengths = self._subsample_frames(
+                frame_subsampling_ratio=frame_subsampling_ratio,
+                random_init_frame=random_frame_subsampling and is_train,
+            )
 
         if random_frame_masking_ratio and is_train:
-            tmp_sgn = torch.zeros_like(self.sgn)
-            num_mask_frames = (
-                (self.sgn_lengths * random_frame_masking_ratio).floor().long()
-            )
-            for idx, features in enumerate(self.sgn):
-                features = features.clone()
-                mask_frame_idx = np.random.permutation(
-                    int(self.sgn_lengths[idx].long().numpy())
-                )[: num_mask_frames[idx]]
-                features[mask_frame_idx, :] = 1e-8
-                tmp_sgn[idx] = features
-            self.sgn = tmp_sgn
+            self.sgn = self._mask_frames(random_frame_masking_ratio)
 
         self.sgn_dim = sgn_dim
         self.sgn_mask = (self.sgn != torch.zeros(sgn_dim))[..., 0].unsqueeze(1)
@@ -111,6 +85,74 @@ class Batch:
         if use_cuda:
             self._make_cuda()
 
+    def _subsample_frames(
+        self, frame_subsampling_ratio: int, random_init_frame: bool
+    ) -> (torch.Tensor, torch.Tensor):
+        """
+        Keep every frame_subsampling_ratio-th frame of each sequence, starting
+        from a random frame (training) or from the centre of the first window.
+        The frames of the whole batch are gathered with a single index.
+
+        :param frame_subsampling_ratio: keep one out of this many frames
+        :param random_init_frame: pick the first frame of each sequence randomly
+        :return: subsampled sgn and sgn_lengths
+        """
+        batch_size, max_length, feature_size = self.sgn.shape
+        lengths = self.sgn_lengths.long()
+        if random_init_frame:
+            init_frame = torch.randint(0, frame_subsampling_ratio, (batch_size,))
+        else:
+            init_frame = torch.full(
+                (batch_size,),
+                math.floor((frame_subsampling_ratio - 1) / 2),
+                dtype=torch.long,
+            )
+
+        # number of frames in features[init_frame:length:frame_subsampling_ratio]
+        new_lengths = (
+            (lengths - init_frame + frame_subsampling_ratio - 1)
+            // frame_subsampling_ratio
+        ).clamp(min=0)
+        steps = torch.arange(int(new_lengths.max()) if batch_size > 0 else 0)
+        valid = steps.unsqueeze(0) < new_lengths.unsqueeze(1)
+        # row index into the flattened [batch_size * max_length, feature_size] view
+        frame_index = (
+            init_frame.unsqueeze(1) + frame_subsampling_ratio * steps
+        ).masked_fill(~valid, 0) + (torch.arange(batch_size) * max_length).unsqueeze(1)
+
+        sgn = self.sgn.reshape(-1, feature_size).index_select(0, frame_index.view(-1))
+        sgn.index_fill_(0, (~valid).view(-1).nonzero().squeeze(1), 0.0)
+        return (
+            sgn.view(batch_size, steps.size(0), feature_size),
+            new_lengths.to(self.sgn_lengths.dtype),
+        )
+
+    def _mask_frames(self, random_frame_masking_ratio: float) -> torch.Tensor:
+        """
+        Replace floor(length * random_frame_masking_ratio) randomly chosen
+        frames of each sequence with 1e-8. Frames are picked by ranking one
+        random score per frame, padding is never picked.
+
+        :param random_frame_masking_ratio: ratio of frames to mask
+        :return: masked sgn
+        """
+        batch_size, max_length, feature_size = self.sgn.shape
+        lengths = self.sgn_lengths.long()
+        num_mask_frames = (self.sgn_lengths * random_frame_masking_ratio).floor().long()
+
+        scores = torch.rand(batch_size, max_length)
+        scores = scores.masked_fill(
+            torch.arange(max_length).unsqueeze(0) >= lengths.unsqueeze(1), 2.0
+        )
+        rank = scores.argsort(dim=1).argsort(dim=1)
+        mask = rank < num_mask_frames.unsqueeze(1)
+        # the padded batch tensor belongs to this batch, so it is masked in place
+        sgn = self.sgn.contiguous()
+        sgn.view(-1, feature_size).index_fill_(
+            0, mask.view(-1).nonzero().squeeze(1), 1e-8
+        )
+        return sgn
+
     def _make_cuda(self):
         """
         Move the batch to GPU
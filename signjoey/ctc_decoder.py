@@ -0,0 +1,229 @@
+# coding: utf-8
+"""
+CTC decoding of gloss log-probabilities
+"""
+from typing import List
+
+import torch
+from torch import Tensor
+
+from signjoey.language_model import NGramLanguageModel
+
+__all__ = ["ctc_greedy_decode", "ctc_beam_search_decode", "ctc_decode"]
+
+# multiplier of the rolling prefix hash, wraps around in int64
+_HASH_BASE = 1000003
+
+
+def _to_lists(tokens: Tensor, lengths: Tensor) -> List[List[int]]:
+    return [row[:length] for row, length in zip(tokens.tolist(), lengths.tolist())]
+
+
+def ctc_greedy_decode(
+    log_probs: Tensor, lengths: Tensor, blank: int = 0
+) -> List[List[int]]:
+    """
+    Best path decoding. Takes the most probable class of every frame, merges
+    repeated classes and removes blanks.
+
+    :param log_probs: log-probabilities of shape (batch, time, classes)
+    :param lengths: number of valid frames of each sequence, shape (batch)
+    :param blank: index of the CTC blank
+    :return: list of decoded class indices for each sequence
+    """
+    batch_size, max_time = log_probs.shape[:2]
+    best = log_probs.argmax(dim=-1)
+    valid = torch.arange(max_time, device=best.device)[None, :] < lengths[:, None]
+    keep = (best != blank) & valid
+    keep[:, 1:] &= best[:, 1:] != best[:, :-1]
+
+    # move kept classes to the front of each row
+    counts = keep.sum(dim=1)
+    order = torch.sort((~keep).to(torch.uint8), dim=1, stable=True).indices
+    return _to_lists(best.gather(1, order).cpu(), counts.cpu())
+
+
+def ctc_beam_search_decode(
+    log_probs: Tensor,
+    lengths: Tensor,
+    beam_size: int,
+    blank: int = 0,
+    lm: NGramLanguageModel = None,
+    lm_weight: float = 0.0,
+    insertion_bonus: float = 0.0,
+) -> List[List[int]]:
+    """
+    CTC prefix beam search, batched over sequences.
+
+    Every hypothesis is a label prefix with the probabilities of ending in a
+    blank and in a label. At each frame, each prefix either stays the same or
+    is extended by a non-blank class. An extension that yields a prefix
+    already in the beam is merged into it. The beam_size most probable
+    prefixes are kept.
+
+    With a language model, every new label adds lm_weight times its language
+    model log-probability and the insertion bonus to the score of a prefix,
+    and the sentence end is scored when picking the final prefix.
+
+    :param log_probs: log-probabilities of shape (batch, time, classes)
+    :param lengths: number of valid frames of each sequence, shape (batch)
+    :param beam_size: number of prefixes kept per sequence
+    :param blank: index of the CTC blank
+    :param lm: language model over the classes, optional
+    :param lm_weight: weight of the language model scores
+    :param insertion_bonus: score added for every label of a prefix
+    :return: list of the most probable prefix of each sequence
+    """
+    batch_size, max_time, num_classes = log_probs.shape
+    device = log_probs.device
+    log_probs = log_probs.float()
+    lengths = lengths.long().to(device)
+    neg_inf = float("-inf")
+    beam_range = torch.arange(batch_size, device=device)[:, None]
+
+    # log-probabilities of ending in blank / non-blank, only beam 0 is alive
+    p_blank = torch.full((batch_size, beam_size), neg_inf, device=device)
+    p_blank[:, 0] = 0.0
+    p_label = torch.full((batch_size, beam_size), neg_inf, device=device)
+    # last label of a prefix, -1 for the empty prefix
+    last = torch.full((batch_size, beam_size), -1, dtype=torch.long, device=device)
+    # hashes of a prefix and of the prefix without its last label
+    prefix_hash = torch.zeros((batch_size, beam_size), dtype=torch.long, device=device)
+    parent_hash = torch.full_like(prefix_hash, -1)
+    prefixes = torch.zeros(
+        (batch_size, beam_size, max_time), dtype=torch.long, device=device
+    )
+    prefix_lengths = torch.zeros_like(prefix_hash)
+    use_lm = lm is not None and lm_weight != 0.0
+    if use_lm:
+        lm_states = torch.full_like(prefix_hash, lm.start_state)
+
+    classes = torch.arange(num_classes, device=device)
+    for t in range(max_time):
+        frame = log_probs[:, t]
+        total = torch.logaddexp(p_blank, p_label)
+        alive = total > neg_inf
+
+        # prefix stays: a blank is emitted or the last label is repeated
+        stay_blank = total + frame[:, blank, None]
+        stay_label = torch.where(
+            last >= 0, p_label + frame.gather(1, last.clamp(min=0)), neg_inf
+        )
+
+        # prefix is extended by a class, repeating the last label needs a blank
+        extend = torch.where(
+            classes[None, None, :] == last[:, :, None],
+            p_blank[:, :, None],
+            total[:, :, None],
+        ) + frame[:, None, :]
+        extend[:, :, blank] = neg_inf
+        if use_lm:
+            extend += lm_weight * lm.score(lm_states)
+        if insertion_bonus != 0.0:
+            extend += insertion_bonus
+
+        # an extension of beam k by the last label of beam j is beam j itself
+        merge = (
+            (parent_hash[:, None, :] == prefix_hash[:, :, None])
+            & alive[:, :, None]
+            & alive[:, None, :]
+            & (last[:, None, :] >= 0)
+        )
+        extend = extend.flatten(1)
+        # beams without a parent in the beam point at a blank column (-inf)
+        merge_index = torch.where(
+            merge.any(dim=1),
+            merge.float().argmax(dim=1) * num_classes + last,
+            blank,
+        )
+        stay_label = torch.logaddexp(stay_label, extend.gather(1, merge_index))
+        extend.scatter_(1, merge_index, neg_inf)
+
+        scores = torch.cat([torch.logaddexp(stay_blank, stay_label), extend], dim=1)
+        best = scores.topk(beam_size, dim=1).indices
+        is_extension = best >= beam_size
+        extension = (best - beam_size).clamp(min=0)
+        source = torch.where(is_extension, extension // num_classes, best)
+        label = extension % num_classes
+
+        new_blank = torch.where(is_extension, neg_inf, stay_blank.gather(1, source))
+        new_label = torch.where(
+            is_extension, extend.gather(1, extension), stay_label.gather(1, source)
+        )
+        source_hash = prefix_hash.gather(1, source)
+        new_hash = torch.where(
+            is_extension, source_hash * _HASH_BASE + label + 1, source_hash
+        )
+        new_parent_hash = torch.where(
+            is_extension, source_hash, parent_hash.gather(1, source)
+        )
+        new_last = torch.where(is_extension, label, last.gather(1, source))
+        new_lengths = prefix_lengths.gather(1, source)
+        new_prefixes = prefixes[beam_range, source]
+        # positions from a prefix length on are unused for prefixes that stay
+        new_prefixes.scatter_(2, new_lengths[:, :, None], label[:, :, None])
+        new_lengths = new_lengths + is_extension.long()
+        if use_lm:
+            new_lm_states = torch.where(
+                is_extension,
+                lm.advance(lm_states.gather(1, source), label),
+                lm_states.gather(1, source),
+            )
+
+        # sequences that already ended keep their beams
+        active = (t < lengths)[:, None]
+        p_blank = torch.where(active, new_blank, p_blank)
+        p_label = torch.where(active, new_label, p_label)
+        prefix_hash = torch.where(active, new_hash, prefix_hash)
+        parent_hash = torch.where(active, new_parent_hash, parent_hash)
+        last = torch.where(active, new_last, last)
+        prefixes = torch.where(active[:, :, None], new_prefixes, prefixes)
+        prefix_lengths = torch.where(active, new_lengths, prefix_lengths)
+        if use_lm:
+            lm_states = torch.where(active, new_lm_states, lm_states)
+
+    final_scores = torch.logaddexp(p_blank, p_label)
+    if use_lm:
+        final_scores = final_scores + lm_weight * lm.end_score(lm_states)
+    best = final_scores.argmax(dim=1)
+    return _to_lists(
+        prefixes[beam_range[:, 0], best].cpu(),
+        prefix_lengths[beam_range[:, 0], best].cpu(),
+    )
+
+
+def ctc_decode(
+    log_probs: Tensor,
+    lengths: Tensor,
+    beam_size: int = 1,
+    blank: int = 0,
+    lm: NGramLanguageModel = None,
+    lm_weight: float = 0.0,
+    insertion_bonus: float = 0.0,
+) -> List[List[int]]:
+    """
+    Decode CTC log-probabilities with best path decoding if beam_size is 0,
+    and with prefix beam search otherwise. The language model is only used by
+    the beam search.
+
+    :param log_probs: log-probabilities of shape (batch, time, classes)
+    :param lengths: number of valid frames of each sequence, shape (batch)
+    :param beam_size: number of prefixes kept per sequence, 0 for greedy
+    :param blank: index of the CTC blank
+    :param lm: language model over the classes, optional
+    :param lm_weight: weight of the language model scores
+    :param insertion_bonus: score added for every label of a prefix
+    :return: list of decoded class indices for each sequence
+    """
+    with torch.no_grad():
+        if beam_size < 1:
+            return ctc_greedy_decode(log_probs, lengths, blank=blank)
+        return ctc_beam_search_decode(
+            log_probs,
+            lengths,
+            beam_size=beam_size,
+            blank=blank,
+            lm=lm,
+            lm_weight=lm_weight,
+            insertion_bonus=insertion_bonus,
+        )
@@ -5,12 +5,13 @@ Data module
 import os
 import sys
 import random
+from typing import List
 
 import torch
 from torchtext import data
-from torchtext.data import Dataset, Iterator
+from torchtext.data import Dataset
 import socket
-from signjoey.dataset import SignTranslationDataset
+from signjoey.dataset import SignTranslationDataset, FeatureField, pad_features
 from signjoey.vocabulary import (
     build_vocab,
     Vocabulary,
@@ -71,28 +72,9 @@ def load_data(data_cfg: dict) -> (Dataset, Dataset, Dataset, Vocabulary, Vocabul
         else:
             return text.split()
 
-    def tokenize_features(features):
-        ft_list = torch.split(features, 1, dim=0)
-        return [ft.squeeze() for ft in ft_list]
-
-    # NOTE (Cihan): The something was necessary to match the function signature.
-    def stack_features(features, something):
-        return torch.stack([torch.stack(ft, dim=0) for ft in features], dim=0)
-
     sequence_field = data.RawField()
     signer_field = data.RawField()
-
-    sgn_field = data.Field(
-        use_vocab=False,
-        init_token=None,
-        dtype=torch.float32,
-        preprocessing=tokenize_features,
-        tokenize=lambda features: features,  # TODO (Cihan): is this necessary?
-        batch_first=True,
-        include_lengths=True,
-        postprocessing=stack_features,
-        pad_token=torch.zeros((pad_feature_size,)),
-    )
+    sgn_field = FeatureField(feature_size=pad_feature_size)
 
     gls_field = data.Field(
         pad_token=PAD_TOKEN,
@@ -116,7 +98,7 @@ def load_data(data_cfg: dict) -> (Dataset, Dataset, Dataset, Vocabulary, Vocabul
     train_data = SignTranslationDataset(
         path=train_paths,
         fields=(sequence_field, signer_field, sgn_field, gls_field, txt_field),
-        filter_pred=lambda x: len(vars(x)["sgn"]) <= max_sent_length
+        filter_pred=lambda x: x.sgn_length <= max_sent_length
         and len(vars(x)["txt"]) <= max_sent_length,
     )
 
@@ -175,27 +157,296 @@ def load_data(data_cfg: dict) -> (Dataset, Dataset, Dataset, Vocabulary, Vocabul
     return train_data, dev_data, test_data, gls_vocab, txt_vocab
 
 
-# TODO (Cihan): I don't like this use of globals.
-#  Need to find a more elegant solution for this it at some point.
-# pylint: disable=global-at-module-level
-global max_sgn_in_batch, max_gls_in_batch, max_txt_in_batch
+class BucketBatchSampler:
+    """
+    Groups example indices of a dataset into batches.
+
+    The sgn, gls and txt lengths of all examples are computed once, batches are
+    then packed from these lengths. With batch_type "token" a batch is closed
+    as soon as adding another example would exceed batch_size padded elements
+    (batch size times the longest sgn, gls or txt sequence in the batch).
+
+    During training, examples are shuffled and split into pools of 100 batches,
+    each pool is sorted by sgn length before it is cut into batches, and the
+    batches of a pool are shuffled. Examples within a training batch are
+    sorted by decreasing sgn length. This follows the bucketing of torchtext's
+    BucketIterator and consumes the random state the same way.
+    Without training, batches keep the order of the dataset, unless
+    sort_by_length is set: then examples are ordered by sgn length, so that
+    examples of similar length end up in the same batch.
+
+    With num_shards > 1 every process of a distributed training iterates over
+    its own share of the batches of an epoch: shard_index, shard_index +
+    num_shards, ... All shards get the same number of batches, the last
+    batches of an epoch that can not be shared out evenly are left out.
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        batch_size: int,
+        batch_type: str = "sentence",
+        train: bool = False,
+        shuffle: bool = False,
+        sort_by_length: bool = False,
+        num_shards: int = 1,
+        shard_index: int = 0,
+    ):
+        """
+        :param dataset: torchtext dataset containing sgn and optionally gls/txt
+        :param batch_size: size of the batches (sentences or padded elements)
+        :param batch_type: measure batch size by sentence count or by token count
+        :param train: whether it's training time (bucketing and sorting)
+        :param shuffle: whether to shuffle the data before each epoch
+        :param sort_by_length: whether to order examples by sgn length when
+            not training
+        :param num_shards: number of processes that share the batches
+        :param shard_index: index of the share of this process
+        """
+        self.batch_size = batch_size
+        self.batch_type = batch_type
+        self.train = train
+        self.shuffle = shuffle
+        self.sort_by_length = sort_by_length
+        self.num_shards = num_shards
+        self.shard_index = shard_index
+
+        examples = dataset.examples
+        self.sgn_lengths = [ex.sgn_length for ex in examples]
+        self.gls_lengths = [len(getattr(ex, "gls", ())) for ex in examples]
+        # +2 for BOS and EOS
+        self.txt_lengths = [len(getattr(ex, "txt", ())) + 2 for ex in examples]
+
+        # private copy of the global random state, so that shuffling does not
+        # depend on (or interfere with) other users of the random module
+        self.random = random.Random()
+        self.random.setstate(random.getstate())
+
+        self._padding = self._new_padding_stats()
+        # batches of the next epoch, once __len__ needed them
+        self._next_batches = None
+
+    def _size(self, count: int, max_lengths: tuple) -> int:
+        if self.batch_type == "token":
+            return count * max(max_lengths)
+        return count
+
+    def _lengths(self, i: int) -> tuple:
+        return self.sgn_lengths[i], self.gls_lengths[i], self.txt_lengths[i]
+
+    def _pack(self, indices: List[int], batch_size: int) -> List[List[int]]:
+        batches = []
+        batch, max_lengths = [], (0, 0, 0)
+        for i in indices:
+            lengths = self._lengths(i)
+            new_max = tuple(max(m, l) for m, l in zip(max_lengths, lengths))
+            size = self._size(len(batch) + 1, new_max)
+            if batch and size > batch_size:
+                batches.append(batch)
+                batch, max_lengths = [i], lengths
+                continue
+            batch.append(i)
+            max_lengths = new_max
+            if size == batch_size:
+                batches.append(batch)
+                batch, max_lengths = [], (0, 0, 0)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def batches(self) -> List[List[int]]:
+        """
+        Create the batches of one epoch.
+
+        :return: list of batches, each a list of example indices
+        """
+        num_examples = len(self.sgn_lengths)
+        if self.shuffle:
+            order = self.random.sample(range(num_examples), num_examples)
+        elif self.sort_by_length and not self.train:
+            order = sorted(range(num_examples), key=lambda i: self.sgn_lengths[i])
+        else:
+            order = list(range(num_examples))
+
+        batches = []
+        for pool in self._pack(order, self.batch_size * 100):
+            if self.train:
+                pool = sorted(pool, key=lambda i: self.sgn_lengths[i])
+            pool_batches = self._pack(pool, self.batch_size)
+            if self.shuffle:
+                pool_batches = self.random.sample(pool_batches, len(pool_batches))
+            batches.extend(pool_batches)
+
+        if self.train:
+            batches = [
+                sorted(b, key=lambda i: self.sgn_lengths[i], reverse=True)
+                for b in batches
+            ]
+        return batches
+
+    @staticmethod
+    def _new_padding_stats() -> dict:
+        return {k: [0, 0] for k in ("sgn", "gls", "txt")}
+
+    def _count_padding(self, batch: List[int]):
+        for key, lengths in (
+            ("sgn", self.sgn_lengths),
+            ("gls", self.gls_lengths),
+            ("txt", self.txt_lengths),
+        ):
+            batch_lengths = [lengths[i] for i in batch]
+            self._padding[key][0] += sum(batch_lengths)
+            self._padding[key][1] += len(batch) * max(batch_lengths)
+
+    def padding_efficiency(self) -> dict:
+        """
+        Ratio of real to padded sgn frames, gls tokens and txt tokens in the
+        batches of the last (or current) epoch.
+
+        :return: dictionary with the ratio for sgn, gls and txt
+        """
+        return {
+            k: real / padded if padded > 0 else 1.0
+            for k, (real, padded) in self._padding.items()
+        }
+
+    def _epoch_batches(self) -> List[List[int]]:
+        if self._next_batches is None:
+            batches = self.batches()
+            if self.num_shards > 1:
+                # every process shuffles the same way, as they share the random
+                # state
+                batches = batches[: len(batches) - len(batches) % self.num_shards]
+                batches = batches[self.shard_index :: self.num_shards]
+            self._next_batches = batches
+        return self._next_batches
+
+    def __iter__(self):
+        batches = self._epoch_batches()
+        self._next_batches = None
+        self._padding = self._new_padding_stats()
+        for batch in batches:
+            self._count_padding(batch)
+            yield batch
+
+    def __len__(self) -> int:
+        # the next epoch is drawn here already, its iteration then reuses it
+        return len(self._epoch_batches())
+
+
+class SamplerIterator:
+    """
+    Iterates over torchtext batches of a dataset as grouped by a batch sampler.
+    """
+
+    def __init__(self, dataset: Dataset, batch_sampler: BucketBatchSampler):
+        """
+        :param dataset: torchtext dataset
+        :param batch_sampler: sampler that yields lists of example indices
+        """
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+
+    def __iter__(self):
+        for indices in self.batch_sampler:
+            yield data.Batch([self.dataset[i] for i in indices], self.dataset)
+
+    def __len__(self) -> int:
+        return len(self.batch_sampler)
 
 
-# pylint: disable=unused-argument,global-variable-undefined
-def token_batch_size_fn(new, count, sofar):
-    """Compute batch size based on number of tokens (+padding)"""
-    global max_sgn_in_batch, max_gls_in_batch, max_txt_in_batch
-    if count == 1:
-        max_sgn_in_batch = 0
-        max_gls_in_batch = 0
-        max_txt_in_batch = 0
-    max_sgn_in_batch = max(max_sgn_in_batch, len(new.sgn))
-    max_gls_in_batch = max(max_gls_in_batch, len(new.gls))
-    max_txt_in_batch = max(max_txt_in_batch, len(new.txt) + 2)
-    sgn_elements = count * max_sgn_in_batch
-    gls_elements = count * max_gls_in_batch
-    txt_elements = count * max_txt_in_batch
-    return max(sgn_elements, gls_elements, txt_elements)
+class SignDataset(torch.utils.data.Dataset):
+    """
+    Map-style torch dataset on top of a torchtext sign translation dataset.
+    Glosses and texts are converted to vocabulary indices once, so that
+    batches can be assembled without torchtext fields.
+    """
+
+    def __init__(self, dataset: Dataset):
+        """
+        :param dataset: torchtext dataset whose gls and txt fields have a vocab
+        """
+        self.examples = dataset.examples
+        gls_vocab = dataset.fields["gls"].vocab
+        txt_vocab = dataset.fields["txt"].vocab
+        gls_unk = gls_vocab.DEFAULT_UNK_ID()
+        txt_unk = txt_vocab.DEFAULT_UNK_ID()
+        bos, eos = txt_vocab.stoi[BOS_TOKEN], txt_vocab.stoi[EOS_TOKEN]
+        self.gls = [[gls_vocab.stoi.get(t, gls_unk) for t in ex.gls] for ex in self.examples]
+        self.txt = [
+            [bos] + [txt_vocab.stoi.get(t, txt_unk) for t in ex.txt] + [eos]
+            for ex in self.examples
+        ]
+
+    def __len__(self) -> int:
+        return len(self.examples)
+
+    def __getitem__(self, i: int) -> tuple:
+        ex = self.examples[i]
+        return ex.sequence, ex.signer, ex.sgn, self.gls[i], self.txt[i]
+
+
+class SignDataBatch:
+    """
+    Batch produced by SignCollator. Has the same attributes as a torchtext
+    batch of a sign translation dataset, so it can be passed to ``Batch``.
+    """
+
+    def __init__(self, sequence, signer, sgn, gls, txt):
+        self.sequence = sequence
+        self.signer = signer
+        self.sgn = sgn
+        self.gls = gls
+        self.txt = txt
+
+    def pin_memory(self):
+        """
+        Called by the DataLoader when pin_memory is set.
+        """
+        self.sgn = tuple(t.pin_memory() for t in self.sgn)
+        self.gls = tuple(t.pin_memory() for t in self.gls)
+        self.txt = tuple(t.pin_memory() for t in self.txt)
+        return self
+
+
+class SignCollator:
+    """
+    Collates SignDataset items into a SignDataBatch. Frames are padded by
+    writing them directly into one preallocated, zero-initialised tensor.
+    """
+
+    def __init__(self, feature_size: int, gls_pad_index: int, txt_pad_index: int):
+        """
+        :param feature_size: size of a single frame
+        :param gls_pad_index: padding index of the gloss vocabulary
+        :param txt_pad_index: padding index of the text vocabulary
+        """
+        self.feature_size = feature_size
+        self.gls_pad_index = gls_pad_index
+        self.txt_pad_index = txt_pad_index
+
+    @staticmethod
+    def _pad_indices(sequences: List[List[int]], pad_index: int) -> tuple:
+        lengths = torch.tensor([len(x) for x in sequences], dtype=torch.long)
+        padded = torch.full(
+            (len(sequences), int(lengths.max())), pad_index, dtype=torch.long
+        )
+        for i, x in enumerate(sequences):
+            padded[i, : len(x)] = torch.tensor(x, dtype=torch.long)
+        return padded, lengths
+
+    def __call__(self, items: List[tuple]) -> SignDataBatch:
+        sequence, signer, sgn, gls, txt = zip(*items)
+
+        padded_sgn, sgn_lengths = pad_features(sgn, self.feature_size)
+
+        return SignDataBatch(
+            sequence=list(sequence),
+            signer=list(signer),
+            sgn=(padded_sgn, sgn_lengths),
+            gls=self._pad_indices(gls, self.gls_pad_index),
+            txt=self._pad_indices(txt, self.txt_pad_index),
+        )
 
 
 def make_data_iter(
@@ -204,9 +455,16 @@ def make_data_iter(
     batch_type: str = "sentence",
     train: bool = False,
     shuffle: bool = False,
-) -> Iterator:
+    data_loader: str = "torchtext",
+    num_workers: int = 0,
+    pin_memory: bool = False,
+    prefetch_factor: int = 2,
+    sort_by_length: bool = False,
+    num_shards: int = 1,
+    shard_index: int = 0,
+):
     """
-    Returns a torchtext iterator for a torchtext dataset.
+    Returns an iterator over batches for a torchtext dataset.
 
     :param dataset: torchtext dataset containing sgn and optionally txt
     :param batch_size: size of the batches the iterator prepares
@@ -215,33 +473,50 @@ def make_data_iter(
         bucketing, sorting within batches and shuffling is disabled
     :param shuffle: whether to shuffle the data before each epoch
         (no effect if set to True for testing)
-    :return: torchtext iterator
+    :param data_loader: "torchtext" to build batches with the torchtext fields,
+        "dataloader" to use a torch DataLoader with SignCollator
+    :param num_workers: number of DataLoader worker processes
+    :param pin_memory: whether the DataLoader returns batches in pinned memory
+    :param prefetch_factor: number of batches loaded in advance by each worker
+    :param sort_by_length: whether to group examples of similar sgn length
+        into batches when not training, batches are then not in the order of
+        the dataset
+    :param num_shards: number of processes that share the batches, e.g. in
+        distributed training
+    :param shard_index: index of the share of this process
+    :return: iterator with the batch sampler as ``batch_sampler`` attribute
     """
-
-    batch_size_fn = token_batch_size_fn if batch_type == "token" else None
-
-    if train:
-        # optionally shuffle and sort during training
-        data_iter = data.BucketIterator(
-            repeat=False,
-            sort=False,
-            dataset=dataset,
-            batch_size=batch_size,
-            batch_size_fn=batch_size_fn,
-            train=True,
-            sort_within_batch=True,
-            sort_key=lambda x: len(x.sgn),
-            shuffle=shuffle,
-        )
-    else:
-        # don't sort/shuffle for validation/inference
-        data_iter = data.BucketIterator(
-            repeat=False,
-            dataset=dataset,
-            batch_size=batch_size,
-            batch_size_fn=batch_size_fn,
-            train=False,
-            sort=False,
-        )
-
-    return data_iter
+    batch_sampler = BucketBatchSampler(
+        dataset,
+        batch_size=batch_size,
+        batch_type=batch_type,
+        train=train,
+        # don't shuffle for validation/inference
+        shuffle=shuffle and train,
+        sort_by_length=sort_by_length,
+        num_shards=num_shards,
+        shard_index=shard_index,
+    )
+    if data_loader == "torchtext":
+        return SamplerIterator(dataset, batch_sampler)
+    if data_loader != "dataloader":
+        raise ValueError("Unknown data loader: {}".format(data_loader))
+
+    # worker seeds are drawn from a separate generator, so that using the
+    # DataLoader leaves the global torch random state (e.g. dropout) untouched
+    generator = torch.Generator()
+    generator.manual_seed(torch.initial_seed())
+    return torch.utils.data.DataLoader(
+        SignDataset(dataset),
+        batch_sampler=batch_sampler,
+        collate_fn=SignCollator(
+            feature_size=dataset.fields["sgn"].feature_size,
+            gls_pad_index=dataset.fields["gls"].vocab.stoi[PAD_TOKEN],
+            txt_pad_index=dataset.fields["txt"].vocab.stoi[PAD_TOKEN],
+        ),
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        persistent_workers=num_workers > 0,
+        generator=generator,
+    )
@@ -8,20 +8,86 @@ from typing import List, Tuple
 import pickle
 import gzip
 import torch
+from signjoey.feature_store import FeatureStore, is_feature_store, FEATURE_EPSILON
 
 
 def load_dataset_file(filename):
+    if is_feature_store(filename):
+        return FeatureStore(filename)
     with gzip.open(filename, "rb") as f:
         loaded_object = pickle.load(f)
         return loaded_object
 
 
+def pad_features(
+    features: List[torch.Tensor], feature_size: int, dtype=torch.float32
+) -> (torch.Tensor, torch.Tensor):
+    """
+    Pad a list of feature tensors into one zero-initialised tensor.
+
+    An example is either a [T, D] tensor or a tuple of [T, D_k] tensors, one
+    per feature stream. Streams are written next to each other, so they are
+    only concatenated in the padded batch.
+
+    :param features: feature tensors of the sequences in a batch
+    :param feature_size: size D of a single frame, summed over all streams
+    :param dtype: dtype of the padded features and of the lengths
+    :return:
+        - padded features of shape [B, max(T), D]
+        - sequence lengths of shape [B]
+    """
+    features = [x if isinstance(x, (tuple, list)) else (x,) for x in features]
+    lengths = torch.tensor([len(x[0]) for x in features], dtype=dtype)
+    padded = torch.zeros(
+        (len(features), int(lengths.max()), feature_size), dtype=dtype
+    )
+    for i, streams in enumerate(features):
+        offset = 0
+        for x in streams:
+            padded[i, : len(x), offset : offset + x.shape[1]] = x
+            offset += x.shape[1]
+        if offset != feature_size:
+            raise ValueError(
+                "Expected {} features per frame, got {}".format(feature_size, offset)
+            )
+    return padded, lengths
+
+
+class FeatureField(RawField):
+    """
+    Field for sign features. Examples keep their features as one contiguous
+    [T, D] tensor, or a tuple of them for multiple feature streams, which is
+    only padded when a batch is created.
+    """
+
+    def __init__(self, feature_size: int, dtype=torch.float32):
+        """
+        :param feature_size: size of a single frame
+        :param dtype: dtype of the padded features and of the lengths
+        """
+        super().__init__()
+        self.feature_size = feature_size
+        self.dtype = dtype
+        self.include_lengths = True
+
+    def process(self, batch, device=None, **kwargs):
+        """
+        Pad the features of a batch.
+
+        :param batch: list of [T, D] feature tensors
+        :param device: device the padded tensors are moved to
+        :return: padded features and sequence lengths
+        """
+        padded, lengths = pad_features(batch, self.feature_size, self.dtype)
+        return padded.to(device), lengths.to(device)
+
+
 class SignTranslationDataset(data.Dataset):
     """Defines a dataset for machine translation."""
 
     @staticmethod
     def sort_key(ex):
-        return data.interleave_keys(len(ex.sgn), len(ex.txt))
+        return data.interleave_keys(ex.sgn_length, len(ex.txt))
 
     def __init__(
         self,
@@ -51,42 +117,43 @@ class SignTranslationDataset(data.Dataset):
         if not isinstance(path, list):
             path = [path]
 
+        # Features of the same sequence in multiple files are kept as separate
+        # streams and only concatenated when a batch is padded.
         samples = {}
         for annotation_file in path:
             tmp = load_dataset_file(annotation_file)
+            from_store = isinstance(tmp, FeatureStore)
             for s in tmp:
+                # This is for numerical stability. Stores written by the converter
+                # already contain it, freshly unpickled tensors can be modified
+                # in place.
+                if not from_store:
+                    s["sign"].add_(FEATURE_EPSILON)
+                elif tmp.epsilon != FEATURE_EPSILON:
+                    s["sign"] = s["sign"] + (FEATURE_EPSILON - tmp.epsilon)
                 seq_id = s["name"]
+                meta = (s["name"], s["signer"], s["gloss"], s["text"])
                 if seq_id in samples:
-                    assert samples[seq_id]["name"] == s["name"]
-                    assert samples[seq_id]["signer"] == s["signer"]
-                    assert samples[seq_id]["gloss"] == s["gloss"]
-                    assert samples[seq_id]["text"] == s["text"]
-                    samples[seq_id]["sign"] = torch.cat(
-                        [samples[seq_id]["sign"], s["sign"]], axis=1
-                    )
+                    assert samples[seq_id]["meta"] == meta, seq_id
+                    assert len(samples[seq_id]["sign"][0]) == len(s["sign"]), seq_id
+                    samples[seq_id]["sign"].append(s["sign"])
                 else:
-                    samples[seq_id] = {
-                        "name": s["name"],
-                        "signer": s["signer"],
-                        "gloss": s["gloss"],
-                        "text": s["text"],
-                        "sign": s["sign"],
-                    }
+                    samples[seq_id] = {"meta": meta, "sign": [s["sign"]]}
 
         examples = []
         for s in samples:
-            sample = samples[s]
-            examples.append(
-                data.Example.fromlist(
-                    [
-                        sample["name"],
-                        sample["signer"],
-                        # This is for numerical stability
-                        sample["sign"] + 1e-8,
-                        sample["gloss"].strip(),
-                        sample["text"].strip(),
-                    ],
-                    fields,
-                )
+            name, signer, gloss, text = samples[s]["meta"]
+            sign = samples[s]["sign"]
+            example = data.Example.fromlist(
+                [
+                    name,
+                    signer,
+                    sign[0] if len(sign) == 1 else tuple(sign),
+                    gloss.strip(),
+                    text.strip(),
+                ],
+                fields,
             )
+            example.sgn_length = len(sign[0])
+            examples.append(example)
         super().__init__(examples, fields, **kwargs)
@@ -3,7 +3,7 @@
 """
 Various decoders
 """
-from typing import Optional
+from typing import List, Optional
 
 import torch
 import torch.nn as nn
@@ -300,6 +300,7 @@ class RecurrentDecoder(Decoder):
         unroll_steps: int,
         hidden: Tensor = None,
         prev_att_vector: Tensor = None,
+        project_outputs: bool = True,
         **kwargs
     ) -> (Tensor, Tensor, Tensor, Tensor):
         """
@@ -341,6 +342,8 @@ class RecurrentDecoder(Decoder):
         :param prev_att_vector: previous attentional vector,
             if not given it's initialized with zeros,
             shape (batch_size, 1, hidden_size)
+        :param project_outputs: if False, the outputs are the attentional
+            vectors, which the output layer has not been applied to yet
         :return:
             - outputs: shape (batch_size, unroll_steps, vocab_size),
             - hidden: last hidden state (num_layers, batch_size, hidden_size),
@@ -399,7 +402,7 @@ class RecurrentDecoder(Decoder):
         # att_vectors: batch, unroll_steps, hidden_size
         att_probs = torch.cat(att_probs, dim=1)
         # att_probs: batch, unroll_steps, src_length
-        outputs = self.output_layer(att_vectors)
+        outputs = self.output_layer(att_vectors) if project_outputs else att_vectors
         # outputs: batch, unroll_steps, vocab_size
         return outputs, hidden, att_probs, att_vectors
 
@@ -525,6 +528,8 @@ class TransformerDecoder(Decoder):
         unroll_steps: int = None,
         hidden: Tensor = None,
         trg_mask: Tensor = None,
+        cache: List[dict] = None,
+        project_outputs: bool = True,
         **kwargs
     ):
         """
@@ -538,24 +543,103 @@ class TransformerDecoder(Decoder):
         :param hidden: unused
         :param trg_mask: to mask out target paddings
                          Note that a subsequent mask is applied here.
+        :param cache: optional cache from `init_cache` for incremental
+            decoding. trg_embed then only holds the targets after the ones
+            seen in previous calls, and the cache is updated in place.
+        :param project_outputs: if False, the output is the final decoder
+            states, which the output layer has not been applied to yet
         :param kwargs:
         :return:
         """
         assert trg_mask is not None, "trg_mask required for Transformer"
 
-        x = self.pe(trg_embed)  # add position encoding to word embedding
+        offset = self.cache_length(cache)
+        if cache is not None and not cache[0]["memory"]:
+            self.prepare_memory(cache, encoder_output)
+        # add position encoding to word embedding
+        x = self.pe(trg_embed, offset=offset)
         x = self.emb_dropout(x)
 
-        trg_mask = trg_mask & subsequent_mask(trg_embed.size(1)).type_as(trg_mask)
+        trg_mask = trg_mask & subsequent_mask(trg_embed.size(1), offset).type_as(
+            trg_mask
+        )
 
-        for layer in self.layers:
-            x = layer(x=x, memory=encoder_output, src_mask=src_mask, trg_mask=trg_mask)
+        for i, layer in enumerate(self.layers):
+            x = layer(
+                x=x,
+                memory=encoder_output,
+                src_mask=src_mask,
+                trg_mask=trg_mask,
+                cache=cache[i] if cache is not None else None,
+            )
 
         x = self.layer_norm(x)
-        output = self.output_layer(x)
+        output = self.output_layer(x) if project_outputs else x
 
         return output, x, None, None
 
+    def init_cache(self, encoder_output: Tensor = None) -> List[dict]:
+        """
+        Create an empty cache for incremental decoding. It holds the
+        self-attention keys and values of all previous targets and the
+        projected source representations of every layer.
+
+        :param encoder_output: source representations to project right away,
+            see `prepare_memory`
+        :return: cache to pass to `forward`
+        """
+        cache = [{"self": {}, "memory": {}} for _ in self.layers]
+        if encoder_output is not None:
+            self.prepare_memory(cache, encoder_output)
+        return cache
+
+    def prepare_memory(self, cache: List[dict], encoder_output: Tensor):
+        """
+        Project the source representations for the source attention of every
+        layer once and store them in the cache. They may have fewer batch
+        entries than the targets, then the targets of a source are expected
+        to be consecutive, e.g. the beams of a sentence in beam search.
+
+        :param cache: cache from `init_cache`
+        :param encoder_output: source representations
+        """
+        for layer, layer_cache in zip(self.layers, cache):
+            layer_cache["memory"] = layer.src_trg_att.project_kv(
+                encoder_output, encoder_output
+            )
+
+    @staticmethod
+    def cache_length(cache: List[dict]) -> int:
+        """
+        :param cache: cache from `init_cache` or None
+        :return: number of targets decoded with the cache
+        """
+        if cache is None or "keys" not in cache[0]["self"]:
+            return 0
+        return cache[0]["self"]["keys"].size(2)
+
+    @staticmethod
+    def reorder_cache(cache: List[dict], index: Tensor, memory_index: Tensor = None):
+        """
+        Select batch entries of a cache in place, e.g. to follow the beams
+        kept in beam search.
+
+        :param cache: cache from `init_cache`
+        :param index: indices of the target entries to keep
+        :param memory_index: indices of the source entries to keep, the
+            source representations are left as they are if not given
+        """
+        for layer_cache in cache:
+            for part, attention_cache in layer_cache.items():
+                if part == "memory":
+                    if memory_index is None:
+                        continue
+                    part_index = memory_index
+                else:
+                    part_index = index
+                for name, value in attention_cache.items():
+                    attention_cache[name] = value.index_select(0, part_index)
+
     def __repr__(self):
         return "%s(num_layers=%r, num_heads=%r)" % (
             self.__class__.__name__,
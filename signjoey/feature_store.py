@@ -0,0 +1,565 @@
+# coding: utf-8
+"""
+Memory-mapped, sharded on-disk format for sign features.
+
+A feature store is a directory containing
+    - ``shard_XXXXX.f32``: contiguous float32 frame arrays ([frames, feature_size])
+    - ``index.npy``: int64 array of (shard, frame offset, length) per sequence
+    - ``meta.json``: format information and name/signer/gloss/text per sequence
+
+Sequences are read through ``numpy.memmap``, so every sign tensor is a
+zero-copy view and only the sequences that are actually touched are paged in.
+
+Stores can also be assembled from a record directory, which holds one ``.npy``
+file per sequence plus a ``manifest.jsonl`` with a content hash per record.
+Records are written in parallel and an interrupted export resumes by skipping
+the records listed in the manifest. A finished export additionally writes
+``index.json`` with the sequence order.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import torch
+
+STORE_FORMAT = "signjoey-feature-store"
+STORE_VERSION = 1
+META_FILE = "meta.json"
+INDEX_FILE = "index.npy"
+RECORD_MANIFEST = "manifest.jsonl"
+RECORD_INDEX = "index.json"
+
+# default upper bound for the size of a single shard file (1 GiB)
+DEFAULT_SHARD_SIZE = 1 << 30
+
+# small constant added to every frame for numerical stability (see dataset.py)
+FEATURE_EPSILON = 1e-8
+
+
+def is_feature_store(path: str) -> bool:
+    """
+    Check whether the given path points to a feature store directory.
+
+    :param path: path to a dataset file or directory
+    :return: True if path is a feature store
+    """
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, META_FILE))
+
+
+class FeatureStoreWriter:
+    """
+    Writes sequences into a new feature store.
+
+    The metadata file is only written on ``close``, so an interrupted
+    conversion never leaves behind a directory that looks like a valid store.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        feature_size: Optional[int] = None,
+        shard_size: int = DEFAULT_SHARD_SIZE,
+        epsilon: float = 0.0,
+    ):
+        """
+        :param path: directory the store is written to
+        :param feature_size: size of each frame, inferred from the first sequence
+            if not given
+        :param shard_size: maximum size of a shard file in bytes
+        :param epsilon: constant added to the stored features
+        """
+        if is_feature_store(path):
+            raise FileExistsError("Feature store {} already exists.".format(path))
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.feature_size = feature_size
+        self.shard_size = shard_size
+        self.epsilon = epsilon
+
+        self._shards = []  # type: List[dict]
+        self._sequences = []  # type: List[dict]
+        self._index = []  # type: List[tuple]
+        self._shard_file = None
+        self._shard_frames = 0
+
+    def _open_shard(self):
+        if self._shard_file is not None:
+            self._shard_file.close()
+        shard_name = "shard_{:05d}.f32".format(len(self._shards))
+        self._shards.append({"file": shard_name, "num_frames": 0})
+        self._shard_file = open(os.path.join(self.path, shard_name), "wb")
+        self._shard_frames = 0
+
+    def add(
+        self,
+        name: str,
+        signer: str,
+        gloss: str,
+        text: str,
+        sign,
+        sha256: Optional[str] = None,
+    ) -> None:
+        """
+        Append a single sequence to the store.
+
+        :param name: sequence id
+        :param signer: signer id
+        :param gloss: gloss annotation
+        :param text: spoken language translation
+        :param sign: sign features [frames, feature_size] (tensor or array)
+        :param sha256: content hash of the original record, kept in the metadata
+        """
+        sign = _as_float32(sign)
+        if sign.ndim != 2:
+            raise ValueError(
+                "Sign features of {} must be 2-dimensional, got shape {}".format(
+                    name, sign.shape
+                )
+            )
+        if self.feature_size is None:
+            self.feature_size = sign.shape[1]
+        elif sign.shape[1] != self.feature_size:
+            raise ValueError(
+                "Feature size mismatch for {}: expected {}, got {}".format(
+                    name, self.feature_size, sign.shape[1]
+                )
+            )
+        if self.epsilon:
+            sign = sign + np.float32(self.epsilon)
+
+        if self._shard_file is None or (
+            self._shard_frames > 0
+            and (self._shard_frames + len(sign)) * self.feature_size * 4
+            > self.shard_size
+        ):
+            self._open_shard()
+
+        sign.tofile(self._shard_file)
+        self._index.append((len(self._shards) - 1, self._shard_frames, len(sign)))
+        self._shard_frames += len(sign)
+        self._shards[-1]["num_frames"] = self._shard_frames
+        sequence = {"name": name, "signer": signer, "gloss": gloss, "text": text}
+        if sha256 is not None:
+            sequence["sha256"] = sha256
+        self._sequences.append(sequence)
+
+    def close(self) -> None:
+        """
+        Flush the last shard and write index and metadata.
+        """
+        if self._shard_file is not None:
+            self._shard_file.close()
+            self._shard_file = None
+        index = np.asarray(self._index, dtype=np.int64).reshape(-1, 3)
+        np.save(os.path.join(self.path, INDEX_FILE), index)
+        meta = {
+            "format": STORE_FORMAT,
+            "version": STORE_VERSION,
+            "feature_size": self.feature_size,
+            "dtype": "float32",
+            "epsilon": self.epsilon,
+            "shards": self._shards,
+            "sequences": self._sequences,
+        }
+        tmp_meta = os.path.join(self.path, META_FILE + ".tmp")
+        with open(tmp_meta, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_meta, os.path.join(self.path, META_FILE))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        elif self._shard_file is not None:
+            self._shard_file.close()
+
+
+class FeatureStore:
+    """
+    Read-only view on a feature store. Behaves like the list of sample dicts
+    stored in the gzip-pickled dataset files, but sign features are
+    memory-mapped instead of being loaded into RAM.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: feature store directory
+        """
+        with open(os.path.join(path, META_FILE), "r") as f:
+            meta = json.load(f)
+        if meta.get("format") != STORE_FORMAT:
+            raise ValueError("{} is not a feature store.".format(path))
+        if meta.get("version", 0) > STORE_VERSION:
+            raise ValueError(
+                "Unsupported feature store version {} in {}".format(
+                    meta["version"], path
+                )
+            )
+        self.path = path
+        self.feature_size = meta["feature_size"]
+        self.epsilon = meta.get("epsilon", 0.0)
+        self._sequences = meta["sequences"]
+        self._index = np.load(os.path.join(path, INDEX_FILE))
+        # copy-on-write mapping: views are writable without touching the files
+        self._shards = [
+            np.memmap(
+                os.path.join(path, shard["file"]),
+                dtype=np.float32,
+                mode="c",
+                shape=(shard["num_frames"], self.feature_size),
+            )
+            if shard["num_frames"] > 0
+            else np.zeros((0, self.feature_size), dtype=np.float32)
+            for shard in meta["shards"]
+        ]
+
+    def __len__(self) -> int:
+        return len(self._sequences)
+
+    def lengths(self) -> np.ndarray:
+        """
+        :return: number of frames of every sequence
+        """
+        return self._index[:, 2].copy()
+
+    def sign(self, i: int) -> torch.Tensor:
+        """
+        :param i: sequence position in the store
+        :return: zero-copy tensor view on the frames of sequence i
+        """
+        shard, offset, length = self._index[i]
+        return torch.from_numpy(self._shards[shard][offset : offset + length])
+
+    def __getitem__(self, i: int) -> dict:
+        sample = dict(self._sequences[i])
+        sample.pop("sha256", None)
+        sample["sign"] = self.sign(i)
+        return sample
+
+    def __iter__(self) -> Iterable[dict]:
+        for i in range(len(self)):
+            yield self[i]
+
+
+def _as_float32(sign) -> np.ndarray:
+    if torch.is_tensor(sign):
+        sign = sign.detach().cpu().numpy()
+    return np.ascontiguousarray(sign, dtype=np.float32)
+
+
+def sequence_hash(name: str, signer: str, gloss: str, text: str, sign) -> str:
+    """
+    Content hash of a single sequence (annotations, shape and float32 frames).
+
+    :return: hex encoded sha256 digest
+    """
+    sign = _as_float32(sign)
+    digest = hashlib.sha256()
+    digest.update(json.dumps([name, signer, gloss, text]).encode("utf-8"))
+    digest.update(np.asarray(sign.shape, dtype=np.int64).tobytes())
+    digest.update(sign.tobytes())
+    return digest.hexdigest()
+
+
+def _record_file(name: str) -> str:
+    # sequence names may contain path separators, so use a digest as file name
+    return hashlib.sha1(name.encode("utf-8")).hexdigest() + ".npy"
+
+
+def _write_record(record_dir: str, sample: dict) -> dict:
+    sign = _as_float32(sample["sign"])
+    entry = {
+        "name": sample["name"],
+        "signer": sample["signer"],
+        "gloss": sample["gloss"],
+        "text": sample["text"],
+        "file": _record_file(sample["name"]),
+        "length": len(sign),
+        "sha256": sequence_hash(
+            sample["name"], sample["signer"], sample["gloss"], sample["text"], sign
+        ),
+    }
+    path = os.path.join(record_dir, entry["file"])
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, sign)
+    os.replace(path + ".tmp", path)
+    return entry
+
+
+def _load_record(record_dir: str, entry: dict) -> np.ndarray:
+    return np.load(os.path.join(record_dir, entry["file"]), mmap_mode="c")
+
+
+def read_manifest(record_dir: str) -> Dict[str, dict]:
+    """
+    Read the manifest of a record directory. A partially written last line
+    (e.g. after a crash) is ignored.
+
+    :param record_dir: record directory
+    :return: manifest entries by sequence name
+    """
+    entries = {}
+    manifest = os.path.join(record_dir, RECORD_MANIFEST)
+    if not os.path.isfile(manifest):
+        return entries
+    with open(manifest, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            entries[entry["name"]] = entry
+    return entries
+
+
+# state shared with the export workers, set by the pool initializer
+_EXPORT_STATE = {}
+
+
+def _init_export_worker(record_dir: str, samples: List[dict]):
+    # keep export workers from oversubscribing the cores with intra-op threads
+    torch.set_num_threads(1)
+    _EXPORT_STATE["record_dir"] = record_dir
+    _EXPORT_STATE["samples"] = samples
+
+
+def _export_worker(i: int) -> dict:
+    return _write_record(_EXPORT_STATE["record_dir"], _EXPORT_STATE["samples"][i])
+
+
+def export_records(
+    samples: List[dict], record_dir: str, num_workers: int = 1, verify: bool = False
+) -> List[dict]:
+    """
+    Write every sample as its own record into record_dir. Records that are
+    already listed in the manifest are skipped, so an interrupted export can
+    simply be restarted.
+
+    :param samples: sample dicts (name, signer, gloss, text, sign)
+    :param record_dir: directory for the records and the manifest
+    :param num_workers: number of worker processes writing records
+    :param verify: recompute the hash of already written records before
+        skipping them
+    :return: manifest entries in the order of samples
+    """
+    os.makedirs(record_dir, exist_ok=True)
+    done = read_manifest(record_dir)
+    todo = []
+    for i, s in enumerate(samples):
+        entry = done.get(s["name"])
+        if entry is not None and os.path.isfile(
+            os.path.join(record_dir, entry["file"])
+        ):
+            if not verify or entry["sha256"] == sequence_hash(
+                entry["name"],
+                entry["signer"],
+                entry["gloss"],
+                entry["text"],
+                _load_record(record_dir, entry),
+            ):
+                continue
+        todo.append(i)
+
+    manifest_path = os.path.join(record_dir, RECORD_MANIFEST)
+    with open(manifest_path, "a+b") as manifest:
+        # terminate a line that was cut off by a crash before appending to it
+        if manifest.tell() > 0:
+            manifest.seek(-1, os.SEEK_END)
+            if manifest.read(1) != b"\n":
+                manifest.write(b"\n")
+
+        def _log(entry):
+            done[entry["name"]] = entry
+            manifest.write((json.dumps(entry) + "\n").encode("utf-8"))
+            manifest.flush()
+
+        if num_workers > 1 and len(todo) > 1:
+            # forked workers inherit the samples instead of receiving copies
+            context = multiprocessing.get_context(
+                "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+            )
+            with context.Pool(
+                num_workers,
+                initializer=_init_export_worker,
+                initargs=(record_dir, samples),
+            ) as pool:
+                for entry in pool.imap_unordered(_export_worker, todo, chunksize=4):
+                    _log(entry)
+        else:
+            for i in todo:
+                _log(_write_record(record_dir, samples[i]))
+
+    names = [s["name"] for s in samples]
+    with open(os.path.join(record_dir, RECORD_INDEX + ".tmp"), "w") as f:
+        json.dump(names, f)
+    os.replace(
+        os.path.join(record_dir, RECORD_INDEX + ".tmp"),
+        os.path.join(record_dir, RECORD_INDEX),
+    )
+    return [done[name] for name in names]
+
+
+def is_exported(record_dir: str) -> bool:
+    """
+    :param record_dir: record directory
+    :return: True if an export into record_dir ran to completion
+    """
+    return os.path.isfile(os.path.join(record_dir, RECORD_INDEX))
+
+
+def _record_names(record_dir: str, entries: Dict[str, dict]) -> List[str]:
+    if is_exported(record_dir):
+        with open(os.path.join(record_dir, RECORD_INDEX), "r") as f:
+            return json.load(f)
+    return list(entries.keys())
+
+
+def load_records(record_dir: str, names: Optional[List[str]] = None) -> List[dict]:
+    """
+    Load records as sample dicts with memory-mapped sign tensors.
+
+    :param record_dir: record directory
+    :param names: sequences to load (default: all records in export order)
+    :return: list of sample dicts
+    """
+    entries = read_manifest(record_dir)
+    if names is None:
+        names = _record_names(record_dir, entries)
+    samples = []
+    for name in names:
+        entry = entries[name]
+        samples.append(
+            {
+                "name": entry["name"],
+                "signer": entry["signer"],
+                "gloss": entry["gloss"],
+                "text": entry["text"],
+                "sign": torch.from_numpy(_load_record(record_dir, entry)),
+            }
+        )
+    return samples
+
+
+def build_store_from_records(
+    record_dir: str,
+    store_path: str,
+    names: Optional[List[str]] = None,
+    shard_size: int = DEFAULT_SHARD_SIZE,
+    epsilon: float = FEATURE_EPSILON,
+) -> int:
+    """
+    Assemble a feature store from a record directory, verifying the content
+    hash of every record on the way.
+
+    :param record_dir: record directory
+    :param store_path: directory of the new store
+    :param names: sequences to include, in order (default: all records)
+    :param shard_size: maximum size of a shard file in bytes
+    :param epsilon: constant baked into the stored features
+    :return: number of sequences in the store
+    """
+    entries = read_manifest(record_dir)
+    if names is None:
+        names = _record_names(record_dir, entries)
+    with FeatureStoreWriter(store_path, shard_size=shard_size, epsilon=epsilon) as w:
+        for name in names:
+            e = entries[name]
+            sign = _load_record(record_dir, e)
+            if sequence_hash(e["name"], e["signer"], e["gloss"], e["text"], sign) != (
+                e["sha256"]
+            ):
+                raise ValueError(
+                    "Record {} in {} does not match its hash.".format(name, record_dir)
+                )
+            w.add(e["name"], e["signer"], e["gloss"], e["text"], sign, e["sha256"])
+    return len(names)
+
+
+def convert_pickle_to_store(
+    pickle_path: str,
+    store_path: str,
+    shard_size: int = DEFAULT_SHARD_SIZE,
+    epsilon: float = FEATURE_EPSILON,
+    num_workers: int = 1,
+    record_dir: Optional[str] = None,
+) -> int:
+    """
+    Convert a gzip-pickled dataset file into a feature store. With a record
+    directory, sequences are first exported as records by num_workers
+    processes, which makes the conversion resumable.
+
+    :param pickle_path: gzip-pickled list of sample dicts
+    :param store_path: directory of the new store
+    :param shard_size: maximum size of a shard file in bytes
+    :param epsilon: constant baked into the stored features
+    :param num_workers: number of processes exporting records
+    :param record_dir: directory for intermediate records, kept afterwards
+    :return: number of converted sequences
+    """
+    with gzip.open(pickle_path, "rb") as f:
+        samples = pickle.load(f)
+    if record_dir is None and num_workers <= 1:
+        with FeatureStoreWriter(
+            store_path, shard_size=shard_size, epsilon=epsilon
+        ) as w:
+            for s in samples:
+                w.add(s["name"], s["signer"], s["gloss"], s["text"], s["sign"])
+        return len(samples)
+
+    keep_records = record_dir is not None
+    if record_dir is None:
+        record_dir = store_path.rstrip("/\\") + ".records"
+    export_records(samples, record_dir, num_workers=num_workers)
+    num_sequences = build_store_from_records(
+        record_dir,
+        store_path,
+        names=[s["name"] for s in samples],
+        shard_size=shard_size,
+        epsilon=epsilon,
+    )
+    if not keep_records:
+        shutil.rmtree(record_dir)
+    return num_sequences
+
+
+def main():
+    ap = argparse.ArgumentParser("Convert gzip-pickled datasets to feature stores")
+    ap.add_argument("input", type=str, help="gzip-pickled dataset file")
+    ap.add_argument("output", type=str, help="feature store directory to create")
+    ap.add_argument(
+        "--shard_size",
+        type=int,
+        default=DEFAULT_SHARD_SIZE >> 20,
+        help="maximum shard size in MiB",
+    )
+    ap.add_argument(
+        "--num_workers", type=int, default=1, help="processes exporting records"
+    )
+    ap.add_argument(
+        "--record_dir",
+        type=str,
+        default=None,
+        help="keep intermediate per-sequence records here (resumable)",
+    )
+    args = ap.parse_args()
+    num_sequences = convert_pickle_to_store(
+        args.input,
+        args.output,
+        shard_size=args.shard_size << 20,
+        num_workers=args.num_workers,
+        record_dir=args.record_dir,
+    )
+    print("Wrote {} sequences to {}".format(num_sequences, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,8 @@ import errno
 import shutil
 import random
 import logging
+import queue
+import threading
 from sys import platform
 from logging import Logger
 from typing import Callable, Optional
@@ -92,15 +94,16 @@ def clones(module: nn.Module, n: int) -> nn.ModuleList:
     return nn.ModuleList([copy.deepcopy(module) for _ in range(n)])
 
 
-def subsequent_mask(size: int) -> Tensor:
+def subsequent_mask(size: int, offset: int = 0) -> Tensor:
     """
     Mask out subsequent positions (to prevent attending to future positions)
     Transformer helper function.
 
-    :param size: size of mask (2nd and 3rd dim)
-    :return: Tensor with 0s and 1s of shape (1, size, size)
+    :param size: size of mask (2nd dim)
+    :param offset: number of previous positions that are always visible
+    :return: Tensor with 0s and 1s of shape (1, size, offset + size)
     """
-    mask = np.triu(np.ones((1, size, size)), k=1).astype("uint8")
+    mask = np.triu(np.ones((1, size, offset + size)), k=offset + 1).astype("uint8")
     return torch.from_numpy(mask) == 0
 
 
@@ -266,3 +269,52 @@ def symlink_update(target, link_name):
             os.symlink(target, link_name)
         else:
             raise e
+
+
+class BackgroundWorker:
+    """
+    Runs functions one after another on a background thread, e.g. to score
+    outputs while the next batch is decoded. Use as a context manager, which
+    waits for all submitted functions and re-raises their first exception.
+    """
+
+    def __init__(self, max_pending: int = 1):
+        """
+        :param max_pending: number of submitted functions that may wait for
+            the thread before submit blocks
+        """
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            # after an error, the queue is only drained
+            if self._error is None:
+                fn, args, kwargs = item
+                try:
+                    fn(*args, **kwargs)
+                except BaseException as e:  # pylint: disable=broad-except
+                    self._error = e
+
+    def submit(self, fn: Callable, *args, **kwargs):
+        """
+        Queues fn(*args, **kwargs).
+
+        :param fn: function to run
+        """
+        self._queue.put((fn, args, kwargs))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # wait for all submitted functions and stop the thread
+        self._queue.put(None)
+        self._thread.join()
+        if exc_type is None and self._error is not None:
+            raise self._error
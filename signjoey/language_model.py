@@ -0,0 +1,211 @@
+# coding: utf-8
+"""
+N-gram gloss language model for CTC decoding
+"""
+from collections import Counter, defaultdict
+from typing import List
+
+import numpy as np
+import torch
+from torch import Tensor
+from torchtext.data import Dataset
+
+from signjoey.vocabulary import GlossVocabulary
+
+
+class NGramLanguageModel:
+    """
+    Interpolated Witten-Bell n-gram model over gloss vocabulary indices.
+
+    A decoder state is the longest suffix of the sentence start symbol and
+    the decoded glosses that was seen as a context in training. Unseen
+    contexts back off to it without changing any probability. For every state,
+    the log-probabilities of all glosses and of the sentence end are computed
+    once and cached as a row of a tensor, so that scoring a batch of beams is
+    a single lookup. At most cache_size rows are kept.
+    """
+
+    def __init__(
+        self,
+        sentences: List[List[int]],
+        vocab_size: int,
+        order: int = 3,
+        cache_size: int = 20000,
+    ):
+        """
+        :param sentences: training gloss sequences as vocabulary indices
+        :param vocab_size: number of glosses in the vocabulary
+        :param order: n-gram order
+        :param cache_size: maximum number of cached score rows
+        """
+        assert order > 0
+        self.order = order
+        self.vocab_size = vocab_size
+        # index of the sentence end in the score rows, and of the sentence
+        # start in contexts
+        self.boundary_index = vocab_size
+
+        self._counts = defaultdict(Counter)
+        for sentence in sentences:
+            tokens = [self.boundary_index] + list(sentence) + [self.boundary_index]
+            for i in range(1, len(tokens)):
+                for n in range(min(order - 1, i) + 1):
+                    self._counts[tuple(tokens[i - n : i])][tokens[i]] += 1
+
+        self._contexts = sorted(self._counts, key=len)
+        self._state_ids = {context: i for i, context in enumerate(self._contexts)}
+        self.start_state = self._state_ids[
+            (self.boundary_index,) if order > 1 else ()
+        ]
+
+        # every context but the empty one is its parent context extended by
+        # one label, stored as sorted keys parent * (vocab_size + 1) + label
+        children = [c for c in self._contexts if c]
+        keys = torch.tensor(
+            [self._edge_key(self._state_ids[c[:-1]], c[-1]) for c in children],
+            dtype=torch.long,
+        )
+        self._edge_keys, order_index = keys.sort()
+        self._edge_children = torch.tensor(
+            [self._state_ids[c] for c in children], dtype=torch.long
+        )[order_index]
+        self._context_lengths = torch.tensor([len(c) for c in self._contexts])
+        self._backoff = torch.tensor(
+            [self._state_ids[c[1:]] if c else 0 for c in self._contexts]
+        )
+
+        # cached rows, computed on first use
+        self.cache_size = cache_size
+        self._row_index = torch.full((len(self._contexts),), -1, dtype=torch.long)
+        self._log_probs = torch.empty((0, vocab_size + 1))
+        self._num_rows = 0
+
+    def _edge_key(self, parent: int, label: int) -> int:
+        return parent * (self.vocab_size + 1) + label
+
+    @classmethod
+    def from_dataset(
+        cls, dataset: Dataset, vocab: GlossVocabulary, order: int = 3
+    ) -> "NGramLanguageModel":
+        """
+        Build a language model from the gloss sequences of a dataset.
+
+        :param dataset: dataset with a gls field, e.g. the training data
+        :param vocab: gloss vocabulary
+        :param order: n-gram order
+        :return: language model over the indices of vocab
+        """
+        unk_index = vocab.DEFAULT_UNK_ID()
+        sentences = [
+            [vocab.stoi.get(token, unk_index) for token in sequence]
+            for sequence in dataset.gls
+        ]
+        return cls(sentences=sentences, vocab_size=len(vocab), order=order)
+
+    @property
+    def num_states(self) -> int:
+        return len(self._contexts)
+
+    def _add_row(self, state: int) -> int:
+        """
+        Compute and cache the rows of a state, and of its backoff states.
+
+        :param state: state id
+        :return: index of the cached rows
+        """
+        if self._row_index[state] >= 0:
+            return int(self._row_index[state])
+
+        context = self._contexts[state]
+        counts = self._counts[context]
+        labels = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        values = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+
+        if context:
+            lower = self._add_row(self._state_ids[context[1:]])
+            lower_probs = self._log_probs[lower].double().exp().numpy()
+        else:
+            lower_probs = np.full(self.vocab_size + 1, 1.0 / (self.vocab_size + 1))
+
+        # Witten-Bell: the backoff weight grows with the number of distinct
+        # continuations of the context
+        probs = lower_probs * len(labels)
+        probs[labels] += values
+        probs /= values.sum() + len(labels)
+
+        if self._num_rows == len(self._log_probs):
+            capacity = max(2 * self._num_rows, 64)
+            self._log_probs = torch.cat(
+                [self._log_probs, self._log_probs.new_empty(capacity, self.vocab_size + 1)]
+            )
+        row = self._num_rows
+        self._log_probs[row] = torch.from_numpy(np.log(probs))
+        self._row_index[state] = row
+        self._num_rows += 1
+        return row
+
+    def _rows(self, states: Tensor) -> Tensor:
+        rows = self._row_index[states]
+        missing = rows < 0
+        if missing.any():
+            missing_states = states[missing].unique()
+            if self._num_rows + len(missing_states) > self.cache_size:
+                # start over, the rows of all requested states are recomputed
+                self._row_index.fill_(-1)
+                self._num_rows = 0
+                missing_states = states.unique()
+            for state in missing_states.tolist():
+                self._add_row(state)
+            rows = self._row_index[states]
+        return rows
+
+    def score(self, states: Tensor) -> Tensor:
+        """
+        Log-probabilities of all glosses given the decoder states.
+
+        :param states: state ids of any shape
+        :return: log-probabilities of shape states.shape + (vocab_size,)
+        """
+        rows = self._rows(states.cpu())
+        return self._log_probs[rows, : self.vocab_size].to(states.device)
+
+    def advance(self, states: Tensor, labels: Tensor) -> Tensor:
+        """
+        Decoder states after appending a gloss.
+
+        The new state is the longest seen context among the suffixes of the
+        state extended by the gloss, found by backing off at most order times.
+
+        :param states: state ids of any shape
+        :param labels: gloss indices of the same shape
+        :return: state ids of the same shape
+        """
+        device = states.device
+        current, labels = states.cpu(), labels.cpu()
+        result = torch.full_like(current, -1)
+        for _ in range(self.order):
+            if len(self._edge_keys) == 0:
+                break
+            keys = self._edge_key(current, labels)
+            index = torch.searchsorted(self._edge_keys, keys).clamp(
+                max=len(self._edge_keys) - 1
+            )
+            # contexts of order - 1 glosses are never extended
+            found = (
+                (result < 0)
+                & (self._context_lengths[current] < self.order - 1)
+                & (self._edge_keys[index] == keys)
+            )
+            result = torch.where(found, self._edge_children[index], result)
+            current = self._backoff[current]
+        return torch.where(result < 0, self._state_ids[()], result).to(device)
+
+    def end_score(self, states: Tensor) -> Tensor:
+        """
+        Log-probabilities of the sentence end given the decoder states.
+
+        :param states: state ids of any shape
+        :return: log-probabilities of the same shape as states
+        """
+        rows = self._rows(states.cpu())
+        return self._log_probs[rows, self.boundary_index].to(states.device)
@@ -3,9 +3,9 @@
 Module to implement training loss
 """
 
-import torch
+import math
+
 from torch import nn, Tensor
-from torch.autograd import Variable
 
 
 class XentLoss(nn.Module):
@@ -21,32 +21,38 @@ class XentLoss(nn.Module):
             # standard xent loss
             self.criterion = nn.NLLLoss(ignore_index=self.pad_index, reduction="sum")
         else:
-            # custom label-smoothed loss, computed with KL divergence loss
-            self.criterion = nn.KLDivLoss(reduction="sum")
+            # custom label-smoothed loss, see _smoothed_loss
+            self.criterion = None
 
-    def _smooth_targets(self, targets: Tensor, vocab_size: int):
+    def _smoothed_loss(self, log_probs: Tensor, targets: Tensor) -> Tensor:
         """
-        Smooth target distribution. All non-reference words get uniform
-        probability mass according to "smoothing".
+        KL divergence between the smoothed target distributions and the
+        predictions, summed over all non-padding positions.
+
+        In the smoothed target distribution the reference word gets the
+        probability 1-smoothing, padding 0 and all other words smoothing/(V-2).
+        The divergence is computed in closed form from the log probability of
+        the reference word, of padding and the sum over the vocabulary, so the
+        batch*seq_len x vocab_size target distributions are never built.
 
+        :param log_probs: log probabilities, batch*seq_len x vocab_size
         :param targets: target indices, batch*seq_len
-        :param vocab_size: size of the output vocabulary
-        :return: smoothed target distributions, batch*seq_len x vocab_size
+        :return: summed loss
         """
-        # batch*seq_len x vocab_size
-        smooth_dist = targets.new_zeros((targets.size(0), vocab_size)).float()
-        # fill distribution uniformly with smoothing
-        smooth_dist.fill_(self.smoothing / (vocab_size - 2))
-        # assign true label the probability of 1-smoothing ("confidence")
-        smooth_dist.scatter_(1, targets.unsqueeze(1).data, 1.0 - self.smoothing)
-        # give padding probability of 0 everywhere
-        smooth_dist[:, self.pad_index] = 0
-        # masking out padding area (sum of probabilities for padding area = 0)
-        padding_positions = torch.nonzero(targets.data == self.pad_index)
-        # pylint: disable=len-as-condition
-        if len(padding_positions) > 0:
-            smooth_dist.index_fill_(0, padding_positions.squeeze(), 0.0)
-        return Variable(smooth_dist, requires_grad=False)
+        confidence = 1.0 - self.smoothing
+        uniform = self.smoothing / (log_probs.size(1) - 2)
+        # sum of target * log(target), 0 * log(0) counts as 0
+        entropy = self.smoothing * math.log(uniform)
+        if confidence > 0:
+            entropy += confidence * math.log(confidence)
+
+        target_log_probs = log_probs.gather(1, targets.unsqueeze(1)).squeeze(1)
+        other_log_probs = (
+            log_probs.sum(dim=1) - log_probs[:, self.pad_index] - target_log_probs
+        )
+        losses = entropy - confidence * target_log_probs - uniform * other_log_probs
+        # padding positions have no target distribution
+        return losses.masked_fill(targets == self.pad_index, 0.0).sum()
 
     # pylint: disable=arguments-differ
     def forward(self, log_probs, targets):
@@ -61,19 +67,11 @@ class XentLoss(nn.Module):
         :param targets: target indices
         :return:
         """
+        # log_probs: batch*seq_len x vocab_size, targets: indices with batch*seq_len
+        log_probs = log_probs.contiguous().view(-1, log_probs.size(-1))
+        targets = targets.contiguous().view(-1)
         if self.smoothing > 0:
-            targets = self._smooth_targets(
-                targets=targets.contiguous().view(-1), vocab_size=log_probs.size(-1)
-            )
-            # targets: distributions with batch*seq_len x vocab_size
-            assert (
-                log_probs.contiguous().view(-1, log_probs.size(-1)).shape
-                == targets.shape
-            )
+            loss = self._smoothed_loss(log_probs=log_probs, targets=targets)
         else:
-            # targets: indices with batch*seq_len
-            targets = targets.contiguous().view(-1)
-        loss = self.criterion(
-            log_probs.contiguous().view(-1, log_probs.size(-1)), targets
-        )
+            loss = self.criterion(log_probs, targets)
         return loss
@@ -3,6 +3,13 @@
 This module holds various MT evaluation metrics.
 """
 
+import multiprocessing
+import os
+import threading
+import weakref
+from collections import Counter
+from typing import Iterable, List
+
 from signjoey.external_metrics import sacrebleu
 from signjoey.external_metrics import mscoco_rouge
 import numpy as np
@@ -10,6 +17,11 @@ import numpy as np
 WER_COST_DEL = 3
 WER_COST_INS = 3
 WER_COST_SUB = 4
+ROUGE_BETA = 1.2
+# number of sentences from which wer_list uses several processes
+WER_PARALLEL_MIN_PAIRS = 20000
+# maximum number of sentence pairs whose counts are cached
+WER_CACHE_SIZE = 100000
 
 
 def chrf(references, hypotheses):
@@ -42,6 +54,182 @@ def bleu(references, hypotheses):
     return scores
 
 
+# reference statistics of the datasets that were evaluated on
+_reference_statistics = weakref.WeakKeyDictionary()
+
+
+class ReferenceStatistics:
+    """
+    BLEU and chrF statistics of references, as computed by sacrebleu's
+    raw_corpus_bleu and corpus_chrf, and their ROUGE tokens, kept so that
+    hypotheses can be scored against them repeatedly.
+    """
+
+    def __init__(self, references: List[str]):
+        """
+        :param references: list of references (strings)
+        """
+        self.references = list(references)
+        self.lengths = []
+        self.ngrams = []
+        self.char_ngrams = []
+        self.char_totals = []
+        # tokens are split on single spaces, as in mscoco_rouge
+        self.rouge_tokens = [reference.split(" ") for reference in self.references]
+        for reference in self.references:
+            reference = reference.rstrip()
+            self.lengths.append(len(reference.split()))
+            self.ngrams.append(sacrebleu.extract_ngrams(reference))
+        for reference in self.references:
+            reference = sacrebleu.delete_whitespace(reference)
+            self.char_ngrams.append(
+                [
+                    sacrebleu.extract_char_ngrams(reference, n + 1)
+                    for n in range(sacrebleu.CHRF_ORDER)
+                ]
+            )
+            self.char_totals.append([sum(c.values()) for c in self.char_ngrams[-1]])
+
+    @classmethod
+    def for_dataset(cls, dataset, references: List[str]) -> "ReferenceStatistics":
+        """
+        Statistics of the references of a dataset, computed when the dataset
+        is evaluated on for the first time.
+
+        :param dataset: dataset the references belong to
+        :param references: list of references (strings)
+        :return: reference statistics
+        """
+        statistics = _reference_statistics.get(dataset)
+        if statistics is None or statistics.references != references:
+            statistics = cls(references)
+            _reference_statistics[dataset] = statistics
+        return statistics
+
+
+class CorpusStatistics:
+    """
+    Accumulates the BLEU, chrF and ROUGE-L statistics of hypotheses against
+    reference statistics. Hypotheses can be added in any order, e.g. batch by
+    batch, the scores are identical to bleu, chrf and rouge on the whole
+    corpus.
+    """
+
+    def __init__(
+        self, reference_statistics: ReferenceStatistics, compute_rouge: bool = True
+    ):
+        """
+        :param reference_statistics: statistics of the references
+        :param compute_rouge: also accumulate ROUGE-L
+        """
+        self.reference_statistics = reference_statistics
+        self.compute_rouge = compute_rouge
+        # sentence scores, summed in the order of the references as in rouge
+        self.rouge_scores = {}
+        self.correct = [0] * sacrebleu.NGRAM_ORDER
+        self.total = [0] * sacrebleu.NGRAM_ORDER
+        self.sys_len = 0
+        self.ref_len = 0
+        self.chrf_statistics = [0] * (sacrebleu.CHRF_ORDER * 3)
+        self.num_hypotheses = 0
+
+    def add(self, indices: Iterable[int], hypotheses: Iterable[str]):
+        """
+        Adds hypotheses of some of the references.
+
+        :param indices: indices of the references
+        :param hypotheses: list of hypotheses (strings)
+        """
+        references = self.reference_statistics
+        indices = list(indices)
+        hypotheses = list(hypotheses)
+        if self.compute_rouge:
+            pairs = [
+                (references.rouge_tokens[i], h.split(" "))
+                for i, h in zip(indices, hypotheses)
+            ]
+            for i, (r, h), lcs in zip(indices, pairs, _lcs_lengths(pairs).tolist()):
+                self.rouge_scores[i] = _rouge_l(lcs, len(r), len(h))
+
+        for i, hypothesis in zip(indices, hypotheses):
+            self.num_hypotheses += 1
+
+            tokens = hypothesis.split()
+            self.sys_len += len(tokens)
+            self.ref_len += references.lengths[i]
+            ref_ngrams = references.ngrams[i]
+            for n in range(min(sacrebleu.NGRAM_ORDER, len(tokens))):
+                sys_ngrams = Counter(
+                    " ".join(tokens[j : j + n + 1]) for j in range(len(tokens) - n)
+                )
+                self.correct[n] += sum(
+                    min(count, ref_ngrams[ngram])
+                    for ngram, count in sys_ngrams.items()
+                    if ngram in ref_ngrams
+                )
+                self.total[n] += len(tokens) - n
+
+            hypothesis = sacrebleu.delete_whitespace(hypothesis)
+            for n, (ref_char_ngrams, ref_char_total) in enumerate(
+                zip(references.char_ngrams[i], references.char_totals[i])
+            ):
+                hyp_char_ngrams = sacrebleu.extract_char_ngrams(hypothesis, n + 1)
+                self.chrf_statistics[3 * n + 0] += max(len(hypothesis) - n, 0)
+                self.chrf_statistics[3 * n + 1] += ref_char_total
+                self.chrf_statistics[3 * n + 2] += sum(
+                    min(count, ref_char_ngrams[ngram])
+                    for ngram, count in hyp_char_ngrams.items()
+                    if ngram in ref_char_ngrams
+                )
+
+    def bleu(self) -> dict:
+        """
+        Raw corpus BLEU of the hypotheses added so far, as returned by bleu.
+
+        :return: dictionary with bleu1 to bleu4
+        """
+        bleu_scores = sacrebleu.compute_bleu(
+            list(self.correct),
+            list(self.total),
+            self.sys_len,
+            self.ref_len,
+            smooth_method="floor",
+            use_effective_order=True,
+        ).scores
+        return {"bleu" + str(n + 1): score for n, score in enumerate(bleu_scores)}
+
+    def chrf(self) -> float:
+        """
+        Character F-score of the hypotheses added so far, as returned by chrf.
+
+        :return: chrF score
+        """
+        avg_precision, avg_recall = sacrebleu._avg_precision_and_recall(
+            self.chrf_statistics, sacrebleu.CHRF_ORDER
+        )
+        return (
+            sacrebleu.CHRF(
+                sacrebleu._chrf(avg_precision, avg_recall, beta=sacrebleu.CHRF_BETA)
+            ).score
+            * 100
+        )
+
+    def rouge(self) -> float:
+        """
+        ROUGE-L of the hypotheses added so far, as returned by rouge, or -1
+        if it is not computed.
+
+        :return: ROUGE-L score
+        """
+        if not self.compute_rouge:
+            return -1
+        rouge_score = 0
+        n_seq = len(self.rouge_scores)
+        for i in sorted(self.rouge_scores):
+            rouge_score += self.rouge_scores[i] / n_seq
+        return rouge_score * 100
+
+
 def token_accuracy(references, hypotheses, level="word"):
     """
     Compute the accuracy of hypothesis tokens: correct tokens / all tokens
@@ -82,95 +270,331 @@ def sequence_accuracy(references, hypotheses):
 
 
 def rouge(references, hypotheses):
+    """
+    ROUGE-L F-score as computed by mscoco_rouge, averaged over sentences
+
+    :param hypotheses: list of hypotheses (strings)
+    :param references: list of references (strings)
+    :return:
+    """
     rouge_score = 0
     n_seq = len(hypotheses)
 
-    for h, r in zip(hypotheses, references):
-        rouge_score += mscoco_rouge.calc_score(hypotheses=[h], references=[r]) / n_seq
+    # tokens are split on single spaces, as in mscoco_rouge
+    pairs = [(r.split(" "), h.split(" ")) for h, r in zip(hypotheses, references)]
+    for (r, h), lcs in zip(pairs, _lcs_lengths(pairs).tolist()):
+        rouge_score += _rouge_l(lcs, len(r), len(h)) / n_seq
 
     return rouge_score * 100
 
 
-def wer_list(references, hypotheses):
-    total_error = total_del = total_ins = total_sub = total_ref_len = 0
+def _rouge_l(lcs: int, ref_len: int, hyp_len: int) -> float:
+    """
+    ROUGE-L F-score of a sentence pair, as computed by mscoco_rouge.
 
-    for r, h in zip(references, hypotheses):
-        res = wer_single(r=r, h=h)
-        total_error += res["num_err"]
-        total_del += res["num_del"]
-        total_ins += res["num_ins"]
-        total_sub += res["num_sub"]
-        total_ref_len += res["num_ref"]
+    :param lcs: length of the longest common subsequence
+    :param ref_len: number of reference tokens
+    :param hyp_len: number of hypothesis tokens
+    :return: score
+    """
+    beta = ROUGE_BETA
+    prec = lcs / float(hyp_len)
+    rec = lcs / float(ref_len)
+    if prec != 0 and rec != 0:
+        return ((1 + beta ** 2) * prec * rec) / float(rec + beta ** 2 * prec)
+    return 0.0
 
-    wer = (total_error / total_ref_len) * 100
-    del_rate = (total_del / total_ref_len) * 100
-    ins_rate = (total_ins / total_ref_len) * 100
-    sub_rate = (total_sub / total_ref_len) * 100
 
-    return {
-        "wer": wer,
-        "del_rate": del_rate,
-        "ins_rate": ins_rate,
-        "sub_rate": sub_rate,
-    }
+def _lcs_lengths(pairs, chunk_size: int = 256) -> np.ndarray:
+    """
+    Lengths of the longest common subsequences of sentence pairs. The table
+    is kept as a single row, which is updated one reference position at a
+    time for all hypothesis positions and sentences of a chunk at once.
+
+    :param pairs: list of (reference words, hypothesis words)
+    :param chunk_size: number of sentences processed at once, sentences of
+        similar length are grouped
+    :return: integer array with the length of each sentence pair
+    """
+    lengths = np.zeros(len(pairs), dtype=np.int64)
+    order = sorted(
+        range(len(pairs)), key=lambda k: (len(pairs[k][0]), len(pairs[k][1]))
+    )
+    for start in range(0, len(pairs), chunk_size):
+        index = order[start : start + chunk_size]
+        ref_ids, ref_lengths, hyp_ids, hyp_lengths = _encode_pairs(
+            [pairs[k] for k in index]
+        )
+        rows = np.arange(len(index))
+        row = np.zeros((len(index), hyp_ids.shape[1] + 1), dtype=np.int64)
+        # the row of the last reference position of every sentence
+        final = np.zeros_like(row)
+        for i in range(ref_ids.shape[1]):
+            match = ref_ids[:, i, None] == hyp_ids
+            # the length at (i, j) is the maximum over (i - 1, j) and
+            # (i - 1, j - 1) + match of all positions up to j
+            candidates = np.maximum(row[:, 1:], row[:, :-1] + match)
+            row[:, 1:] = np.maximum.accumulate(candidates, axis=1)
+            done = ref_lengths == i + 1
+            final[done] = row[done]
+        lengths[index] = final[rows, hyp_lengths]
+    return lengths
+
+
+def wer_list(references, hypotheses, num_workers: int = None):
+    """
+    Corpus word error rate with deletion, insertion and substitution rates.
 
+    :param references: list of references (strings)
+    :param hypotheses: list of hypotheses (strings)
+    :param num_workers: number of processes, by default sets of at least
+        WER_PARALLEL_MIN_PAIRS sentences are split across the CPUs
+    :return: dictionary with wer, del_rate, ins_rate and sub_rate in percent
+    """
+    statistics = WERStatistics()
+    statistics.add(
+        references=references, hypotheses=hypotheses, num_workers=num_workers
+    )
+    return statistics.scores()
 
-def wer_single(r, h):
-    r = r.strip().split()
-    h = h.strip().split()
-    edit_distance_matrix = edit_distance(r=r, h=h)
-    alignment, alignment_out = get_alignment(r=r, h=h, d=edit_distance_matrix)
 
-    num_cor = np.sum([s == "C" for s in alignment])
-    num_del = np.sum([s == "D" for s in alignment])
-    num_ins = np.sum([s == "I" for s in alignment])
-    num_sub = np.sum([s == "S" for s in alignment])
-    num_err = num_del + num_ins + num_sub
-    num_ref = len(r)
+class WERStatistics:
+    """
+    Accumulates word error counts, e.g. batch by batch, for the scores of
+    wer_list.
+    """
 
-    return {
-        "alignment": alignment,
-        "alignment_out": alignment_out,
+    def __init__(self):
+        self.counts = np.zeros(5, dtype=np.int64)
+
+    def add(self, references, hypotheses, num_workers: int = None):
+        """
+        Adds sentences.
+
+        :param references: list of references (strings)
+        :param hypotheses: list of hypotheses (strings)
+        :param num_workers: number of processes, see wer_counts
+        """
+        self.counts += wer_counts(
+            references=references, hypotheses=hypotheses, num_workers=num_workers
+        ).sum(axis=0)
+
+    def scores(self) -> dict:
+        """
+        :return: dictionary with wer, del_rate, ins_rate and sub_rate in percent
+        """
+        _, total_sub, total_ins, total_del, total_ref_len = self.counts.tolist()
+        total_error = total_del + total_ins + total_sub
+
+        def rate(count):
+            # without reference words, errors give inf and no errors nan
+            if total_ref_len == 0:
+                return float("inf") if count > 0 else float("nan")
+            return (count / total_ref_len) * 100
+
+        return {
+            "wer": rate(total_error),
+            "del_rate": rate(total_del),
+            "ins_rate": rate(total_ins),
+            "sub_rate": rate(total_sub),
+        }
+
+
+def wer_single(r, h, alignment: bool = False):
+    """
+    Word error counts of a single sentence.
+
+    :param r: reference (string)
+    :param h: hypothesis (string)
+    :param alignment: also return the alignment steps and strings
+    :return: dictionary with num_cor, num_del, num_ins, num_sub, num_err and
+        num_ref, and alignment and alignment_out if requested
+    """
+    num_cor, num_sub, num_ins, num_del, num_ref = wer_counts(
+        references=[r], hypotheses=[h]
+    )[0].tolist()
+    result = {
         "num_cor": num_cor,
         "num_del": num_del,
         "num_ins": num_ins,
         "num_sub": num_sub,
-        "num_err": num_err,
+        "num_err": num_del + num_ins + num_sub,
         "num_ref": num_ref,
     }
+    if alignment:
+        r = r.strip().split()
+        h = h.strip().split()
+        result["alignment"], result["alignment_out"] = get_alignment(
+            r=r, h=h, d=edit_distance(r=r, h=h)
+        )
+    return result
 
 
-def edit_distance(r, h):
+# sentence pairs whose counts were computed before, e.g. the same references
+# and hypotheses in every validation
+_wer_cache = {}
+
+
+def wer_counts(references, hypotheses, num_workers: int = None) -> np.ndarray:
     """
-    Original Code from https://github.com/zszyellow/WER-in-python/blob/master/wer.py
-    This function is to calculate the edit distance of reference sentence and the hypothesis sentence.
-    Main algorithm used is dynamic programming.
-    Attributes:
-        r -> the list of words produced by splitting reference sentence.
-        h -> the list of words produced by splitting hypothesis sentence.
+    Alignment counts of every sentence pair, with the same alignment that
+    get_alignment would choose.
+
+    :param references: list of references (strings)
+    :param hypotheses: list of hypotheses (strings)
+    :param num_workers: number of processes, by default sets of at least
+        WER_PARALLEL_MIN_PAIRS sentences are split across the CPUs. Off the
+        main thread (e.g. in a BackgroundWorker) the counts are always
+        computed in this process, as forking a multi-threaded process is unsafe
+    :return: integer array of shape (sentences, 5) with the number of correct
+        words, substitutions, insertions, deletions and reference words
     """
-    d = np.zeros((len(r) + 1) * (len(h) + 1), dtype=np.uint8).reshape(
-        (len(r) + 1, len(h) + 1)
-    )
-    for i in range(len(r) + 1):
-        for j in range(len(h) + 1):
-            if i == 0:
-                # d[0][j] = j
-                d[0][j] = j * WER_COST_INS
-            elif j == 0:
-                d[i][0] = i * WER_COST_DEL
-    for i in range(1, len(r) + 1):
-        for j in range(1, len(h) + 1):
-            if r[i - 1] == h[j - 1]:
-                d[i][j] = d[i - 1][j - 1]
-            else:
-                substitute = d[i - 1][j - 1] + WER_COST_SUB
-                insert = d[i][j - 1] + WER_COST_INS
-                delete = d[i - 1][j] + WER_COST_DEL
-                d[i][j] = min(substitute, insert, delete)
+    assert len(references) == len(hypotheses)
+    counts = np.zeros((len(references), 5), dtype=np.int64)
+    missing = []
+    for i, pair in enumerate(zip(references, hypotheses)):
+        cached = _wer_cache.get(pair)
+        if cached is None:
+            missing.append(i)
+        else:
+            counts[i] = cached
+    if not missing:
+        return counts
+
+    pairs = [
+        (references[i].strip().split(), hypotheses[i].strip().split())
+        for i in missing
+    ]
+    if num_workers is None:
+        num_workers = (
+            min(os.cpu_count() or 1, 8) if len(pairs) >= WER_PARALLEL_MIN_PAIRS else 0
+        )
+    if num_workers > 1 and threading.current_thread() is threading.main_thread():
+        chunk_size = -(-len(pairs) // num_workers)
+        chunks = [pairs[i : i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+        with multiprocessing.get_context("fork").Pool(num_workers) as pool:
+            new_counts = np.concatenate(pool.map(_alignment_counts, chunks))
+    else:
+        new_counts = _alignment_counts(pairs)
+
+    counts[missing] = new_counts
+    if len(_wer_cache) + len(missing) > WER_CACHE_SIZE:
+        _wer_cache.clear()
+    for i, c in zip(missing, new_counts):
+        _wer_cache[references[i], hypotheses[i]] = c
+    return counts
+
+
+def _encode_pairs(pairs) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+    """
+    Map the words of sentence pairs to integer ids and pad them. References
+    and hypotheses are padded with different ids that never match.
+
+    :param pairs: list of (reference words, hypothesis words)
+    :return: reference ids, reference lengths, hypothesis ids, hypothesis lengths
+    """
+    vocab = {}
+    ref_lengths = np.array([len(r) for r, _ in pairs], dtype=np.int64)
+    hyp_lengths = np.array([len(h) for _, h in pairs], dtype=np.int64)
+    ref_ids = np.full((len(pairs), ref_lengths.max(initial=0)), -1, dtype=np.int64)
+    hyp_ids = np.full((len(pairs), hyp_lengths.max(initial=0)), -2, dtype=np.int64)
+    for k, (r, h) in enumerate(pairs):
+        ref_ids[k, : len(r)] = [vocab.setdefault(w, len(vocab)) for w in r]
+        hyp_ids[k, : len(h)] = [vocab.setdefault(w, len(vocab)) for w in h]
+    return ref_ids, ref_lengths, hyp_ids, hyp_lengths
+
+
+def _edit_distance_batch(ref_ids: np.ndarray, hyp_ids: np.ndarray) -> np.ndarray:
+    """
+    Edit distance matrices of padded id sequences, filled one reference
+    position at a time for all hypothesis positions and sentences at once.
+    Insertions within a row are resolved with a running minimum.
+
+    :param ref_ids: reference ids of shape (sentences, R)
+    :param hyp_ids: hypothesis ids of shape (sentences, H)
+    :return: matrices of shape (sentences, R + 1, H + 1), entries beyond the
+        length of a sentence are meaningless
+    """
+    num_pairs, ref_len = ref_ids.shape
+    hyp_len = hyp_ids.shape[1]
+    ins = np.arange(hyp_len + 1, dtype=np.int64) * WER_COST_INS
+    sub = np.where(ref_ids[:, :, None] == hyp_ids[:, None, :], 0, WER_COST_SUB)
+
+    d = np.empty((num_pairs, ref_len + 1, hyp_len + 1), dtype=np.int64)
+    d[:, 0] = ins
+    best = np.empty((num_pairs, hyp_len + 1), dtype=np.int64)
+    for i in range(1, ref_len + 1):
+        best[:, 0] = i * WER_COST_DEL
+        np.minimum(
+            d[:, i - 1, :-1] + sub[:, i - 1],
+            d[:, i - 1, 1:] + WER_COST_DEL,
+            out=best[:, 1:],
+        )
+        d[:, i] = np.minimum.accumulate(best - ins, axis=1) + ins
     return d
 
 
+def _alignment_counts(pairs, chunk_size: int = 256) -> np.ndarray:
+    """
+    Trace back the edit distance matrices of sentence pairs in the order of
+    get_alignment (correct, substitution, insertion, deletion) and count the
+    steps, all sentences of a chunk at once.
+
+    :param pairs: list of (reference words, hypothesis words)
+    :param chunk_size: number of sentences whose matrices are kept at once,
+        sentences of similar length are grouped
+    :return: counts as returned by wer_counts
+    """
+    counts = np.zeros((len(pairs), 5), dtype=np.int64)
+    order = sorted(
+        range(len(pairs)), key=lambda k: (len(pairs[k][0]), len(pairs[k][1]))
+    )
+    for start in range(0, len(pairs), chunk_size):
+        index = order[start : start + chunk_size]
+        ref_ids, ref_lengths, hyp_ids, hyp_lengths = _encode_pairs(
+            [pairs[k] for k in index]
+        )
+        d = _edit_distance_batch(ref_ids, hyp_ids)
+        # pad so that x - 1 and y - 1 can be looked up for x = 0 or y = 0
+        ref_ids = np.pad(ref_ids, ((0, 0), (0, 1)), constant_values=-1)
+        hyp_ids = np.pad(hyp_ids, ((0, 0), (0, 1)), constant_values=-2)
+
+        rows = np.arange(len(index))
+        x, y = ref_lengths.copy(), hyp_lengths.copy()
+        chunk_counts = np.zeros((len(index), 4), dtype=np.int64)
+        active = (x > 0) | (y > 0)
+        while active.any():
+            both = (x >= 1) & (y >= 1)
+            current = d[rows, x, y]
+            diagonal = d[rows, x - 1, y - 1]
+            same = ref_ids[rows, x - 1] == hyp_ids[rows, y - 1]
+            cor = both & (current == diagonal) & same
+            sub = both & ~cor & (current == diagonal + WER_COST_SUB)
+            ins = (y >= 1) & ~cor & ~sub & (current == d[rows, x, y - 1] + WER_COST_INS)
+            dele = ~cor & ~sub & ~ins
+            steps = np.stack([cor, sub, ins, dele], axis=1) & active[:, None]
+            chunk_counts += steps
+            x -= steps[:, 0] | steps[:, 1] | steps[:, 3]
+            y -= steps[:, 0] | steps[:, 1] | steps[:, 2]
+            active = (x > 0) | (y > 0)
+        counts[index, :4] = chunk_counts
+        counts[index, 4] = ref_lengths
+    return counts
+
+
+def edit_distance(r, h):
+    """
+    Edit distance matrix of a reference and a hypothesis, with the costs
+    WER_COST_DEL, WER_COST_INS and WER_COST_SUB.
+
+    :param r: list of reference words
+    :param h: list of hypothesis words
+    :return: integer matrix of shape (len(r) + 1, len(h) + 1)
+    """
+    ref_ids, _, hyp_ids, _ = _encode_pairs([(r, h)])
+    return _edit_distance_batch(ref_ids, hyp_ids)[0]
+
+
 def get_alignment(r, h, d):
     """
     Original Code from https://github.com/zszyellow/WER-in-python/blob/master/wer.py
@@ -1,11 +1,8 @@
 # coding: utf-8
-import tensorflow as tf
-
-tf.config.set_visible_devices([], "GPU")
-
 import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from itertools import groupby
 from signjoey.initialization import initialize_model
@@ -13,12 +10,15 @@ from signjoey.embeddings import Embeddings, SpatialEmbeddings
 from signjoey.encoders import Encoder, RecurrentEncoder, TransformerEncoder
 from signjoey.decoders import Decoder, RecurrentDecoder, TransformerDecoder
 from signjoey.search import beam_search, greedy
+from signjoey.ctc_decoder import ctc_decode
+from signjoey.language_model import NGramLanguageModel
 from signjoey.vocabulary import (
     TextVocabulary,
     GlossVocabulary,
     PAD_TOKEN,
     EOS_TOKEN,
     BOS_TOKEN,
+    SIL_TOKEN,
 )
 from signjoey.batch import Batch
 from signjoey.helpers import freeze_params
@@ -82,6 +82,9 @@ class SignModel(nn.Module):
         sgn_lengths: Tensor,
         txt_input: Tensor,
         txt_mask: Tensor = None,
+        encoder_output: Tensor = None,
+        encoder_hidden: Tensor = None,
+        project_outputs: bool = True,
     ) -> (Tensor, Tensor, Tensor, Tensor):
         """
         First encodes the source sentence.
@@ -90,26 +93,32 @@ class SignModel(nn.Module):
         :param sgn: source input
         :param sgn_mask: source mask
         :param sgn_lengths: length of source inputs
-        :param txt_input: target input
+        :param txt_input: target input, if None the decoder is not run
         :param txt_mask: target mask
+        :param encoder_output: encoder output of the source, if it was
+            already encoded
+        :param encoder_hidden: encoder hidden state that belongs to it
+        :param project_outputs: if False, the decoder outputs are the decoder
+            states before the output layer
         :return: decoder outputs
         """
-        encoder_output, encoder_hidden = self.encode(
-            sgn=sgn, sgn_mask=sgn_mask, sgn_length=sgn_lengths
-        )
+        if encoder_output is None:
+            encoder_output, encoder_hidden = self.encode(
+                sgn=sgn, sgn_mask=sgn_mask, sgn_length=sgn_lengths
+            )
 
         if self.do_recognition:
             # Gloss Recognition Part
             # N x T x C
             gloss_scores = self.gloss_output_layer(encoder_output)
-            # N x T x C
-            gloss_probabilities = gloss_scores.log_softmax(2)
+            # N x T x C, in fp32 for the CTC loss under autocast
+            gloss_probabilities = gloss_scores.float().log_softmax(2)
             # Turn it into T x N x C
             gloss_probabilities = gloss_probabilities.permute(1, 0, 2)
         else:
             gloss_probabilities = None
 
-        if self.do_translation:
+        if self.do_translation and txt_input is not None:
             unroll_steps = txt_input.size(1)
             decoder_outputs = self.decode(
                 encoder_output=encoder_output,
@@ -118,6 +127,7 @@ class SignModel(nn.Module):
                 txt_input=txt_input,
                 unroll_steps=unroll_steps,
                 txt_mask=txt_mask,
+                project_outputs=project_outputs,
             )
         else:
             decoder_outputs = None
@@ -150,6 +160,7 @@ class SignModel(nn.Module):
         unroll_steps: int,
         decoder_hidden: Tensor = None,
         txt_mask: Tensor = None,
+        project_outputs: bool = True,
     ) -> (Tensor, Tensor, Tensor, Tensor):
         """
         Decode, given an encoded source sentence.
@@ -161,6 +172,8 @@ class SignModel(nn.Module):
         :param unroll_steps: number of steps to unroll the decoder for
         :param decoder_hidden: decoder hidden state (optional)
         :param txt_mask: mask for spoken language words
+        :param project_outputs: if False, the outputs are the decoder states
+            before the output layer
         :return: decoder outputs (outputs, hidden, att_probs, att_vectors)
         """
         return self.decoder(
@@ -171,6 +184,7 @@ class SignModel(nn.Module):
             trg_mask=txt_mask,
             unroll_steps=unroll_steps,
             hidden=decoder_hidden,
+            project_outputs=project_outputs,
         )
 
     def get_loss_for_batch(
@@ -180,27 +194,47 @@ class SignModel(nn.Module):
         translation_loss_function: nn.Module,
         recognition_loss_weight: float,
         translation_loss_weight: float,
+        encoder_output: Tensor = None,
+        encoder_hidden: Tensor = None,
+        translation_loss_chunk_size: int = None,
+        forward_module: nn.Module = None,
     ) -> (Tensor, Tensor):
         """
         Compute non-normalized loss and number of tokens for a batch
 
         :param batch: batch to compute loss for
         :param recognition_loss_function: Sign Language Recognition Loss Function (CTC)
-        :param translation_loss_function: Sign Language Translation Loss Function (XEntropy)
+        :param translation_loss_function: Sign Language Translation Loss Function
+            (XEntropy), if None the decoder is not run
         :param recognition_loss_weight: Weight for recognition loss
         :param translation_loss_weight: Weight for translation loss
+        :param encoder_output: encoder output of the batch, if it was already
+            encoded, e.g. to decode hypotheses from it as well
+        :param encoder_hidden: encoder hidden state that belongs to it
+        :param translation_loss_chunk_size: if given, the translation loss is
+            computed in slices of this many time steps, see
+            `_chunked_translation_loss`
+        :param forward_module: module to run the forward pass with instead of
+            this model, e.g. the model wrapped in DistributedDataParallel
         :return: recognition_loss: sum of losses over sequences in the batch
         :return: translation_loss: sum of losses over non-pad elements in the batch
         """
         # pylint: disable=unused-variable
+        do_translation_loss = (
+            self.do_translation and translation_loss_function is not None
+        )
 
         # Do a forward pass
-        decoder_outputs, gloss_probabilities = self.forward(
+        forward = self.forward if forward_module is None else forward_module
+        decoder_outputs, gloss_probabilities = forward(
             sgn=batch.sgn,
             sgn_mask=batch.sgn_mask,
             sgn_lengths=batch.sgn_lengths,
-            txt_input=batch.txt_input,
+            txt_input=batch.txt_input if do_translation_loss else None,
             txt_mask=batch.txt_mask,
+            encoder_output=encoder_output,
+            encoder_hidden=encoder_hidden,
+            project_outputs=translation_loss_chunk_size is None,
         )
 
         if self.do_recognition:
@@ -218,20 +252,64 @@ class SignModel(nn.Module):
         else:
             recognition_loss = None
 
-        if self.do_translation:
+        if do_translation_loss:
             assert decoder_outputs is not None
             word_outputs, _, _, _ = decoder_outputs
-            # Calculate Translation Loss
-            txt_log_probs = F.log_softmax(word_outputs, dim=-1)
-            translation_loss = (
-                translation_loss_function(txt_log_probs, batch.txt)
-                * translation_loss_weight
-            )
+            if translation_loss_chunk_size is None:
+                # Calculate Translation Loss
+                # in fp32 under autocast as well
+                txt_log_probs = F.log_softmax(word_outputs.float(), dim=-1)
+                translation_loss = translation_loss_function(txt_log_probs, batch.txt)
+            else:
+                # word_outputs are the decoder states before the output layer
+                translation_loss = self._chunked_translation_loss(
+                    decoder_states=word_outputs,
+                    txt=batch.txt,
+                    translation_loss_function=translation_loss_function,
+                    chunk_size=translation_loss_chunk_size,
+                )
+            translation_loss = translation_loss * translation_loss_weight
         else:
             translation_loss = None
 
         return recognition_loss, translation_loss
 
+    def _chunked_translation_loss(
+        self,
+        decoder_states: Tensor,
+        txt: Tensor,
+        translation_loss_function: nn.Module,
+        chunk_size: int,
+    ) -> Tensor:
+        """
+        Compute the translation loss in slices of chunk_size time steps.
+
+        The logits and log probabilities of a slice are not kept for the
+        backward pass but recomputed from its decoder states, so their memory
+        scales with the chunk size instead of the target length. The loss
+        function has to sum over the positions.
+
+        :param decoder_states: decoder states before the output layer
+        :param txt: target indices
+        :param translation_loss_function: Sign Language Translation Loss Function
+        :param chunk_size: number of time steps per slice
+        :return: translation loss summed over all slices
+        """
+
+        def chunk_loss(states: Tensor, targets: Tensor) -> Tensor:
+            log_probs = F.log_softmax(self.decoder.output_layer(states).float(), dim=-1)
+            return translation_loss_function(log_probs, targets)
+
+        translation_loss = 0
+        for start in range(0, txt.size(1), chunk_size):
+            translation_loss = translation_loss + checkpoint(
+                chunk_loss,
+                decoder_states[:, start : start + chunk_size],
+                txt[:, start : start + chunk_size],
+                use_reentrant=False,
+            )
+        return translation_loss
+
     def run_batch(
         self,
         batch: Batch,
@@ -239,24 +317,36 @@ class SignModel(nn.Module):
         translation_beam_size: int = 1,
         translation_beam_alpha: float = -1,
         translation_max_output_length: int = 100,
+        recognition_lm: NGramLanguageModel = None,
+        recognition_lm_weight: float = 0.0,
+        recognition_lm_insertion_bonus: float = 0.0,
+        encoder_output: Tensor = None,
+        encoder_hidden: Tensor = None,
     ) -> (np.array, np.array, np.array):
         """
         Get outputs and attentions scores for a given batch
 
         :param batch: batch to generate hypotheses for
-        :param recognition_beam_size: size of the beam for CTC beam search
-            if 1 use greedy
+        :param recognition_beam_size: size of the beam for CTC prefix beam search
+            if 0 use greedy
         :param translation_beam_size: size of the beam for translation beam search
             if 1 use greedy
         :param translation_beam_alpha: alpha value for beam search
         :param translation_max_output_length: maximum length of translation hypotheses
+        :param recognition_lm: gloss language model fused into CTC beam search
+        :param recognition_lm_weight: weight of the gloss language model scores
+        :param recognition_lm_insertion_bonus: score added for every decoded gloss
+        :param encoder_output: encoder output of the batch, if it was already
+            encoded, e.g. to compute the loss as well
+        :param encoder_hidden: encoder hidden state that belongs to it
         :return: stacked_output: hypotheses for batch,
             stacked_attention_scores: attention scores for batch
         """
 
-        encoder_output, encoder_hidden = self.encode(
-            sgn=batch.sgn, sgn_mask=batch.sgn_mask, sgn_length=batch.sgn_lengths
-        )
+        if encoder_output is None:
+            encoder_output, encoder_hidden = self.encode(
+                sgn=batch.sgn, sgn_mask=batch.sgn_mask, sgn_length=batch.sgn_lengths
+            )
 
         if self.do_recognition:
             # Gloss Recognition Part
@@ -264,69 +354,115 @@ class SignModel(nn.Module):
             gloss_scores = self.gloss_output_layer(encoder_output)
             # N x T x C
             gloss_probabilities = gloss_scores.log_softmax(2)
-            # Turn it into T x N x C
-            gloss_probabilities = gloss_probabilities.permute(1, 0, 2)
-            gloss_probabilities = gloss_probabilities.cpu().detach().numpy()
-            tf_gloss_probabilities = np.concatenate(
-                (gloss_probabilities[:, :, 1:], gloss_probabilities[:, :, 0, None]),
-                axis=-1,
+            decoded_gloss_sequences = self.run_recognition(
+                gloss_probabilities=gloss_probabilities,
+                sgn_lengths=batch.sgn_lengths,
+                recognition_beam_size=recognition_beam_size,
+                recognition_lm=recognition_lm,
+                recognition_lm_weight=recognition_lm_weight,
+                recognition_lm_insertion_bonus=recognition_lm_insertion_bonus,
             )
-
-            assert recognition_beam_size > 0
-            ctc_decode, _ = tf.nn.ctc_beam_search_decoder(
-                inputs=tf_gloss_probabilities,
-                sequence_length=batch.sgn_lengths.cpu().detach().numpy(),
-                beam_width=recognition_beam_size,
-                top_paths=1,
-            )
-            ctc_decode = ctc_decode[0]
-            # Create a decoded gloss list for each sample
-            tmp_gloss_sequences = [[] for i in range(gloss_scores.shape[0])]
-            for (value_idx, dense_idx) in enumerate(ctc_decode.indices):
-                tmp_gloss_sequences[dense_idx[0]].append(
-                    ctc_decode.values[value_idx].numpy() + 1
-                )
-            decoded_gloss_sequences = []
-            for seq_idx in range(0, len(tmp_gloss_sequences)):
-                decoded_gloss_sequences.append(
-                    [x[0] for x in groupby(tmp_gloss_sequences[seq_idx])]
-                )
         else:
             decoded_gloss_sequences = None
 
         if self.do_translation:
-            # greedy decoding
-            if translation_beam_size < 2:
-                stacked_txt_output, stacked_attention_scores = greedy(
-                    encoder_hidden=encoder_hidden,
-                    encoder_output=encoder_output,
-                    src_mask=batch.sgn_mask,
-                    embed=self.txt_embed,
-                    bos_index=self.txt_bos_index,
-                    eos_index=self.txt_eos_index,
-                    decoder=self.decoder,
-                    max_output_length=translation_max_output_length,
-                )
-                # batch, time, max_sgn_length
-            else:  # beam size
-                stacked_txt_output, stacked_attention_scores = beam_search(
-                    size=translation_beam_size,
-                    encoder_hidden=encoder_hidden,
-                    encoder_output=encoder_output,
-                    src_mask=batch.sgn_mask,
-                    embed=self.txt_embed,
-                    max_output_length=translation_max_output_length,
-                    alpha=translation_beam_alpha,
-                    eos_index=self.txt_eos_index,
-                    pad_index=self.txt_pad_index,
-                    bos_index=self.txt_bos_index,
-                    decoder=self.decoder,
-                )
+            stacked_txt_output, stacked_attention_scores = self.run_translation(
+                encoder_output=encoder_output,
+                encoder_hidden=encoder_hidden,
+                sgn_mask=batch.sgn_mask,
+                translation_beam_size=translation_beam_size,
+                translation_beam_alpha=translation_beam_alpha,
+                translation_max_output_length=translation_max_output_length,
+            )
         else:
             stacked_txt_output = stacked_attention_scores = None
 
         return decoded_gloss_sequences, stacked_txt_output, stacked_attention_scores
 
+    def run_recognition(
+        self,
+        gloss_probabilities: Tensor,
+        sgn_lengths: Tensor,
+        recognition_beam_size: int = 1,
+        recognition_lm: NGramLanguageModel = None,
+        recognition_lm_weight: float = 0.0,
+        recognition_lm_insertion_bonus: float = 0.0,
+    ) -> list:
+        """
+        Decode gloss sequences from gloss log probabilities with CTC search
+
+        :param gloss_probabilities: gloss log probabilities (N x T x C)
+        :param sgn_lengths: length of the sign sequences
+        :param recognition_beam_size: size of the beam for CTC prefix beam search
+            if 0 use greedy
+        :param recognition_lm: gloss language model fused into CTC beam search
+        :param recognition_lm_weight: weight of the gloss language model scores
+        :param recognition_lm_insertion_bonus: score added for every decoded gloss
+        :return: decoded gloss sequences
+        """
+        # The blank label is the silence index in the gloss vocabulary.
+        ctc_decode_output = ctc_decode(
+            log_probs=gloss_probabilities,
+            lengths=sgn_lengths,
+            beam_size=recognition_beam_size,
+            blank=self.gls_vocab.stoi[SIL_TOKEN],
+            lm=recognition_lm,
+            lm_weight=recognition_lm_weight,
+            insertion_bonus=recognition_lm_insertion_bonus,
+        )
+        return [[x[0] for x in groupby(sequence)] for sequence in ctc_decode_output]
+
+    def run_translation(
+        self,
+        encoder_output: Tensor,
+        encoder_hidden: Tensor,
+        sgn_mask: Tensor,
+        translation_beam_size: int = 1,
+        translation_beam_alpha: float = -1,
+        translation_max_output_length: int = 100,
+    ) -> (np.array, np.array):
+        """
+        Generate translations from encoder outputs with greedy or beam search
+
+        :param encoder_output: encoder states for attention computation
+        :param encoder_hidden: last encoder state for decoder initialization
+        :param sgn_mask: sign sequence mask, 1 at valid tokens
+        :param translation_beam_size: size of the beam for translation beam search
+            if 1 use greedy
+        :param translation_beam_alpha: alpha value for beam search
+        :param translation_max_output_length: maximum length of translation hypotheses
+        :return: stacked_txt_output: hypotheses for batch,
+            stacked_attention_scores: attention scores for batch
+        """
+        # greedy decoding
+        if translation_beam_size < 2:
+            stacked_txt_output, stacked_attention_scores = greedy(
+                encoder_hidden=encoder_hidden,
+                encoder_output=encoder_output,
+                src_mask=sgn_mask,
+                embed=self.txt_embed,
+                bos_index=self.txt_bos_index,
+                eos_index=self.txt_eos_index,
+                decoder=self.decoder,
+                max_output_length=translation_max_output_length,
+            )
+            # batch, time, max_sgn_length
+        else:  # beam size
+            stacked_txt_output, _, stacked_attention_scores = beam_search(
+                size=translation_beam_size,
+                encoder_hidden=encoder_hidden,
+                encoder_output=encoder_output,
+                src_mask=sgn_mask,
+                embed=self.txt_embed,
+                max_output_length=translation_max_output_length,
+                alpha=translation_beam_alpha,
+                eos_index=self.txt_eos_index,
+                pad_index=self.txt_pad_index,
+                bos_index=self.txt_bos_index,
+                decoder=self.decoder,
+            )
+        return stacked_txt_output, stacked_attention_scores
+
     def __repr__(self) -> str:
         """
         String representation: a description of encoder, decoder and embeddings
@@ -5,8 +5,12 @@ import wandb
 torch.backends.cudnn.deterministic = True
 
 import logging
+import multiprocessing
 import numpy as np
+import os
 import pickle as pickle
+import shutil
+import tempfile
 import time
 import torch.nn as nn
 
@@ -14,13 +18,15 @@ from typing import List
 from torchtext.data import Dataset
 from signjoey.loss import XentLoss
 from signjoey.helpers import (
+    BackgroundWorker,
     bpe_postprocess,
     load_config,
     get_latest_checkpoint,
     load_checkpoint,
 )
-from signjoey.metrics import bleu, chrf, rouge, wer_list
+from signjoey.metrics import CorpusStatistics, ReferenceStatistics, WERStatistics
 from signjoey.model import build_model, SignModel
+from signjoey.language_model import NGramLanguageModel
 from signjoey.batch import Batch
 from signjoey.data import load_data, make_data_iter
 from signjoey.vocabulary import PAD_TOKEN, SIL_TOKEN
@@ -30,6 +36,71 @@ from signjoey.phoenix_utils.phoenix_cleanup import (
 )
 
 
+class EncoderOutputCache:
+    """
+    Encoder outputs, gloss log probabilities and losses of the batches of a
+    dataset, filled by the first validate_on_data call that gets the cache.
+    Later calls decode them with other search parameters without running the
+    encoder again, and reuse the hypotheses of search parameters that were
+    decoded before.
+
+    The batches are kept in memory, or saved to files in spill_dir and read
+    back when they are decoded.
+    """
+
+    def __init__(self, spill_dir: str = None):
+        """
+        :param spill_dir: directory for the batch files, in memory if None
+        """
+        self.complete = False
+        self._batches = []
+        self._outputs = {}
+        self._spill_dir = None
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._spill_dir = tempfile.mkdtemp(prefix="encoder_cache_", dir=spill_dir)
+
+    def add(self, encoded: dict):
+        """
+        Adds the next batch.
+
+        :param encoded: encoder outputs, log probabilities and losses of a batch
+        """
+        if self._spill_dir is None:
+            self._batches.append(encoded)
+        else:
+            path = os.path.join(
+                self._spill_dir, "batch_{:06d}.pt".format(len(self._batches))
+            )
+            torch.save(encoded, path)
+            self._batches.append(path)
+
+    def __iter__(self):
+        for encoded in self._batches:
+            yield encoded if self._spill_dir is None else torch.load(encoded)
+
+    def outputs(self, key: tuple) -> list:
+        """
+        Hypotheses of the batches for some search parameters, which are
+        appended to the returned list as they are decoded.
+
+        :param key: search parameters
+        :return: list of batch hypotheses
+        """
+        return self._outputs.setdefault(key, [])
+
+    def close(self):
+        """
+        Frees the batches and deletes their files.
+        """
+        self.complete = False
+        self._batches = []
+        self._outputs = {}
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+
+
 # pylint: disable=too-many-arguments,too-many-locals,no-member
 def validate_on_data(
     model: SignModel,
@@ -52,6 +123,14 @@ def validate_on_data(
     batch_type: str = "sentence",
     dataset_version: str = "phoenix_2014_trans",
     frame_subsampling_ratio: int = None,
+    recognition_lm: NGramLanguageModel = None,
+    recognition_lm_weight: float = 0.0,
+    recognition_lm_insertion_bonus: float = 0.0,
+    sort_by_length: bool = False,
+    compute_rouge: bool = True,
+    compute_translation_loss: bool = True,
+    encoder_cache: "EncoderOutputCache" = None,
+    collect_attention_scores: bool = False,
 ) -> (
     float,
     float,
@@ -91,6 +170,20 @@ def validate_on_data(
     :param do_translation: flag for predicting text
     :param dataset_version: phoenix_2014 or phoenix_2014_trans
     :param frame_subsampling_ratio: frame subsampling ratio
+    :param recognition_lm: gloss language model fused into CTC beam search
+    :param recognition_lm_weight: weight of the gloss language model scores
+    :param recognition_lm_insertion_bonus: score added for every decoded gloss
+    :param sort_by_length: group sentences of similar sign length into batches
+    :param compute_rouge: compute ROUGE-L, otherwise it is reported as -1
+    :param compute_translation_loss: run the decoder on the references for
+        the translation loss and perplexity, otherwise they are reported as -1
+    :param encoder_cache: cache that the first call fills with the encoder
+        outputs and losses of the batches, later calls decode from it without
+        running the encoder. All calls with the same cache have to use the
+        same data, batching and losses.
+    :param collect_attention_scores: return the translation attention scores
+        of every sentence, otherwise only the current batch holds them.
+        The hypotheses of all sentences are kept in either case.
 
     :return:
         - current_valid_score: current validation score [eval_metric],
@@ -101,7 +194,8 @@ def validate_on_data(
         - valid_references: validation references,
         - valid_hypotheses: validation_hypotheses,
         - decoded_valid: raw validation hypotheses (before post-processing),
-        - valid_attention_scores: attention scores for validation hypotheses
+        - valid_attention_scores: attention scores for validation hypotheses,
+          None unless collect_attention_scores is set
     """
     valid_iter = make_data_iter(
         dataset=data,
@@ -109,21 +203,67 @@ def validate_on_data(
         batch_type=batch_type,
         shuffle=False,
         train=False,
+        sort_by_length=sort_by_length,
     )
 
-    # disable dropout
-    model.eval()
-    # don't track gradients during validation
-    with torch.no_grad():
-        all_gls_outputs = []
-        all_txt_outputs = []
-        all_attention_scores = []
-        total_recognition_loss = 0
-        total_translation_loss = 0
-        total_num_txt_tokens = 0
-        total_num_gls_tokens = 0
-        total_num_seqs = 0
-        for valid_batch in iter(valid_iter):
+    # batches of dataset indices, in the order of the iterator
+    batch_indices = valid_iter.batch_sampler.batches()
+
+    if do_recognition:
+        # Gloss clean-up function
+        if dataset_version == "phoenix_2014_trans":
+            gls_cln_fn = clean_phoenix_2014_trans
+        elif dataset_version == "phoenix_2014":
+            gls_cln_fn = clean_phoenix_2014
+        else:
+            raise ValueError("Unknown Dataset Version: " + dataset_version)
+
+        # Construct gloss sequences for metrics
+        gls_ref = [gls_cln_fn(" ".join(t)) for t in data.gls]
+        decoded_gls = [None] * len(data)
+        gls_hyp = [None] * len(data)
+        gls_statistics = WERStatistics()
+
+    if do_translation:
+        join_char = " " if level in ["word", "bpe"] else ""
+        # Construct text sequences for metrics
+        txt_ref = [join_char.join(t) for t in data.txt]
+        # post-process
+        if level == "bpe":
+            txt_ref = [bpe_postprocess(v) for v in txt_ref]
+        decoded_txt = [None] * len(data)
+        txt_hyp = [None] * len(data)
+        txt_statistics = CorpusStatistics(
+            ReferenceStatistics.for_dataset(data, txt_ref), compute_rouge=compute_rouge
+        )
+
+    def score_batch(indices, gls_predictions, txt_predictions):
+        # decode back to symbols and add the sequences to the metrics
+        if gls_predictions is not None:
+            batch_decoded_gls = model.gls_vocab.arrays_to_sentences(
+                arrays=gls_predictions
+            )
+            batch_gls_hyp = [gls_cln_fn(" ".join(t)) for t in batch_decoded_gls]
+            gls_statistics.add(
+                references=[gls_ref[i] for i in indices], hypotheses=batch_gls_hyp
+            )
+            for i, decoded, hyp in zip(indices, batch_decoded_gls, batch_gls_hyp):
+                decoded_gls[i] = decoded
+                gls_hyp[i] = hyp
+        if txt_predictions is not None:
+            batch_decoded_txt = model.txt_vocab.arrays_to_sentences(
+                arrays=txt_predictions
+            )
+            batch_txt_hyp = [join_char.join(t) for t in batch_decoded_txt]
+            if level == "bpe":
+                batch_txt_hyp = [bpe_postprocess(v) for v in batch_txt_hyp]
+            txt_statistics.add(indices=indices, hypotheses=batch_txt_hyp)
+            for i, decoded, hyp in zip(indices, batch_decoded_txt, batch_txt_hyp):
+                decoded_txt[i] = decoded
+                txt_hyp[i] = hyp
+
+    def encode_batches():
+        for valid_batch, indices in zip(iter(valid_iter), batch_indices):
             batch = Batch(
                 is_train=False,
                 torch_batch=valid_batch,
@@ -134,13 +274,17 @@ def validate_on_data(
             )
             sort_reverse_index = batch.sort_by_sgn_lengths()
 
+            # the encoder output serves both the loss and the hypotheses
+            encoder_output, encoder_hidden = model.encode(
+                sgn=batch.sgn, sgn_mask=batch.sgn_mask, sgn_length=batch.sgn_lengths
+            )
             batch_recognition_loss, batch_translation_loss = model.get_loss_for_batch(
                 batch=batch,
                 recognition_loss_function=recognition_loss_function
                 if do_recognition
                 else None,
                 translation_loss_function=translation_loss_function
-                if do_translation
+                if do_translation and compute_translation_loss
                 else None,
                 recognition_loss_weight=recognition_loss_weight
                 if do_recognition
@@ -148,46 +292,150 @@ def validate_on_data(
                 translation_loss_weight=translation_loss_weight
                 if do_translation
                 else None,
+                encoder_output=encoder_output,
+                encoder_hidden=encoder_hidden,
             )
-            if do_recognition:
-                total_recognition_loss += batch_recognition_loss
-                total_num_gls_tokens += batch.num_gls_tokens
-            if do_translation:
-                total_translation_loss += batch_translation_loss
-                total_num_txt_tokens += batch.num_txt_tokens
-            total_num_seqs += batch.num_seqs
+            yield {
+                "indices": indices,
+                "sort_reverse_index": sort_reverse_index,
+                "sgn_mask": batch.sgn_mask,
+                "sgn_lengths": batch.sgn_lengths,
+                "encoder_output": encoder_output,
+                "encoder_hidden": encoder_hidden,
+                # N x T x C
+                "gloss_probabilities": model.gloss_output_layer(
+                    encoder_output
+                ).log_softmax(2)
+                if do_recognition
+                else None,
+                "recognition_loss": batch_recognition_loss,
+                "translation_loss": batch_translation_loss,
+                "num_gls_tokens": batch.num_gls_tokens,
+                "num_txt_tokens": batch.num_txt_tokens,
+                "num_seqs": batch.num_seqs,
+            }
 
+    fill_cache = encoder_cache is not None and not encoder_cache.complete
+    if encoder_cache is not None:
+        # hypotheses of previous calls with the same search parameters
+        gls_outputs = encoder_cache.outputs(
             (
-                batch_gls_predictions,
-                batch_txt_predictions,
-                batch_attention_scores,
-            ) = model.run_batch(
-                batch=batch,
-                recognition_beam_size=recognition_beam_size if do_recognition else None,
-                translation_beam_size=translation_beam_size if do_translation else None,
-                translation_beam_alpha=translation_beam_alpha
-                if do_translation
-                else None,
-                translation_max_output_length=translation_max_output_length
-                if do_translation
-                else None,
+                "gls",
+                recognition_beam_size,
+                id(recognition_lm),
+                recognition_lm_weight,
+                recognition_lm_insertion_bonus,
+            )
+        )
+        txt_outputs = encoder_cache.outputs(
+            (
+                "txt",
+                translation_beam_size,
+                translation_beam_alpha,
+                translation_max_output_length,
+                collect_attention_scores,
             )
+        )
 
-            # sort outputs back to original order
-            if do_recognition:
-                all_gls_outputs.extend(
+    # disable dropout
+    model.eval()
+    # don't track gradients during validation
+    with torch.no_grad():
+        all_attention_scores = [] if collect_attention_scores else None
+        total_recognition_loss = 0
+        total_translation_loss = 0
+        total_num_txt_tokens = 0
+        total_num_gls_tokens = 0
+        total_num_seqs = 0
+        # outputs of a batch are scored on a background thread while the
+        # next batch is decoded
+        with BackgroundWorker() as scorer:
+            if encoder_cache is None or fill_cache:
+                encoded_batches = encode_batches()
+            else:
+                encoded_batches = iter(encoder_cache)
+            for batch_number, encoded in enumerate(encoded_batches):
+                if fill_cache:
+                    encoder_cache.add(encoded)
+                if do_recognition:
+                    total_recognition_loss += encoded["recognition_loss"]
+                    total_num_gls_tokens += encoded["num_gls_tokens"]
+                if do_translation and compute_translation_loss:
+                    total_translation_loss += encoded["translation_loss"]
+                    total_num_txt_tokens += encoded["num_txt_tokens"]
+                total_num_seqs += encoded["num_seqs"]
+
+                if not do_recognition:
+                    batch_gls_predictions = None
+                elif encoder_cache is not None and batch_number < len(gls_outputs):
+                    batch_gls_predictions = gls_outputs[batch_number]
+                else:
+                    batch_gls_predictions = model.run_recognition(
+                        gloss_probabilities=encoded["gloss_probabilities"],
+                        sgn_lengths=encoded["sgn_lengths"],
+                        recognition_beam_size=recognition_beam_size,
+                        recognition_lm=recognition_lm,
+                        recognition_lm_weight=recognition_lm_weight,
+                        recognition_lm_insertion_bonus=recognition_lm_insertion_bonus,
+                    )
+                    if encoder_cache is not None:
+                        gls_outputs.append(batch_gls_predictions)
+
+                if not do_translation:
+                    batch_txt_predictions = batch_attention_scores = None
+                elif encoder_cache is not None and batch_number < len(txt_outputs):
+                    batch_txt_predictions, batch_attention_scores = txt_outputs[
+                        batch_number
+                    ]
+                else:
+                    (
+                        batch_txt_predictions,
+                        batch_attention_scores,
+                    ) = model.run_translation(
+                        encoder_output=encoded["encoder_output"],
+                        encoder_hidden=encoded["encoder_hidden"],
+                        sgn_mask=encoded["sgn_mask"],
+                        translation_beam_size=translation_beam_size,
+                        translation_beam_alpha=translation_beam_alpha,
+                        translation_max_output_length=translation_max_output_length,
+                    )
+                    if encoder_cache is not None:
+                        txt_outputs.append(
+                            (
+                                batch_txt_predictions,
+                                batch_attention_scores
+                                if collect_attention_scores
+                                else None,
+                            )
+                        )
+
+                # sort outputs back to original order
+                sort_reverse_index = encoded["sort_reverse_index"]
+                scorer.submit(
+                    score_batch,
+                    encoded["indices"],
                     [batch_gls_predictions[sri] for sri in sort_reverse_index]
+                    if do_recognition
+                    else None,
+                    batch_txt_predictions[sort_reverse_index]
+                    if do_translation
+                    else None,
                 )
-            if do_translation:
-                all_txt_outputs.extend(batch_txt_predictions[sort_reverse_index])
-            all_attention_scores.extend(
-                batch_attention_scores[sort_reverse_index]
-                if batch_attention_scores is not None
-                else []
-            )
+                if collect_attention_scores and batch_attention_scores is not None:
+                    all_attention_scores.extend(
+                        batch_attention_scores[sort_reverse_index]
+                    )
+        if fill_cache:
+            encoder_cache.complete = True
+
+        if sort_by_length and all_attention_scores:
+            # restore the order of the data
+            order = [i for b in batch_indices for i in b]
+            restore = sorted(range(len(order)), key=order.__getitem__)
+            all_attention_scores = [all_attention_scores[i] for i in restore]
 
         if do_recognition:
-            assert len(all_gls_outputs) == len(data)
+            assert None not in gls_hyp
             if (
                 recognition_loss_function is not None
                 and recognition_loss_weight != 0
@@ -196,29 +444,15 @@ def validate_on_data(
                 valid_recognition_loss = total_recognition_loss
             else:
                 valid_recognition_loss = -1
-            # decode back to symbols
-            decoded_gls = model.gls_vocab.arrays_to_sentences(arrays=all_gls_outputs)
-
-            # Gloss clean-up function
-            if dataset_version == "phoenix_2014_trans":
-                gls_cln_fn = clean_phoenix_2014_trans
-            elif dataset_version == "phoenix_2014":
-                gls_cln_fn = clean_phoenix_2014
-            else:
-                raise ValueError("Unknown Dataset Version: " + dataset_version)
-
-            # Construct gloss sequences for metrics
-            gls_ref = [gls_cln_fn(" ".join(t)) for t in data.gls]
-            gls_hyp = [gls_cln_fn(" ".join(t)) for t in decoded_gls]
-            assert len(gls_ref) == len(gls_hyp)
 
             # GLS Metrics
-            gls_wer_score = wer_list(hypotheses=gls_hyp, references=gls_ref)
+            gls_wer_score = gls_statistics.scores()
 
         if do_translation:
-            assert len(all_txt_outputs) == len(data)
+            assert None not in txt_hyp
             if (
                 translation_loss_function is not None
+                and compute_translation_loss
                 and translation_loss_weight != 0
                 and total_num_txt_tokens > 0
             ):
@@ -229,23 +463,11 @@ def validate_on_data(
             else:
                 valid_translation_loss = -1
                 valid_ppl = -1
-            # decode back to symbols
-            decoded_txt = model.txt_vocab.arrays_to_sentences(arrays=all_txt_outputs)
-            # evaluate with metric on full dataset
-            join_char = " " if level in ["word", "bpe"] else ""
-            # Construct text sequences for metrics
-            txt_ref = [join_char.join(t) for t in data.txt]
-            txt_hyp = [join_char.join(t) for t in decoded_txt]
-            # post-process
-            if level == "bpe":
-                txt_ref = [bpe_postprocess(v) for v in txt_ref]
-                txt_hyp = [bpe_postprocess(v) for v in txt_hyp]
-            assert len(txt_ref) == len(txt_hyp)
 
             # TXT Metrics
-            txt_bleu = bleu(references=txt_ref, hypotheses=txt_hyp)
-            txt_chrf = chrf(references=txt_ref, hypotheses=txt_hyp)
-            txt_rouge = rouge(references=txt_ref, hypotheses=txt_hyp)
+            txt_bleu = txt_statistics.bleu()
+            txt_chrf = txt_statistics.chrf()
+            txt_rouge = txt_statistics.rouge()
 
         valid_scores = {}
         if do_recognition:
@@ -277,6 +499,54 @@ def validate_on_data(
     return results
 
 
+# validate_on_data arguments of the running sweep, inherited by forked workers
+_sweep_kwargs = {}
+
+
+def _init_sweep_worker():
+    # OpenMP deadlocks in a forked child that starts more threads than one,
+    # once the parent has used its thread pool
+    torch.set_num_threads(1)
+
+
+def _validate_sweep_config(config: dict) -> dict:
+    return validate_on_data(**_sweep_kwargs, **config)
+
+
+def sweep_on_data(configs: List[dict], num_workers: int = 0, **kwargs) -> List[dict]:
+    """
+    Runs validate_on_data for several configurations, e.g. search parameters.
+
+    With num_workers > 1 the configurations are distributed over forked worker
+    processes, which see the model weights and the filled encoder cache of
+    this process copy-on-write. Every worker runs on a single CPU thread.
+
+    :param configs: validate_on_data arguments that differ between runs
+    :param num_workers: number of worker processes, 0 runs in this process
+    :param kwargs: validate_on_data arguments shared by all runs
+    :return: results of validate_on_data, in the order of configs
+    """
+    if num_workers < 2 or len(configs) < 2:
+        return [validate_on_data(**kwargs, **config) for config in configs]
+
+    results = []
+    encoder_cache = kwargs.get("encoder_cache", None)
+    if encoder_cache is not None and not encoder_cache.complete:
+        # fill the cache here, so that the workers do not run the encoder
+        results.append(validate_on_data(**kwargs, **configs[0]))
+        configs = configs[1:]
+
+    _sweep_kwargs.update(kwargs)
+    try:
+        with multiprocessing.get_context("fork").Pool(
+            processes=min(num_workers, len(configs)), initializer=_init_sweep_worker
+        ) as pool:
+            results.extend(pool.map(_validate_sweep_config, configs, chunksize=1))
+    finally:
+        _sweep_kwargs.clear()
+    return results
+
+
 # pylint: disable-msg=logging-too-many-args
 def test(
     cfg_file, ckpt: str, output_path: str = None, logger: logging.Logger = None
@@ -315,6 +585,7 @@ def test(
 
     batch_size = cfg["training"]["batch_size"]
     batch_type = cfg["training"].get("batch_type", "sentence")
+    sort_by_length = cfg["training"].get("eval_sort_by_length", False)
     use_cuda = cfg["training"].get("use_cuda", False)
     level = cfg["data"]["level"]
     dataset_version = cfg["data"].get("version", "phoenix_2014_trans")
@@ -323,7 +594,9 @@ def test(
     )
 
     # load the data
-    _, dev_data, test_data, gls_vocab, txt_vocab = load_data(data_cfg=cfg["data"])
+    train_data, dev_data, test_data, gls_vocab, txt_vocab = load_data(
+        data_cfg=cfg["data"]
+    )
 
     # load model state from disk
     model_checkpoint = load_checkpoint(ckpt, use_cuda=use_cuda)
@@ -356,10 +629,24 @@ def test(
         recognition_beam_sizes = cfg["testing"].get("recognition_beam_sizes", [1])
         translation_beam_sizes = cfg["testing"].get("translation_beam_sizes", [1])
         translation_beam_alphas = cfg["testing"].get("translation_beam_alphas", [-1])
+        recognition_lm_order = cfg["testing"].get("recognition_lm_order", 0)
+        recognition_lm_weights = cfg["testing"].get("recognition_lm_weights", [0.0])
+        recognition_lm_insertion_bonuses = cfg["testing"].get(
+            "recognition_lm_insertion_bonuses", [0.0]
+        )
+        cache_encoder_outputs = cfg["testing"].get("cache_encoder_outputs", True)
+        encoder_cache_dir = cfg["testing"].get("encoder_cache_dir", None)
+        sweep_num_workers = cfg["testing"].get("sweep_num_workers", 0)
     else:
         recognition_beam_sizes = [1]
         translation_beam_sizes = [1]
         translation_beam_alphas = [-1]
+        recognition_lm_order = 0
+        recognition_lm_weights = [0.0]
+        recognition_lm_insertion_bonuses = [0.0]
+        cache_encoder_outputs = True
+        encoder_cache_dir = None
+        sweep_num_workers = 0
 
     if "testing" in cfg.keys():
         max_recognition_beam_size = cfg["testing"].get(
@@ -368,6 +655,11 @@ def test(
         if max_recognition_beam_size is not None:
             recognition_beam_sizes = list(range(1, max_recognition_beam_size + 1))
 
+    if use_cuda and sweep_num_workers > 1:
+        # CUDA can not be used in forked processes
+        logger.warning("sweep_num_workers is ignored when using CUDA")
+        sweep_num_workers = 0
+
     if do_recognition:
         recognition_loss_function = torch.nn.CTCLoss(
             blank=model.gls_vocab.stoi[SIL_TOKEN], zero_infinity=True
@@ -384,16 +676,57 @@ def test(
     # NOTE (Cihan): Currently Hardcoded to be 0 for TensorFlow decoding
     assert model.gls_vocab.stoi[SIL_TOKEN] == 0
 
+    # gloss language model for CTC beam search, built from the training glosses
+    recognition_lm = None
+    if do_recognition and recognition_lm_order > 0:
+        recognition_lm = NGramLanguageModel.from_dataset(
+            dataset=train_data, vocab=gls_vocab, order=recognition_lm_order
+        )
+        logger.info(
+            "Gloss %d-gram language model with %d states",
+            recognition_lm_order,
+            recognition_lm.num_states,
+        )
+    else:
+        # the weight has no effect without a language model
+        recognition_lm_weights = [0.0]
+    sweep_recognition_lm = (
+        recognition_lm is not None or recognition_lm_insertion_bonuses != [0.0]
+    )
+
+    # the dev set is encoded once for all search parameters of the sweeps
+    dev_encoder_cache = (
+        EncoderOutputCache(spill_dir=encoder_cache_dir)
+        if cache_encoder_outputs
+        else None
+    )
+
     if do_recognition:
         # Dev Recognition CTC Beam Search Results
         dev_recognition_results = {}
         dev_best_wer_score = float("inf")
         dev_best_recognition_beam_size = 1
-        for rbw in recognition_beam_sizes:
+        dev_best_recognition_lm_weight = 0.0
+        dev_best_recognition_lm_insertion_bonus = 0.0
+        recognition_experiments = [
+            (rbw, lmw, lmb)
+            for rbw in recognition_beam_sizes
+            for lmw in recognition_lm_weights
+            for lmb in recognition_lm_insertion_bonuses
+        ]
+        for rbw, lmw, lmb in recognition_experiments:
+            # the dumped results are keyed by beam size unless an LM is swept
+            result_key = (rbw, lmw, lmb) if sweep_recognition_lm else rbw
             logger.info("-" * 60)
             valid_start_time = time.time()
             logger.info("[DEV] partition [RECOGNITION] experiment [BW]: %d", rbw)
-            dev_recognition_results[rbw] = validate_on_data(
+            if sweep_recognition_lm:
+                logger.info(
+                    "[DEV] partition [RECOGNITION] experiment [LM]: %.2f [IB]: %.2f",
+                    lmw,
+                    lmb,
+                )
+            dev_recognition_results[result_key] = validate_on_data(
                 model=model,
                 data=dev_data,
                 batch_size=batch_size,
@@ -422,12 +755,20 @@ def test(
                 translation_beam_size=1 if do_translation else None,
                 translation_beam_alpha=-1 if do_translation else None,
                 frame_subsampling_ratio=frame_subsampling_ratio,
+                sort_by_length=sort_by_length,
+                recognition_lm=recognition_lm,
+                recognition_lm_weight=lmw,
+                recognition_lm_insertion_bonus=lmb,
+                encoder_cache=dev_encoder_cache,
             )
             logger.info("finished in %.4fs ", time.time() - valid_start_time)
-            if dev_recognition_results[rbw]["valid_scores"]["wer"] < dev_best_wer_score:
-                dev_best_wer_score = dev_recognition_results[rbw]["valid_scores"]["wer"]
+            dev_recognition_result = dev_recognition_results[result_key]
+            if dev_recognition_result["valid_scores"]["wer"] < dev_best_wer_score:
+                dev_best_wer_score = dev_recognition_result["valid_scores"]["wer"]
                 dev_best_recognition_beam_size = rbw
-                dev_best_recognition_result = dev_recognition_results[rbw]
+                dev_best_recognition_lm_weight = lmw
+                dev_best_recognition_lm_insertion_bonus = lmb
+                dev_best_recognition_result = dev_recognition_result
                 logger.info("*" * 60)
                 logger.info(
                     "[DEV] partition [RECOGNITION] results:\n\t"
@@ -445,6 +786,12 @@ def test(
                         "sub_rate"
                     ],
                 )
+                if sweep_recognition_lm:
+                    logger.info(
+                        "New Best Gloss LM Weight: %.2f and Insertion Bonus: %.2f",
+                        dev_best_recognition_lm_weight,
+                        dev_best_recognition_lm_insertion_bonus,
+                    )
                 logger.info("*" * 60)
 
     if do_translation:
@@ -453,71 +800,81 @@ def test(
         dev_best_bleu_score = float("-inf")
         dev_best_translation_beam_size = 1
         dev_best_translation_alpha = 1
-        for tbw in translation_beam_sizes:
-            dev_translation_results[tbw] = {}
-            for ta in translation_beam_alphas:
-                dev_translation_results[tbw][ta] = validate_on_data(
-                    model=model,
-                    data=dev_data,
-                    batch_size=batch_size,
-                    use_cuda=use_cuda,
-                    level=level,
-                    sgn_dim=sum(cfg["data"]["feature_size"])
-                    if isinstance(cfg["data"]["feature_size"], list)
-                    else cfg["data"]["feature_size"],
-                    batch_type=batch_type,
-                    dataset_version=dataset_version,
-                    do_recognition=do_recognition,
-                    recognition_loss_function=recognition_loss_function
-                    if do_recognition
-                    else None,
-                    recognition_loss_weight=1 if do_recognition else None,
-                    recognition_beam_size=1 if do_recognition else None,
-                    do_translation=do_translation,
-                    translation_loss_function=translation_loss_function,
-                    translation_loss_weight=1,
-                    translation_max_output_length=translation_max_output_length,
-                    txt_pad_index=txt_vocab.stoi[PAD_TOKEN],
-                    translation_beam_size=tbw,
-                    translation_beam_alpha=ta,
-                    frame_subsampling_ratio=frame_subsampling_ratio,
+        translation_experiments = [
+            (tbw, ta)
+            for tbw in translation_beam_sizes
+            for ta in translation_beam_alphas
+        ]
+        translation_sweep_results = sweep_on_data(
+            configs=[
+                {"translation_beam_size": tbw, "translation_beam_alpha": ta}
+                for tbw, ta in translation_experiments
+            ],
+            num_workers=sweep_num_workers,
+            model=model,
+            data=dev_data,
+            batch_size=batch_size,
+            use_cuda=use_cuda,
+            level=level,
+            sgn_dim=sum(cfg["data"]["feature_size"])
+            if isinstance(cfg["data"]["feature_size"], list)
+            else cfg["data"]["feature_size"],
+            batch_type=batch_type,
+            dataset_version=dataset_version,
+            do_recognition=do_recognition,
+            recognition_loss_function=recognition_loss_function
+            if do_recognition
+            else None,
+            recognition_loss_weight=1 if do_recognition else None,
+            recognition_beam_size=1 if do_recognition else None,
+            do_translation=do_translation,
+            translation_loss_function=translation_loss_function,
+            translation_loss_weight=1,
+            translation_max_output_length=translation_max_output_length,
+            txt_pad_index=txt_vocab.stoi[PAD_TOKEN],
+            frame_subsampling_ratio=frame_subsampling_ratio,
+            sort_by_length=sort_by_length,
+            encoder_cache=dev_encoder_cache,
+        )
+        for (tbw, ta), translation_sweep_result in zip(
+            translation_experiments, translation_sweep_results
+        ):
+            dev_translation_results.setdefault(tbw, {})[ta] = translation_sweep_result
+            if (
+                dev_translation_results[tbw][ta]["valid_scores"]["bleu"]
+                > dev_best_bleu_score
+            ):
+                dev_best_bleu_score = dev_translation_results[tbw][ta][
+                    "valid_scores"
+                ]["bleu"]
+                dev_best_translation_beam_size = tbw
+                dev_best_translation_alpha = ta
+                dev_best_translation_result = dev_translation_results[tbw][ta]
+                logger.info(
+                    "[DEV] partition [Translation] results:\n\t"
+                    "New Best Translation Beam Size: %d and Alpha: %d\n\t"
+                    "BLEU-4 %.2f\t(BLEU-1: %.2f,\tBLEU-2: %.2f,\tBLEU-3: %.2f,\tBLEU-4: %.2f)\n\t"
+                    "CHRF %.2f\t"
+                    "ROUGE %.2f",
+                    dev_best_translation_beam_size,
+                    dev_best_translation_alpha,
+                    dev_best_translation_result["valid_scores"]["bleu"],
+                    dev_best_translation_result["valid_scores"]["bleu_scores"][
+                        "bleu1"
+                    ],
+                    dev_best_translation_result["valid_scores"]["bleu_scores"][
+                        "bleu2"
+                    ],
+                    dev_best_translation_result["valid_scores"]["bleu_scores"][
+                        "bleu3"
+                    ],
+                    dev_best_translation_result["valid_scores"]["bleu_scores"][
+                        "bleu4"
+                    ],
+                    dev_best_translation_result["valid_scores"]["chrf"],
+                    dev_best_translation_result["valid_scores"]["rouge"],
                 )
-
-                if (
-                    dev_translation_results[tbw][ta]["valid_scores"]["bleu"]
-                    > dev_best_bleu_score
-                ):
-                    dev_best_bleu_score = dev_translation_results[tbw][ta][
-                        "valid_scores"
-                    ]["bleu"]
-                    dev_best_translation_beam_size = tbw
-                    dev_best_translation_alpha = ta
-                    dev_best_translation_result = dev_translation_results[tbw][ta]
-                    logger.info(
-                        "[DEV] partition [Translation] results:\n\t"
-                        "New Best Translation Beam Size: %d and Alpha: %d\n\t"
-                        "BLEU-4 %.2f\t(BLEU-1: %.2f,\tBLEU-2: %.2f,\tBLEU-3: %.2f,\tBLEU-4: %.2f)\n\t"
-                        "CHRF %.2f\t"
-                        "ROUGE %.2f",
-                        dev_best_translation_beam_size,
-                        dev_best_translation_alpha,
-                        dev_best_translation_result["valid_scores"]["bleu"],
-                        dev_best_translation_result["valid_scores"]["bleu_scores"][
-                            "bleu1"
-                        ],
-                        dev_best_translation_result["valid_scores"]["bleu_scores"][
-                            "bleu2"
-                        ],
-                        dev_best_translation_result["valid_scores"]["bleu_scores"][
-                            "bleu3"
-                        ],
-                        dev_best_translation_result["valid_scores"]["bleu_scores"][
-                            "bleu4"
-                        ],
-                        dev_best_translation_result["valid_scores"]["chrf"],
-                        dev_best_translation_result["valid_scores"]["rouge"],
-                    )
-                    logger.info("-" * 60)
+                logger.info("-" * 60)
 
     logger.info("*" * 60)
     logger.info(
@@ -557,7 +914,15 @@ def test(
         dev_best_translation_result["valid_scores"]["chrf"] if do_translation else -1,
         dev_best_translation_result["valid_scores"]["rouge"] if do_translation else -1,
     )
+    if do_recognition and sweep_recognition_lm:
+        logger.info(
+            "[DEV] Best Gloss LM Weight: %.2f and Insertion Bonus: %.2f",
+            dev_best_recognition_lm_weight,
+            dev_best_recognition_lm_insertion_bonus,
+        )
     logger.info("*" * 60)
+    if dev_encoder_cache is not None:
+        dev_encoder_cache.close()
 
     test_best_result = validate_on_data(
         model=model,
@@ -588,6 +953,12 @@ def test(
         else None,
         translation_beam_alpha=dev_best_translation_alpha if do_translation else None,
         frame_subsampling_ratio=frame_subsampling_ratio,
+        sort_by_length=sort_by_length,
+        recognition_lm=recognition_lm,
+        recognition_lm_weight=dev_best_recognition_lm_weight if do_recognition else 0.0,
+        recognition_lm_insertion_bonus=dev_best_recognition_lm_insertion_bonus
+        if do_recognition
+        else 0.0,
     )
 
     logger.info(
@@ -69,7 +69,8 @@ def recurrent_greedy(
 ) -> (np.array, np.array):
     """
     Greedy decoding: in each step, choose the word that gets highest score.
-    Version for recurrent decoder.
+    Version for recurrent decoder. Sequences that produced </s> are removed
+    from the decoded batch, their remaining outputs are </s>.
 
     :param src_mask: mask for source inputs, 0 for positions after </s>
     :param embed: target embedding
@@ -87,11 +88,16 @@ def recurrent_greedy(
     prev_y = src_mask.new_full(
         size=[batch_size, 1], fill_value=bos_index, dtype=torch.long
     )
-    output = []
-    attention_scores = []
+    output = src_mask.new_full(
+        [batch_size, max_output_length], eos_index, dtype=torch.long
+    )
+    attention_scores = encoder_output.new_zeros(
+        [batch_size, max_output_length, src_mask.size(-1)]
+    )
     hidden = None
     prev_att_vector = None
-    finished = src_mask.new_zeros((batch_size, 1)).byte()
+    # batch entry of every decoded sequence
+    batch_index = torch.arange(batch_size, device=src_mask.device)
 
     # pylint: disable=unused-variable
     for t in range(max_output_length):
@@ -109,19 +115,33 @@ def recurrent_greedy(
 
         # greedy decoding: choose arg max over vocabulary in each step
         next_word = torch.argmax(logits, dim=-1)  # batch x time=1
-        output.append(next_word.squeeze(1).detach().cpu().numpy())
+        output[batch_index, t] = next_word.squeeze(1)
         prev_y = next_word
-        attention_scores.append(att_probs.squeeze(1).detach().cpu().numpy())
+        attention_scores[batch_index, t] = att_probs.squeeze(1)
         # batch, max_src_lengths
         # check if previous symbol was <eos>
-        is_eos = torch.eq(next_word, eos_index)
-        finished += is_eos
-        # stop predicting if <eos> reached for all elements in batch
-        if (finished >= 1).sum() == batch_size:
-            break
+        is_eos = torch.eq(next_word.squeeze(1), eos_index)
+        if is_eos.any():
+            # stop predicting if <eos> reached for all elements in batch
+            keep = (~is_eos).nonzero().view(-1)
+            if len(keep) == 0:
+                break
+            # remove finished sequences
+            batch_index = batch_index.index_select(0, keep)
+            prev_y = prev_y.index_select(0, keep)
+            encoder_output = encoder_output.index_select(0, keep)
+            src_mask = src_mask.index_select(0, keep)
+            if encoder_hidden is not None:
+                encoder_hidden = encoder_hidden.index_select(0, keep)
+            if isinstance(hidden, tuple):
+                # for LSTMs, states are tuples of tensors
+                hidden = tuple(h.index_select(1, keep) for h in hidden)
+            else:
+                hidden = hidden.index_select(1, keep)
+            prev_att_vector = prev_att_vector.index_select(0, keep)
 
-    stacked_output = np.stack(output, axis=1)  # batch, time
-    stacked_attention_scores = np.stack(attention_scores, axis=1)
+    stacked_output = output[:, : t + 1].cpu().numpy()  # batch, time
+    stacked_attention_scores = attention_scores[:, : t + 1].cpu().numpy()
     return stacked_output, stacked_attention_scores
 
 
@@ -139,6 +159,9 @@ def transformer_greedy(
     """
     Special greedy function for transformer, since it works differently.
     The transformer remembers all previous states and attends to them.
+    They are kept in a decoder cache, so only the newest token is decoded
+    in each step. Sequences that produced </s> are removed from the decoded
+    batch, their remaining outputs are </s>.
 
     :param src_mask: mask for source inputs, 0 for positions after </s>
     :param embed: target embedding layer
@@ -156,15 +179,20 @@ def transformer_greedy(
     batch_size = src_mask.size(0)
 
     # start with BOS-symbol for each sentence in the batch
-    ys = encoder_output.new_full([batch_size, 1], bos_index, dtype=torch.long)
+    prev_y = encoder_output.new_full([batch_size, 1], bos_index, dtype=torch.long)
+    ys = encoder_output.new_full(
+        [batch_size, max_output_length], eos_index, dtype=torch.long
+    )
+    # batch entry of every decoded sequence
+    batch_index = torch.arange(batch_size, device=encoder_output.device)
 
     # a subsequent mask is intersected with this in decoder forward pass
     trg_mask = src_mask.new_ones([1, 1, 1])
-    finished = src_mask.new_zeros((batch_size)).byte()
+    cache = decoder.init_cache(encoder_output)
 
-    for _ in range(max_output_length):
+    for t in range(max_output_length):
 
-        trg_embed = embed(ys)  # embed the previous tokens
+        trg_embed = embed(prev_y)  # embed the newest token
 
         # pylint: disable=unused-variable
         with torch.no_grad():
@@ -176,22 +204,29 @@ def transformer_greedy(
                 unroll_steps=None,
                 hidden=None,
                 trg_mask=trg_mask,
+                cache=cache,
             )
 
             logits = logits[:, -1]
             _, next_word = torch.max(logits, dim=1)
             next_word = next_word.data
-            ys = torch.cat([ys, next_word.unsqueeze(-1)], dim=1)
+            ys[batch_index, t] = next_word
+            prev_y = next_word.unsqueeze(-1)
 
         # check if previous symbol was <eos>
         is_eos = torch.eq(next_word, eos_index)
-        finished += is_eos
-        # stop predicting if <eos> reached for all elements in batch
-        if (finished >= 1).sum() == batch_size:
-            break
+        if is_eos.any():
+            # stop predicting if <eos> reached for all elements in batch
+            keep = (~is_eos).nonzero().view(-1)
+            if len(keep) == 0:
+                break
+            # remove finished sequences
+            batch_index = batch_index.index_select(0, keep)
+            prev_y = prev_y.index_select(0, keep)
+            src_mask = src_mask.index_select(0, keep)
+            decoder.reorder_cache(cache, keep, memory_index=keep)
 
-    ys = ys[:, 1:]  # remove BOS-symbol
-    return ys.detach().cpu().numpy(), None
+    return ys[:, : t + 1].detach().cpu().numpy(), None
 
 
 # pylint: disable=too-many-statements,too-many-branches
@@ -208,12 +243,14 @@ def beam_search(
     alpha: float,
     embed: Embeddings,
     n_best: int = 1,
-) -> (np.array, np.array):
+) -> (np.array, np.array, None):
     """
     Beam search with size k.
     Inspired by OpenNMT-py, adapted for Transformer.
 
     In each decoding step, find the k most likely partial hypotheses.
+    The n_best finished hypotheses of every sentence are kept in tensors and
+    updated in every step, so that finishing beams need no host syncs.
 
     :param decoder:
     :param size: size of the beam
@@ -226,9 +263,11 @@ def beam_search(
     :param max_output_length:
     :param alpha: `alpha` factor for length penalty
     :param embed:
-    :param n_best: return this many hypotheses, <= beam (currently only 1)
+    :param n_best: return this many hypotheses, <= beam
     :return:
-        - stacked_output: output hypotheses (2d array of indices),
+        - stacked_output: output hypotheses (2d array of indices), the n_best
+            hypotheses of a sentence are consecutive rows
+        - stacked_scores: scores of the hypotheses (1d array)
         - stacked_attention_scores: attention scores (3d array)
     """
     assert size > 0, "Beam size must be >0."
@@ -250,16 +289,19 @@ def beam_search(
     if hidden is not None:
         hidden = tile(hidden, size, dim=1)  # layers x batch*k x dec_hidden_size
 
-    encoder_output = tile(
-        encoder_output.contiguous(), size, dim=0
-    )  # batch*k x src_len x enc_hidden_size
-    src_mask = tile(src_mask, size, dim=0)  # batch*k x 1 x src_len
-
-    # Transformer only: create target mask
+    # Transformer only: create target mask and decoder cache
     if transformer:
         trg_mask = src_mask.new_ones([1, 1, 1])  # transformer only
+        # the source representations are projected once and shared by the
+        # beams of a sentence, so they are not tiled
+        cache = decoder.init_cache(encoder_output)
     else:
         trg_mask = None
+        cache = None
+        encoder_output = tile(
+            encoder_output.contiguous(), size, dim=0
+        )  # batch*k x src_len x enc_hidden_size
+        src_mask = tile(src_mask, size, dim=0)  # batch*k x 1 x src_len
 
     # numbering elements in the batch
     batch_offset = torch.arange(
@@ -285,25 +327,31 @@ def beam_search(
     topk_log_probs = torch.zeros(batch_size, size, device=encoder_output.device)
     topk_log_probs[:, 1:] = float("-inf")
 
-    # Structure that holds finished hypotheses.
-    hypotheses = [[] for _ in range(batch_size)]
+    # The n_best finished hypotheses of every sentence, best first.
+    # Empty slots have a score of -inf and length 0.
+    hyp_scores = torch.full(
+        (batch_size, n_best), float("-inf"), device=encoder_output.device
+    )
+    hyp_seqs = torch.full(
+        (batch_size, n_best, max_output_length),
+        pad_index,
+        dtype=torch.long,
+        device=encoder_output.device,
+    )
+    hyp_lengths = torch.zeros(
+        (batch_size, n_best), dtype=torch.long, device=encoder_output.device
+    )
 
-    results = {
-        "predictions": [[] for _ in range(batch_size)],
-        "scores": [[] for _ in range(batch_size)],
-        "gold_score": [0] * batch_size,
-    }
+    # number of EOS in the alive hypotheses
+    eos_counts = torch.zeros(
+        batch_size * size, dtype=torch.long, device=encoder_output.device
+    )
 
     for step in range(max_output_length):
 
-        # This decides which part of the predicted sentence we feed to the
-        # decoder to make the next prediction.
-        # For Transformer, we feed the complete predicted sentence so far.
-        # For Recurrent models, only feed the previous target word prediction
-        if transformer:  # Transformer
-            decoder_input = alive_seq  # complete prediction so far
-        else:  # Recurrent
-            decoder_input = alive_seq[:, -1].view(-1, 1)  # only the last word
+        # We only feed the previous target word prediction to the decoder.
+        # The Transformer keeps the earlier ones in its cache.
+        decoder_input = alive_seq[:, -1].view(-1, 1)  # only the last word
 
         # expand current hypotheses
         # decode one single step
@@ -319,10 +367,9 @@ def beam_search(
             prev_att_vector=att_vectors,
             unroll_steps=1,
             trg_mask=trg_mask,  # subsequent mask for Transformer only
+            cache=cache,  # decoder cache for Transformer only
         )
 
-        # For the Transformer we made predictions for all time steps up to
-        # this point, so we only want to know about the last time step.
         if transformer:
             logits = logits[:, -1]  # keep only the last time step
             hidden = None  # we don't need to keep it for transformer
@@ -365,41 +412,59 @@ def beam_search(
         alive_seq = torch.cat(
             [alive_seq.index_select(0, select_indices), topk_ids.view(-1, 1)], -1
         )  # batch_size*k x hyp_len
+        eos_counts = eos_counts.index_select(0, select_indices) + topk_ids.view(
+            -1
+        ).eq(eos_index)
 
         is_finished = topk_ids.eq(eos_index)
         if step + 1 == max_output_length:
             is_finished.fill_(True)
         # end condition is whether the top beam is finished
         end_condition = is_finished[:, 0].eq(True)
+        # all beams of an ended sentence are finished
+        is_finished |= end_condition.unsqueeze(1)
+        # If a prediction has more than one EOS, it has already been added to
+        # the hypotheses, so you don't have to add it again.
+        is_finished &= eos_counts.view(-1, size).lt(2)
+
+        # merge the finished predictions into the hypotheses. A stable sort
+        # prefers earlier hypotheses among equal scores.
+        predictions = alive_seq.view(-1, size, alive_seq.size(-1))
+        all_scores = torch.cat(
+            [
+                hyp_scores.index_select(0, batch_offset),
+                topk_scores.masked_fill(~is_finished, float("-inf")),
+            ],
+            dim=1,
+        )
+        all_seqs = torch.cat(
+            [
+                hyp_seqs.index_select(0, batch_offset),
+                F.pad(  # ignore start_token
+                    predictions[:, :, 1:],
+                    (0, max_output_length - step - 1),
+                    value=pad_index,
+                ),
+            ],
+            dim=1,
+        )
+        all_lengths = torch.cat(
+            [
+                hyp_lengths.index_select(0, batch_offset),
+                torch.full_like(topk_ids, step + 1),
+            ],
+            dim=1,
+        )
+        best = all_scores.sort(dim=1, descending=True, stable=True).indices
+        best = best[:, :n_best]
+        hyp_scores[batch_offset] = all_scores.gather(1, best)
+        hyp_seqs[batch_offset] = all_seqs.gather(
+            1, best.unsqueeze(2).expand(-1, -1, max_output_length)
+        )
+        hyp_lengths[batch_offset] = all_lengths.gather(1, best)
 
-        # save finished hypotheses
-        if is_finished.any():
-            predictions = alive_seq.view(-1, size, alive_seq.size(-1))
-            for i in range(is_finished.size(0)):
-                b = batch_offset[i]
-                if end_condition[i]:
-                    is_finished[i].fill_(True)
-                finished_hyp = is_finished[i].nonzero().view(-1)
-                # store finished hypotheses for this batch
-                for j in finished_hyp:
-                    # Check if the prediction has more than one EOS.
-                    # If it has more than one EOS, it means that the prediction should have already
-                    # been added to the hypotheses, so you don't have to add them again.
-                    if (predictions[i, j, 1:] == eos_index).nonzero().numel() < 2:
-                        hypotheses[b].append(
-                            (
-                                topk_scores[i, j],
-                                predictions[i, j, 1:],
-                            )  # ignore start_token
-                        )
-                # if the batch reached the end, save the n_best hypotheses
-                if end_condition[i]:
-                    best_hyp = sorted(hypotheses[b], key=lambda x: x[0], reverse=True)
-                    for n, (score, pred) in enumerate(best_hyp):
-                        if n >= n_best:
-                            break
-                        results["scores"][b].append(score)
-                        results["predictions"][b].append(pred)
+        # remove ended sentences from the batch
+        if end_condition.any():
             non_finished = end_condition.eq(False).nonzero().view(-1)
             # if all sentences are translated, no need to go further
             # pylint: disable=len-as-condition
@@ -412,11 +477,22 @@ def beam_search(
             alive_seq = predictions.index_select(0, non_finished).view(
                 -1, alive_seq.size(-1)
             )
+            eos_counts = (
+                eos_counts.view(-1, size).index_select(0, non_finished).view(-1)
+            )
+            if transformer:
+                src_mask = src_mask.index_select(0, non_finished)
+                decoder.reorder_cache(
+                    cache, batch_index.view(-1), memory_index=non_finished
+                )
+        elif transformer:
+            decoder.reorder_cache(cache, batch_index.view(-1))
 
         # reorder indices, outputs and masks
         select_indices = batch_index.view(-1)
-        encoder_output = encoder_output.index_select(0, select_indices)
-        src_mask = src_mask.index_select(0, select_indices)
+        if not transformer:
+            encoder_output = encoder_output.index_select(0, select_indices)
+            src_mask = src_mask.index_select(0, select_indices)
 
         if hidden is not None and not transformer:
             if isinstance(hidden, tuple):
@@ -432,20 +508,9 @@ def beam_search(
         if att_vectors is not None:
             att_vectors = att_vectors.index_select(0, select_indices)
 
-    def pad_and_stack_hyps(hyps, pad_value):
-        filled = (
-            np.ones((len(hyps), max([h.shape[0] for h in hyps])), dtype=int) * pad_value
-        )
-        for j, h in enumerate(hyps):
-            for k, i in enumerate(h):
-                filled[j, k] = i
-        return filled
-
-    # from results to stacked outputs
-    assert n_best == 1
-    # only works for n_best=1 for now
-    final_outputs = pad_and_stack_hyps(
-        [r[0].cpu().numpy() for r in results["predictions"]], pad_value=pad_index
-    )
+    # from hypotheses to stacked outputs
+    final_length = int(hyp_lengths.max())
+    final_outputs = hyp_seqs[:, :, :final_length].reshape(batch_size * n_best, -1)
+    final_scores = hyp_scores.view(-1)
 
-    return final_outputs, None
+    return final_outputs.cpu().numpy(), final_scores.cpu().numpy(), None
@@ -4,6 +4,9 @@ import torch
 torch.backends.cudnn.deterministic = True
 
 import argparse
+import contextlib
+import datetime
+import logging
 import numpy as np
 import os
 import shutil
@@ -32,9 +35,11 @@ from signjoey.prediction import test
 from signjoey.metrics import wer_single
 from signjoey.vocabulary import SIL_TOKEN
 from torch import Tensor
+from torch import distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.tensorboard import SummaryWriter
 from torchtext.data import Dataset
-from typing import List, Dict
+from typing import Dict, Iterator, List
 
 
 # pylint: disable=too-many-instance-attributes
@@ -52,14 +57,29 @@ class TrainManager:
         train_config = config["training"]
         self.config = config
 
+        # distributed data parallel training with one process per rank,
+        # the process group is set up by train()
+        self.distributed = dist.is_available() and dist.is_initialized()
+        self.rank = dist.get_rank() if self.distributed else 0
+        self.world_size = dist.get_world_size() if self.distributed else 1
+        # only the main process validates, logs and writes files
+        self.is_main_process = self.rank == 0
+
         # files for logging and storing
-        self.model_dir = make_model_dir(
-            train_config["model_dir"], overwrite=train_config.get("overwrite", False)
-        )
-        self.logger = make_logger(model_dir=self.model_dir)
+        if self.is_main_process:
+            self.model_dir = make_model_dir(
+                train_config["model_dir"],
+                overwrite=train_config.get("overwrite", False),
+            )
+            self.logger = make_logger(model_dir=self.model_dir)
+            self.tb_writer = SummaryWriter(log_dir=self.model_dir + "/tensorboard/")
+        else:
+            self.model_dir = train_config["model_dir"]
+            # without handlers, only warnings and errors are shown
+            self.logger = logging.getLogger(__name__)
+            self.tb_writer = None
         self.logging_freq = train_config.get("logging_freq", 100)
         self.valid_report_file = "{}/validations.txt".format(self.model_dir)
-        self.tb_writer = SummaryWriter(log_dir=self.model_dir + "/tensorboard/")
 
         # input
         self.feature_size = (
@@ -95,7 +115,27 @@ class TrainManager:
         self.optimizer = build_optimizer(
             config=train_config, parameters=model.parameters()
         )
-        self.batch_multiplier = train_config.get("batch_multiplier", 1)
+        # gradient accumulation: batches are collected until they hold
+        # accumulation_size batches, tokens or frames, then an update is made
+        self.accumulation_type = train_config.get("accumulation_type", "batch")
+        if self.accumulation_type not in ["batch", "tokens", "frames"]:
+            raise ValueError(
+                "Invalid setting for 'accumulation_type': {}".format(
+                    self.accumulation_type
+                )
+            )
+        if self.accumulation_type == "batch":
+            self.accumulation_size = train_config.get(
+                "accumulation_size", train_config.get("batch_multiplier", 1)
+            )
+        elif "accumulation_size" in train_config:
+            self.accumulation_size = train_config["accumulation_size"]
+        else:
+            raise ValueError(
+                "'accumulation_type' {} requires 'accumulation_size'".format(
+                    self.accumulation_type
+                )
+            )
 
         # validation & early stopping
         self.validation_freq = train_config.get("validation_freq", 100)
@@ -106,6 +146,12 @@ class TrainManager:
             raise ValueError(
                 "Invalid setting for 'eval_metric': {}".format(self.eval_metric)
             )
+        # ROUGE can be left out of validations during training
+        self.eval_rouge = train_config.get("eval_rouge", True)
+        if self.eval_metric == "rouge" and not self.eval_rouge:
+            raise ValueError("'eval_metric' rouge requires 'eval_rouge'")
+        # the translation loss and perplexity can be left out of validations
+        self.eval_translation_loss = train_config.get("eval_translation_loss", True)
         self.early_stopping_metric = train_config.get(
             "early_stopping_metric", "eval_metric"
         )
@@ -131,6 +177,15 @@ class TrainManager:
                     self.early_stopping_metric
                 )
             )
+        if (
+            self.early_stopping_metric in ["ppl", "translation_loss"]
+            and not self.eval_translation_loss
+        ):
+            raise ValueError(
+                "'early_stopping_metric' {} requires 'eval_translation_loss'".format(
+                    self.early_stopping_metric
+                )
+            )
 
         # data_augmentation parameters
         self.frame_subsampling_ratio = config["data"].get(
@@ -162,6 +217,11 @@ class TrainManager:
         self.batch_type = train_config.get("batch_type", "sentence")
         self.eval_batch_size = train_config.get("eval_batch_size", self.batch_size)
         self.eval_batch_type = train_config.get("eval_batch_type", self.batch_type)
+        self.eval_sort_by_length = train_config.get("eval_sort_by_length", False)
+        self.data_loader = train_config.get("data_loader", "torchtext")
+        self.num_workers = train_config.get("num_workers", 0)
+        self.pin_memory = train_config.get("pin_memory", False)
+        self.prefetch_factor = train_config.get("prefetch_factor", 2)
 
         self.use_cuda = train_config["use_cuda"]
         if self.use_cuda:
@@ -171,6 +231,23 @@ class TrainManager:
             if self.do_recognition:
                 self.recognition_loss_function.cuda()
 
+        # mixed precision: the forward pass runs under autocast, while the
+        # weights, gradients and optimizer states stay in fp32
+        self.precision = train_config.get("precision", "fp32")
+        if self.precision not in ["fp32", "bf16", "fp16"]:
+            raise ValueError(
+                "Invalid setting for 'precision': {}".format(self.precision)
+            )
+        if self.precision == "fp16" and not self.use_cuda:
+            raise ValueError("'precision' fp16 requires 'use_cuda', use bf16 on CPU")
+        self.autocast_dtype = {
+            "fp32": None,
+            "bf16": torch.bfloat16,
+            "fp16": torch.float16,
+        }[self.precision]
+        # fp16 gradients underflow without loss scaling, bf16 has the fp32 range
+        self.scaler = torch.cuda.amp.GradScaler() if self.precision == "fp16" else None
+
         # initialize training statistics
         self.steps = 0
         # stop training if this flag is True by reaching learning rate minimum
@@ -202,6 +279,16 @@ class TrainManager:
                 reset_optimizer=reset_optimizer,
             )
 
+        if self.distributed:
+            # averages the gradients of all processes during the backward pass,
+            # the model itself stays unwrapped for validation and checkpoints
+            self.ddp_model = DistributedDataParallel(
+                self.model,
+                device_ids=[torch.cuda.current_device()] if self.use_cuda else None,
+            )
+        else:
+            self.ddp_model = None
+
     def _get_recognition_params(self, train_config) -> None:
         # NOTE (Cihan): The blank label is the silence index in the gloss vocabulary.
         #   There is an assertion in the GlossVocabulary class's __init__.
@@ -231,6 +318,19 @@ class TrainManager:
                 "Invalid normalization {}.".format(self.translation_normalization_mode)
             )
         self.translation_loss_weight = train_config.get("translation_loss_weight", 1.0)
+        # compute the training loss over slices of the target time steps
+        self.translation_loss_chunk_size = train_config.get(
+            "translation_loss_chunk_size", None
+        )
+        if (
+            self.translation_loss_chunk_size is not None
+            and self.translation_loss_chunk_size < 1
+        ):
+            raise ValueError(
+                "Invalid setting for 'translation_loss_chunk_size': {}".format(
+                    self.translation_loss_chunk_size
+                )
+            )
         self.eval_translation_beam_size = train_config.get(
             "eval_translation_beam_size", 1
         )
@@ -265,6 +365,9 @@ class TrainManager:
             "scheduler_state": self.scheduler.state_dict()
             if self.scheduler is not None
             else None,
+            "scaler_state": self.scaler.state_dict()
+            if self.scaler is not None
+            else None,
         }
         torch.save(state, model_path)
         if self.ckpt_queue.full():
@@ -313,6 +416,12 @@ class TrainManager:
 
         if not reset_optimizer:
             self.optimizer.load_state_dict(model_checkpoint["optimizer_state"])
+            # checkpoints of fp32 and bf16 training have no loss scale
+            if (
+                model_checkpoint.get("scaler_state", None) is not None
+                and self.scaler is not None
+            ):
+                self.scaler.load_state_dict(model_checkpoint["scaler_state"])
         else:
             self.logger.info("Reset optimizer.")
 
@@ -348,7 +457,8 @@ class TrainManager:
         :param train_data: training data
         :param valid_data: validation data
         """
-        wandb.init(project="mml24_agkw", name=self.config["name"], config = self.config, tags = [self.config["name"]])
+        if self.is_main_process:
+            wandb.init(project="mml24_agkw", name=self.config["name"], config = self.config, tags = [self.config["name"]])
 
         train_iter = make_data_iter(
             train_data,
@@ -356,6 +466,12 @@ class TrainManager:
             batch_type=self.batch_type,
             train=True,
             shuffle=self.shuffle,
+            data_loader=self.data_loader,
+            num_workers=self.num_workers,
+            pin_memory=self.pin_memory and self.use_cuda,
+            prefetch_factor=self.prefetch_factor,
+            num_shards=self.world_size,
+            shard_index=self.rank,
         )
         epoch_no = None
         for epoch_no in range(self.epochs):
@@ -367,7 +483,6 @@ class TrainManager:
             self.model.train()
             start = time.time()
             total_valid_duration = 0
-            count = self.batch_multiplier - 1
 
             if self.do_recognition:
                 processed_gls_tokens = self.total_gls_tokens
@@ -376,59 +491,31 @@ class TrainManager:
                 processed_txt_tokens = self.total_txt_tokens
                 epoch_translation_loss = 0
 
-            for batch in iter(train_iter):
-                # reactivate training
-                # create a Batch object from torchtext batch
-                batch = Batch(
-                    is_train=True,
-                    torch_batch=batch,
-                    txt_pad_index=self.txt_pad_index,
-                    sgn_dim=self.feature_size,
-                    use_cuda=self.use_cuda,
-                    frame_subsampling_ratio=self.frame_subsampling_ratio,
-                    random_frame_subsampling=self.random_frame_subsampling,
-                    random_frame_masking_ratio=self.random_frame_masking_ratio,
-                )
-
-                # only update every batch_multiplier batches
-                # see https://medium.com/@davidlmorton/
-                # increasing-mini-batch-size-without-increasing-
-                # memory-6794e10db672
-                update = count == 0
-
-                recognition_loss, translation_loss = self._train_batch(
-                    batch, update=update
-                )
-
-                if self.do_recognition:
-                    self.tb_writer.add_scalar(
-                        "train/train_recognition_loss", recognition_loss, self.steps
+            for batches in self._accumulate_batches(train_iter):
+                update_start_time = time.time()
+                update_gls_tokens = self.total_gls_tokens
+                update_txt_tokens = self.total_txt_tokens
+                recognition_loss, translation_loss = self._train_update(batches)
+
+                if self.is_main_process:
+                    self._log_update(
+                        recognition_loss=recognition_loss,
+                        translation_loss=translation_loss,
+                        num_batches=len(batches) * self.world_size,
+                        num_gls_tokens=self.total_gls_tokens - update_gls_tokens,
+                        num_txt_tokens=self.total_txt_tokens - update_txt_tokens,
+                        duration=time.time() - update_start_time,
                     )
+                if self.do_recognition:
                     epoch_recognition_loss += recognition_loss.detach().cpu().numpy()
-
                 if self.do_translation:
-                    self.tb_writer.add_scalar(
-                        "train/train_translation_loss", translation_loss, self.steps
-                    )
                     epoch_translation_loss += translation_loss.detach().cpu().numpy()
 
-                count = self.batch_multiplier if update else count
-                count -= 1
-
-                if (
-                    self.scheduler is not None
-                    and self.scheduler_step_at == "step"
-                    and update
-                ):
+                if self.scheduler is not None and self.scheduler_step_at == "step":
                     self.scheduler.step()
 
-                wandb.log({
-                    "train_recognition_loss": recognition_loss,
-                    "train_translation_loss": translation_loss,
-                    "step": self.steps
-                })
                 # log learning progress
-                if self.steps % self.logging_freq == 0 and update:
+                if self.steps % self.logging_freq == 0:
                     elapsed = time.time() - start - total_valid_duration
 
                     log_out = "[Epoch: {:03d} Step: {:08d}] ".format(
@@ -463,7 +550,7 @@ class TrainManager:
                     total_valid_duration = 0
 
                 # validate on the entire dev set
-                if self.steps % self.validation_freq == 0 and update:
+                if self.steps % self.validation_freq == 0 and self.is_main_process:
                     valid_start_time = time.time()
                     # TODO (Cihan): There must be a better way of passing
                     #   these recognition only and translation only parameters!
@@ -508,6 +595,9 @@ class TrainManager:
                         if self.do_translation
                         else None,
                         frame_subsampling_ratio=self.frame_subsampling_ratio,
+                        sort_by_length=self.eval_sort_by_length,
+                        compute_rouge=self.eval_rouge,
+                        compute_translation_loss=self.eval_translation_loss,
                     )
                     self.model.train()
 
@@ -717,11 +807,15 @@ class TrainManager:
                             "references.dev.txt", valid_seq, val_res["txt_ref"]
                         )
 
+                if self.steps % self.validation_freq == 0 and self.distributed:
+                    self._broadcast_validation_outcome()
+
                 if self.stop:
                     break
             if self.stop:
                 if (
-                    self.scheduler is not None
+                    self.is_main_process
+                    and self.scheduler is not None
                     and self.scheduler_step_at == "validation"
                     and self.last_best_lr != prev_lr
                 ):
@@ -744,6 +838,18 @@ class TrainManager:
                 epoch_recognition_loss if self.do_recognition else -1,
                 epoch_translation_loss if self.do_translation else -1,
             )
+            padding_efficiency = train_iter.batch_sampler.padding_efficiency()
+            self.logger.info(
+                "Epoch %3d: Padding Efficiency Sgn %.2f%%  Gls %.2f%%  Txt %.2f%%",
+                epoch_no + 1,
+                padding_efficiency["sgn"] * 100,
+                padding_efficiency["gls"] * 100,
+                padding_efficiency["txt"] * 100,
+            )
+            if self.is_main_process:
+                self.tb_writer.add_scalars(
+                    "train/padding_efficiency", padding_efficiency, self.steps
+                )
         else:
             self.logger.info("Training ended after %3d epochs.", epoch_no + 1)
         self.logger.info(
@@ -753,6 +859,9 @@ class TrainManager:
             self.early_stopping_metric,
         )
 
+        if not self.is_main_process:
+            return
+
         # TODO: change data path to make it usable outside of colab
         artifact = wandb.Artifact(name=self.config["name"], type="model", metadata = self.config)
         artifact.add_file(f"./sign_sample_model/{self.config['name']}/best.ckpt")
@@ -761,79 +870,264 @@ class TrainManager:
 
         self.tb_writer.close()  # close Tensorboard writer
 
-    def _train_batch(self, batch: Batch, update: bool = True) -> (Tensor, Tensor):
+    def _accumulate_batches(self, train_iter) -> Iterator[List[Batch]]:
+        """
+        Group the training batches into updates. A group is complete once it
+        holds `self.accumulation_size` batches, tokens or frames, depending on
+        `self.accumulation_type`. The last group of an epoch may be smaller.
+        Tokens are text tokens, or gloss tokens for recognition only models.
+        In distributed training the sizes are per process, tokens and frames
+        are averaged over the processes.
+
+        :param train_iter: training data iterator
+        :return: lists of batches, one for every update
         """
-        Train the model on one batch: Compute the loss, make a gradient step.
+        batches = []
+        accumulated_size = 0
+        for torch_batch in iter(train_iter):
+            # create a Batch object from torchtext batch
+            batch = Batch(
+                is_train=True,
+                torch_batch=torch_batch,
+                txt_pad_index=self.txt_pad_index,
+                sgn_dim=self.feature_size,
+                use_cuda=self.use_cuda,
+                frame_subsampling_ratio=self.frame_subsampling_ratio,
+                random_frame_subsampling=self.random_frame_subsampling,
+                random_frame_masking_ratio=self.random_frame_masking_ratio,
+            )
+            batches.append(batch)
+
+            if self.accumulation_type == "batch":
+                batch_size = 1
+            elif self.accumulation_type == "tokens":
+                batch_size = (
+                    batch.num_txt_tokens
+                    if self.do_translation
+                    else int(batch.num_gls_tokens)
+                )
+            else:
+                batch_size = int(batch.sgn_lengths.sum())
+            if self.distributed and self.accumulation_type != "batch":
+                # average over the processes, so that all of them close their
+                # groups at the same batch
+                batch_size = torch.tensor(
+                    batch_size, device="cuda" if self.use_cuda else "cpu"
+                )
+                dist.all_reduce(batch_size)
+                batch_size = int(batch_size) / self.world_size
+            accumulated_size += batch_size
+
+            if accumulated_size >= self.accumulation_size:
+                yield batches
+                batches = []
+                accumulated_size = 0
+        if batches:
+            yield batches
+
+    def _train_update(self, batches: List[Batch]) -> (Tensor, Tensor):
+        """
+        Train the model on the batches of one update: Accumulate their
+        gradients, then clip them and make a gradient step.
+
+        The losses are normalized over all batches of the update, as if they
+        were a single batch: the translation loss by their total number of
+        sequences or tokens, the recognition loss by their number of sequences.
+        In distributed training the batches of all processes form the update.
 
-        :param batch: training batch
-        :param update: if False, only store gradient. if True also make update
+        :param batches: training batches of the update
         :return normalized_recognition_loss: Normalized recognition loss
         :return normalized_translation_loss: Normalized translation loss
         """
-
-        recognition_loss, translation_loss = self.model.get_loss_for_batch(
-            batch=batch,
-            recognition_loss_function=self.recognition_loss_function
-            if self.do_recognition
-            else None,
-            translation_loss_function=self.translation_loss_function
-            if self.do_translation
-            else None,
-            recognition_loss_weight=self.recognition_loss_weight
-            if self.do_recognition
-            else None,
-            translation_loss_weight=self.translation_loss_weight
-            if self.do_translation
-            else None,
+        num_seqs = sum(batch.num_seqs for batch in batches)
+        num_gls_tokens = (
+            sum(batch.num_gls_tokens for batch in batches) if self.do_recognition else 0
         )
+        num_txt_tokens = (
+            sum(batch.num_txt_tokens for batch in batches) if self.do_translation else 0
+        )
+        if self.distributed:
+            counts = torch.tensor(
+                [num_seqs, num_gls_tokens, num_txt_tokens],
+                dtype=torch.int64,
+                device="cuda" if self.use_cuda else "cpu",
+            )
+            dist.all_reduce(counts)
+            num_seqs, num_gls_tokens, num_txt_tokens = counts.tolist()
 
-        # normalize translation loss
         if self.do_translation:
             if self.translation_normalization_mode == "batch":
-                txt_normalization_factor = batch.num_seqs
+                txt_normalization_factor = num_seqs
             elif self.translation_normalization_mode == "tokens":
-                txt_normalization_factor = batch.num_txt_tokens
+                txt_normalization_factor = num_txt_tokens
             else:
                 raise NotImplementedError("Only normalize by 'batch' or 'tokens'")
 
-            # division needed since loss.backward sums the gradients until updated
-            normalized_translation_loss = translation_loss / (
-                txt_normalization_factor * self.batch_multiplier
-            )
-        else:
-            normalized_translation_loss = 0
+        update_recognition_loss = 0
+        update_translation_loss = 0
+        for batch_no, batch in enumerate(batches):
+            # distributed: the forward pass decides whether the following
+            # backward pass averages the gradients, only the last one does
+            if self.distributed and batch_no < len(batches) - 1:
+                sync_context = self.ddp_model.no_sync()
+            else:
+                sync_context = contextlib.nullcontext()
+            # the model computes its log probabilities and losses in fp32
+            with sync_context, torch.autocast(
+                device_type="cuda" if self.use_cuda else "cpu",
+                dtype=self.autocast_dtype,
+                enabled=self.autocast_dtype is not None,
+            ):
+                recognition_loss, translation_loss = self.model.get_loss_for_batch(
+                    batch=batch,
+                    recognition_loss_function=self.recognition_loss_function
+                    if self.do_recognition
+                    else None,
+                    translation_loss_function=self.translation_loss_function
+                    if self.do_translation
+                    else None,
+                    recognition_loss_weight=self.recognition_loss_weight
+                    if self.do_recognition
+                    else None,
+                    translation_loss_weight=self.translation_loss_weight
+                    if self.do_translation
+                    else None,
+                    translation_loss_chunk_size=self.translation_loss_chunk_size
+                    if self.do_translation
+                    else None,
+                    forward_module=self.ddp_model,
+                )
 
-        # TODO (Cihan): Add Gloss Token normalization (?)
-        #   I think they are already being normalized by batch
-        #   I need to think about if I want to normalize them by token.
-        if self.do_recognition:
-            normalized_recognition_loss = recognition_loss / self.batch_multiplier
-        else:
-            normalized_recognition_loss = 0
+            # normalize translation loss
+            if self.do_translation:
+                # loss.backward sums the gradients of all batches of the update
+                normalized_translation_loss = (
+                    translation_loss / txt_normalization_factor
+                )
+                update_translation_loss += normalized_translation_loss.detach()
+            else:
+                normalized_translation_loss = 0
+
+            # the CTC loss is averaged over the sequences of a batch,
+            # so every batch is weighted by its share of the sequences
+            if self.do_recognition:
+                normalized_recognition_loss = recognition_loss * (
+                    batch.num_seqs / num_seqs
+                )
+                update_recognition_loss += normalized_recognition_loss.detach()
+            else:
+                normalized_recognition_loss = 0
+
+            total_loss = normalized_recognition_loss + normalized_translation_loss
+            if self.distributed:
+                # DistributedDataParallel averages the gradients of the processes
+                total_loss = total_loss * self.world_size
+            # compute gradients, scaled ones with fp16
+            if self.scaler is None:
+                total_loss.backward()
+            else:
+                self.scaler.scale(total_loss).backward()
 
-        total_loss = normalized_recognition_loss + normalized_translation_loss
-        # compute gradients
-        total_loss.backward()
+        # increment token counter
+        if self.do_recognition:
+            self.total_gls_tokens += num_gls_tokens
+        if self.do_translation:
+            self.total_txt_tokens += num_txt_tokens
 
         if self.clip_grad_fun is not None:
+            if self.scaler is not None:
+                self.scaler.unscale_(self.optimizer)
             # clip gradients (in-place)
             self.clip_grad_fun(params=self.model.parameters())
 
-        if update:
-            # make gradient step
+        # make gradient step
+        if self.scaler is None:
             self.optimizer.step()
-            self.optimizer.zero_grad()
+        else:
+            # skips the step if the gradients overflowed
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+        self.optimizer.zero_grad()
+
+        # increment step counter
+        self.steps += 1
+
+        if self.distributed:
+            update_losses = torch.tensor(
+                [float(update_recognition_loss), float(update_translation_loss)],
+                device="cuda" if self.use_cuda else "cpu",
+            )
+            dist.all_reduce(update_losses)
+            update_recognition_loss, update_translation_loss = update_losses.unbind()
 
-            # increment step counter
-            self.steps += 1
+        return update_recognition_loss, update_translation_loss
+
+    def _log_update(
+        self,
+        recognition_loss: Tensor,
+        translation_loss: Tensor,
+        num_batches: int,
+        num_gls_tokens: int,
+        num_txt_tokens: int,
+        duration: float,
+    ) -> None:
+        """
+        Log the losses and the throughput of an update to tensorboard and wandb.
+
+        :param recognition_loss: normalized recognition loss of the update
+        :param translation_loss: normalized translation loss of the update
+        :param num_batches: number of batches of the update
+        :param num_gls_tokens: number of gloss tokens of the update
+        :param num_txt_tokens: number of text tokens of the update
+        :param duration: duration of the update in seconds
+        """
+        update_log_data = {
+            "train_recognition_loss": recognition_loss,
+            "train_translation_loss": translation_loss,
+            "train_update_batches": num_batches,
+            "step": self.steps,
+        }
 
-        # increment token counter
         if self.do_recognition:
-            self.total_gls_tokens += batch.num_gls_tokens
+            self.tb_writer.add_scalar(
+                "train/train_recognition_loss", recognition_loss, self.steps
+            )
+            update_log_data["train_gls_tokens_per_sec"] = num_gls_tokens / duration
+            self.tb_writer.add_scalar(
+                "train/gls_tokens_per_sec",
+                update_log_data["train_gls_tokens_per_sec"],
+                self.steps,
+            )
+
         if self.do_translation:
-            self.total_txt_tokens += batch.num_txt_tokens
+            self.tb_writer.add_scalar(
+                "train/train_translation_loss", translation_loss, self.steps
+            )
+            update_log_data["train_txt_tokens_per_sec"] = num_txt_tokens / duration
+            self.tb_writer.add_scalar(
+                "train/txt_tokens_per_sec",
+                update_log_data["train_txt_tokens_per_sec"],
+                self.steps,
+            )
 
-        return normalized_recognition_loss, normalized_translation_loss
+        wandb.log(update_log_data)
+
+    def _broadcast_validation_outcome(self) -> None:
+        """
+        Share the outcome of a validation from the main process with the
+        others: whether to stop training and the learning rates, which a
+        scheduler stepping at validation may have decayed.
+        """
+        state = torch.tensor(
+            [float(self.stop)]
+            + [group["lr"] for group in self.optimizer.param_groups],
+            dtype=torch.float64,
+            device="cuda" if self.use_cuda else "cpu",
+        )
+        dist.broadcast(state, src=0)
+        self.stop = bool(state[0])
+        for group, lr in zip(self.optimizer.param_groups, state[1:].tolist()):
+            group["lr"] = lr
 
     def _add_report(
         self,
@@ -951,7 +1245,9 @@ class TrainManager:
         for ri in rand_idx:
             self.logger.info("Logging Sequence: %s", sequences[ri])
             if self.do_recognition:
-                gls_res = wer_single(r=gls_references[ri], h=gls_hypotheses[ri])
+                gls_res = wer_single(
+                    r=gls_references[ri], h=gls_hypotheses[ri], alignment=True
+                )
                 self.logger.info(
                     "\tGloss Reference :\t%s", gls_res["alignment_out"]["align_ref"]
                 )
@@ -964,7 +1260,9 @@ class TrainManager:
             if self.do_recognition and self.do_translation:
                 self.logger.info("\t" + "-" * 116)
             if self.do_translation:
-                txt_res = wer_single(r=txt_references[ri], h=txt_hypotheses[ri])
+                txt_res = wer_single(
+                    r=txt_references[ri], h=txt_hypotheses[ri], alignment=True
+                )
                 self.logger.info(
                     "\tText Reference  :\t%s", txt_res["alignment_out"]["align_ref"]
                 )
@@ -1002,10 +1300,25 @@ def train(cfg_file: str) -> None:
     """
     Main training function. After training, also test on test data if given.
 
+    Started with torchrun, every process trains on its share of the training
+    batches and the gradients are averaged (DistributedDataParallel).
+
     :param cfg_file: path to configuration yaml file
     """
     cfg = load_config(cfg_file)
 
+    # set up the process group when started with torchrun
+    if int(os.environ.get("WORLD_SIZE", 1)) > 1:
+        if cfg["training"].get("use_cuda", False):
+            torch.cuda.set_device(int(os.environ["LOCAL_RANK"]))
+        # the other processes wait for the validations of the first one
+        dist.init_process_group(
+            backend=cfg["training"].get("distributed_backend", "gloo"),
+            timeout=datetime.timedelta(
+                seconds=cfg["training"].get("distributed_timeout", 7200)
+            ),
+        )
+
     # set the random seed
     set_seed(seed=cfg["training"].get("random_seed", 42))
 
@@ -1030,34 +1343,46 @@ def train(cfg_file: str) -> None:
     # for training management, e.g. early stopping and model selection
     trainer = TrainManager(model=model, config=cfg)
 
-    # store copy of original training config in model dir
-    shutil.copy2(cfg_file, trainer.model_dir + "/config.yaml")
+    if trainer.is_main_process:
+        # store copy of original training config in model dir
+        shutil.copy2(cfg_file, trainer.model_dir + "/config.yaml")
 
-    # log all entries of config
-    log_cfg(cfg, trainer.logger)
+        # log all entries of config
+        log_cfg(cfg, trainer.logger)
 
-    log_data_info(
-        train_data=train_data,
-        valid_data=dev_data,
-        test_data=test_data,
-        gls_vocab=gls_vocab,
-        txt_vocab=txt_vocab,
-        logging_function=trainer.logger.info,
-    )
+        log_data_info(
+            train_data=train_data,
+            valid_data=dev_data,
+            test_data=test_data,
+            gls_vocab=gls_vocab,
+            txt_vocab=txt_vocab,
+            logging_function=trainer.logger.info,
+        )
+
+        trainer.logger.info(str(model))
 
-    trainer.logger.info(str(model))
+        # store the vocabs
+        gls_vocab_file = "{}/gls.vocab".format(cfg["training"]["model_dir"])
+        gls_vocab.to_file(gls_vocab_file)
+        txt_vocab_file = "{}/txt.vocab".format(cfg["training"]["model_dir"])
+        txt_vocab.to_file(txt_vocab_file)
 
-    # store the vocabs
-    gls_vocab_file = "{}/gls.vocab".format(cfg["training"]["model_dir"])
-    gls_vocab.to_file(gls_vocab_file)
-    txt_vocab_file = "{}/txt.vocab".format(cfg["training"]["model_dir"])
-    txt_vocab.to_file(txt_vocab_file)
+    if trainer.distributed:
+        # the processes start from the same parameters, but draw different
+        # dropout masks and augmentations. With these, results differ from a
+        # single process accumulating the same batches.
+        torch.manual_seed(cfg["training"].get("random_seed", 42) + trainer.rank)
 
     # train the model
     trainer.train_and_validate(train_data=train_data, valid_data=dev_data)
     # Delete to speed things up as we don't need training data anymore
     del train_data, dev_data, test_data
 
+    if trainer.distributed:
+        dist.destroy_process_group()
+        if not trainer.is_main_process:
+            return
+
     # predict with the best model on validation and test
     # (if test data is available)
     ckpt = "{}/{}.ckpt".format(trainer.model_dir, trainer.best_ckpt_iteration)
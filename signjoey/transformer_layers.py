@@ -38,29 +38,75 @@ class MultiHeadedAttention(nn.Module):
         self.softmax = nn.Softmax(dim=-1)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, k: Tensor, v: Tensor, q: Tensor, mask: Tensor = None):
+    def project_kv(self, k: Tensor, v: Tensor) -> dict:
+        """
+        Projects keys and values, e.g. to cache them for incremental decoding.
+
+        :param k: keys   [B, M, D] with M being the sentence length.
+        :param v: values [B, M, D]
+        :return: dict with keys and values of shape [B, num_heads, M, head_size]
+        """
+        batch_size = k.size(0)
+        k = self.k_layer(k)
+        v = self.v_layer(v)
+        k = k.view(batch_size, -1, self.num_heads, self.head_size).transpose(1, 2)
+        v = v.view(batch_size, -1, self.num_heads, self.head_size).transpose(1, 2)
+        return {"keys": k, "values": v}
+
+    def forward(
+        self,
+        k: Tensor,
+        v: Tensor,
+        q: Tensor,
+        mask: Tensor = None,
+        cache: dict = None,
+        static_kv: bool = False,
+    ):
         """
         Computes multi-headed attention.
 
+        If there are fewer keys than queries in the batch dimension, every
+        batch entry of the keys is shared by consecutive queries, e.g. by
+        the beams of a sentence.
+
         :param k: keys   [B, M, D] with M being the sentence length.
         :param v: values [B, M, D]
         :param q: query  [B, M, D]
         :param mask: optional mask [B, 1, M]
+        :param cache: optional dict with the projected keys and values of
+            previous calls, updated in place for incremental decoding
+        :param static_kv: take the keys and values from the cache as they
+            are, as prepared with `project_kv`
         :return:
         """
-        batch_size = k.size(0)
+        batch_size = q.size(0)
         num_heads = self.num_heads
 
-        # project the queries (q), keys (k), and values (v)
-        k = self.k_layer(k)
-        v = self.v_layer(v)
+        # project the queries (q), keys (k), and values (v) and reshape
+        # them for our computation to [batch_size, num_heads, ..]
+        if cache is not None and static_kv:
+            k, v = cache["keys"], cache["values"]
+        else:
+            projected = self.project_kv(k, v)
+            k, v = projected["keys"], projected["values"]
+            if cache is not None:
+                if "keys" in cache:
+                    k = torch.cat([cache["keys"], k], dim=2)
+                    v = torch.cat([cache["values"], v], dim=2)
+                cache["keys"], cache["values"] = k, v
         q = self.q_layer(q)
-
-        # reshape q, k, v for our computation to [batch_size, num_heads, ..]
-        k = k.view(batch_size, -1, num_heads, self.head_size).transpose(1, 2)
-        v = v.view(batch_size, -1, num_heads, self.head_size).transpose(1, 2)
         q = q.view(batch_size, -1, num_heads, self.head_size).transpose(1, 2)
 
+        # fold the queries sharing keys into the query length
+        shared = batch_size // k.size(0)
+        query_len = q.size(2)
+        if shared > 1:
+            q = (
+                q.reshape(k.size(0), shared, num_heads, query_len, self.head_size)
+                .transpose(1, 2)
+                .reshape(k.size(0), num_heads, shared * query_len, self.head_size)
+            )
+
         # compute scores
         q = q / math.sqrt(self.head_size)
 
@@ -79,6 +125,12 @@ class MultiHeadedAttention(nn.Module):
         # get context vector (select values with attention) and reshape
         # back to [B, M, D]
         context = torch.matmul(attention, v)
+        if shared > 1:
+            context = (
+                context.view(k.size(0), num_heads, shared, query_len, self.head_size)
+                .transpose(1, 2)
+                .reshape(batch_size, num_heads, query_len, self.head_size)
+            )
         context = (
             context.transpose(1, 2)
             .contiguous()
@@ -154,14 +206,15 @@ class PositionalEncoding(nn.Module):
         self.register_buffer("pe", pe)
         self.dim = size
 
-    def forward(self, emb):
+    def forward(self, emb, offset: int = 0):
         """Embed inputs.
         Args:
             emb (FloatTensor): Sequence of word vectors
                 ``(seq_len, batch_size, self.dim)``
+            offset (int): position of the first vector
         """
         # Add position encodings
-        return emb + self.pe[:, : emb.size(1)]
+        return emb + self.pe[:, offset : offset + emb.size(1)]
 
 
 class TransformerEncoderLayer(nn.Module):
@@ -251,6 +304,7 @@ class TransformerDecoderLayer(nn.Module):
         memory: Tensor = None,
         src_mask: Tensor = None,
         trg_mask: Tensor = None,
+        cache: dict = None,
     ) -> Tensor:
         """
         Forward pass of a single Transformer decoder layer.
@@ -259,16 +313,24 @@ class TransformerDecoderLayer(nn.Module):
         :param memory: source representations
         :param src_mask: source mask
         :param trg_mask: target mask (so as to not condition on future steps)
+        :param cache: optional dict with the self-attention cache under "self"
+            and the source-attention cache under "memory", for incremental
+            decoding
         :return: output tensor
         """
+        self_cache = cache["self"] if cache is not None else None
+        memory_cache = cache["memory"] if cache is not None else None
+
         # decoder/target self-attention
         x_norm = self.x_layer_norm(x)
-        h1 = self.trg_trg_att(x_norm, x_norm, x_norm, mask=trg_mask)
+        h1 = self.trg_trg_att(x_norm, x_norm, x_norm, mask=trg_mask, cache=self_cache)
         h1 = self.dropout(h1) + x
 
         # source-target attention
         h1_norm = self.dec_layer_norm(h1)
-        h2 = self.src_trg_att(memory, memory, h1_norm, mask=src_mask)
+        h2 = self.src_trg_att(
+            memory, memory, h1_norm, mask=src_mask, cache=memory_cache, static_kv=True
+        )
 
         # final position-wise feed-forward layer
         o = self.feed_forward(self.dropout(h2) + h1)